@@ -0,0 +1,125 @@
+import os
+import time
+import argparse
+import tempfile
+import multiprocessing
+from run_batch_spiders import create_crawl_jobs, run_batch_crawl
+from benchmarks.fixture_site import FixtureSite, load_seasons, build_imdb_pages, build_wiki_pages
+
+
+def build_fixture_manifest(site, seasons, num_shows, output_dir):
+    """Add the pages of num_shows fixture shows to the site, and create a batch crawl manifest for them."""
+    # the offsite filter matches the host, while the link extractor matches the host + port of the URLs
+    allowed_domains = ['127.0.0.1', site.base_url.split('//')[1]]
+
+    manifest = []
+    for show_num in range(num_shows):
+        show_id = 'tt8{:06d}'.format(show_num)
+        show_path = 'Fixture_Show_{}'.format(show_num)
+        site.pages.update(build_imdb_pages(seasons, show_id=show_id))
+        site.pages.update(build_wiki_pages(seasons, show_path=show_path))
+
+        manifest.append({
+            'spider': 'imdb',
+            'start_urls': ['{}/title/{}/'.format(site.base_url, show_id)],
+            'allowed_domains': allowed_domains,
+            'output_path': os.path.join(output_dir, '{}_imdb.json'.format(show_path))
+        })
+        manifest.append({
+            'spider': 'wiki',
+            'start_url': '{}/wiki/{}'.format(site.base_url, show_path),
+            'url_substring': show_path,
+            'title_keywords': ['fixture', 'show'],
+            'allowed_domains': allowed_domains,
+            'output_path': os.path.join(output_dir, '{}_wiki.json'.format(show_path))
+        })
+
+    return manifest
+
+
+def _run_batch_crawl(jobs, max_crawls_per_domain, max_requests_per_domain, stats_queue):
+    """Run a batch crawl in a child process, since the Twisted reactor can not be restarted."""
+    stats_queue.put(run_batch_crawl(jobs, max_crawls_per_domain, max_requests_per_domain, log_level='WARNING'))
+
+
+def run_in_child_process(jobs, max_crawls_per_domain, max_requests_per_domain):
+    """Run a batch crawl in a child process, and return its stats."""
+    stats_queue = multiprocessing.Queue()
+    crawl_process = multiprocessing.Process(
+        target=_run_batch_crawl, args=(jobs, max_crawls_per_domain, max_requests_per_domain, stats_queue)
+    )
+    crawl_process.start()
+    batch_stats = stats_queue.get()
+    crawl_process.join()
+
+    return batch_stats
+
+
+def run_benchmark(args):
+    """Compare one process per crawl (sequentially) to the concurrent batch crawl, on a local stand-in site."""
+    seasons = load_seasons(args.json_path, args.num_seasons, args.season_size)
+    output_dir = tempfile.mkdtemp(prefix='batch_crawl_')
+
+    site = FixtureSite({}, delay=args.delay).start()
+    try:
+        jobs = create_crawl_jobs(build_fixture_manifest(site, seasons, args.num_shows, output_dir), '.')
+
+        # every show is crawled in its own process, one after the other
+        start = time.time()
+        sequential_items = 0
+        for job in jobs:
+            sequential_items += run_in_child_process([job], 1, args.max_requests_per_domain)['items']
+        sequential_seconds = time.time() - start
+        sequential_max_in_flight = site.max_in_flight
+
+        # all the shows are crawled concurrently, in a single process
+        site.reset_counters()
+        start = time.time()
+        batch_stats = run_in_child_process(jobs, args.max_crawls_per_domain, args.max_requests_per_domain)
+        batch_seconds = time.time() - start
+    finally:
+        site.stop()
+
+    print('{:<12}{:>8}{:>8}{:>12}{:>12}{:>16}'.format('mode', 'crawls', 'items', 'seconds', 'items/sec',
+                                                       'max in-flight'))
+    print('{:<12}{:>8}{:>8}{:>12.1f}{:>12.1f}{:>16}'.format(
+        'sequential', len(jobs), sequential_items, sequential_seconds, sequential_items / sequential_seconds,
+        sequential_max_in_flight
+    ))
+    print('{:<12}{:>8}{:>8}{:>12.1f}{:>12.1f}{:>16}'.format(
+        'batch', batch_stats['num_crawls'], batch_stats['items'], batch_seconds, batch_stats['items'] / batch_seconds,
+        site.max_in_flight
+    ))
+    print('\nPer-domain limit of concurrent requests: {} (all the fixture shows are served from the same host).'.format(
+        args.max_requests_per_domain
+    ))
+    print('Outputs: {}'.format(output_dir))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the multi-show batch crawl against sequential crawls on a local stand-in site.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_path', type=str, required=False, default='scraped_data/star_trek_imdb.json',
+                        help='Pre-scraped episode data used for building the fixture site.')
+    parser.add_argument('-n', '--num_shows', type=int, required=False, default=6,
+                        help='Number of fixture shows. Every show is crawled by both spiders.')
+    parser.add_argument('-ns', '--num_seasons', type=int, required=False, default=3,
+                        help='Number of seasons per fixture show.')
+    parser.add_argument('-ss', '--season_size', type=int, required=False, default=10,
+                        help='Number of episodes per season.')
+    parser.add_argument('-dl', '--delay', type=float, required=False, default=0.05,
+                        help='Simulated response latency of the stand-in site in seconds.')
+    parser.add_argument('-c', '--max_crawls_per_domain', type=int, required=False, default=4,
+                        help='Maximum number of crawls running concurrently against the same domain.')
+    parser.add_argument('-r', '--max_requests_per_domain', type=int, required=False, default=8,
+                        help='Maximum number of concurrent requests per domain, shared by the concurrent crawls.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
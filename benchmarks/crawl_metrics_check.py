@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import argparse
+import tempfile
+import multiprocessing
+from collections import Counter
+from scrapy.crawler import CrawlerProcess
+from scrapy.exceptions import DropItem
+from spiders.imdb_episode_summary_spider import ImdbEpisodeSummarySpider
+from spiders.wiki_episode_table_spider import WikiEpisodeTableSpider
+from utils.crawl_metrics import crawl_metrics_settings
+from benchmarks.fixture_site import (FixtureSite, load_seasons, build_imdb_pages, build_wiki_pages,
+                                     IMDB_SHOW_ID, WIKI_SHOW_PATH)
+
+ROBOTS_BODY_SIZE = len('User-agent: *\nDisallow:\n')
+NUM_CHARACTER_PAGES = 20
+
+
+class DropUrlPipeline:
+    """Item pipeline that drops the items of the source URLs matching the DROP_URL_PATTERN setting."""
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get('DROP_URL_PATTERN'))
+
+    def process_item(self, item, spider):
+        if self.pattern.search(item['source_url']):
+            raise DropItem('Source URL excluded from the check output.')
+        return item
+
+
+def _crawl(spider_cls, spider_kwargs, settings):
+    """Run a single crawl (in a child process, since the Twisted reactor can not be restarted)."""
+    process = CrawlerProcess(settings=settings)
+    process.crawl(spider_cls, **spider_kwargs)
+    process.start()
+
+
+def _expected_bytes(site, failures):
+    """The total size of the successful responses of the fixture site."""
+    return sum((len(site.pages[path].encode('utf-8')) if path in site.pages else ROBOTS_BODY_SIZE) *
+               (count - failures.get(path, 0))
+               for path, count in site.request_counts.items())
+
+
+def run_crawl(site, spider_cls, spider_kwargs, spider_settings, name, work_dir, interval):
+    """Run an instrumented crawl against the fixture site, and load its metrics report and its output."""
+    site.reset_counters()
+    # the offsite filter matches the host, while the link extractor matches the host + port of the URLs
+    spider_kwargs = dict(spider_kwargs, allowed_domains=['127.0.0.1', site.base_url.split('//')[1]])
+    metrics_path = os.path.join(work_dir, '{}_metrics.json'.format(name))
+    settings = dict(spider_settings, **{
+        'FEED_FORMAT': 'jsonlines',
+        'FEED_URI': os.path.join(work_dir, '{}.jl'.format(name)),
+        'ROBOTSTXT_OBEY': True,
+        'RETRY_TIMES': 2,
+        'ITEM_PIPELINES': {'benchmarks.crawl_metrics_check.DropUrlPipeline': 300},
+        'LOG_LEVEL': 'WARNING'
+    })
+    settings.update(crawl_metrics_settings(metrics_path, interval))
+
+    crawl_process = multiprocessing.Process(target=_crawl, args=(spider_cls, spider_kwargs, settings))
+    crawl_process.start()
+    crawl_process.join()
+
+    with open(metrics_path, 'r') as f:
+        report = json.load(f)
+    with open(settings['FEED_URI'], 'r') as f:
+        items = [json.loads(line) for line in f]
+
+    return report, items
+
+
+def compare(name, checks):
+    """Print the expected and the measured values, and return the number of mismatches."""
+    print('\n{:<12}{:<36}{:>10}{:>10}'.format('spider', 'metric', 'expected', 'measured'))
+    mismatches = 0
+    for metric, expected, measured in checks:
+        mismatches += expected != measured
+        print('{:<12}{:<36}{:>10}{:>10}{}'.format(name, metric, expected, measured,
+                                                  '' if expected == measured else '  MISMATCH'))
+    return mismatches
+
+
+def run_check(args):
+    """Crawl the fixture site with the instrumentation on, and compare the reports with the served requests."""
+    seasons = load_seasons(args.json_path, args.num_seasons, args.season_size)
+    num_episodes = sum(len(season) for season in seasons)
+    # a duplicate summary: the first summary of an episode of the 2nd season also appears on the page of a later episode
+    ep_title, ep_sums = seasons[-1][-1]
+    seasons[-1][-1] = (ep_title, ep_sums + [seasons[1][0][1][0]])
+    work_dir = tempfile.mkdtemp(prefix='crawl_metrics_')
+
+    pages = build_imdb_pages(seasons)
+    pages.update(build_wiki_pages(seasons, num_character_pages=NUM_CHARACTER_PAGES))
+    # the first requests of a season list and of a plot summary page fail, and are retried
+    failures = {'/title/{}/episodes?season=1'.format(IMDB_SHOW_ID): 1,
+                '/title/{}01001/plotsummary'.format(IMDB_SHOW_ID): 2,
+                '/wiki/{}_(season_1)'.format(WIKI_SHOW_PATH): 1}
+
+    site = FixtureSite(pages, delay=args.delay, failures=failures).start()
+    mismatches = 0
+    try:
+        report, items = run_crawl(site, ImdbEpisodeSummarySpider, {
+            'start_urls': ['{}/title/{}/'.format(site.base_url, IMDB_SHOW_ID)]
+        }, {'DROP_URL_PATTERN': '{}01\\d+/'.format(IMDB_SHOW_ID)}, 'imdb', work_dir, args.interval)
+        imdb_failures = {path: count for path, count in failures.items() if path.startswith('/title/')}
+        num_requests = sum(site.request_counts.values())
+        summaries = Counter(item['episode_summary'] for item in items)
+        totals, callbacks = report['totals'], report['callbacks']
+
+        mismatches += compare('imdb', [
+            ('requests served', num_requests, totals['responses'] + totals['retries']),
+            ('requests scheduled', num_requests - site.request_counts['/robots.txt'] + totals['requests_dropped'],
+             totals['requests_scheduled']),
+            ('retries', sum(imdb_failures.values()), totals['retries']),
+            ('response bytes', _expected_bytes(site, imdb_failures), totals['response_bytes']),
+            ('robots.txt responses', 1, callbacks['robots.txt']['responses']),
+            ('parse responses', 1, callbacks['parse']['responses']),
+            ('parse_episode_list responses', len(seasons), callbacks['parse_episode_list']['responses']),
+            ('parse_episode_page responses', num_episodes, callbacks['parse_episode_page']['responses']),
+            ('parse_plot_summary_page responses', num_episodes, callbacks['parse_plot_summary_page']['responses']),
+            ('parse_episode_page requests', num_episodes, callbacks['parse_episode_page']['requests']),
+            ('items scraped', len(items), totals['items_scraped']),
+            ('items dropped', sum(len(ep_sums) for _, ep_sums in seasons[0]), totals['items_dropped']),
+            ('duplicate items', len(items) - len(summaries), totals['duplicate_items']),
+            ('duplicate requests', 0, totals['requests_dropped'])
+        ])
+
+        report, items = run_crawl(site, WikiEpisodeTableSpider, {
+            'start_url': '{}/wiki/{}'.format(site.base_url, WIKI_SHOW_PATH),
+            'allow': WIKI_SHOW_PATH,
+            'title_keywords': ['fixture', 'show']
+        }, {'DEPTH_LIMIT': 3, 'DROP_URL_PATTERN': '_\\(season_1\\)$'}, 'wiki', work_dir, args.interval)
+        wiki_failures = {path: count for path, count in failures.items() if path.startswith('/wiki/')}
+        num_requests = sum(site.request_counts.values())
+        totals, callbacks = report['totals'], report['callbacks']
+
+        mismatches += compare('wiki', [
+            ('requests served', num_requests, totals['responses'] + totals['retries']),
+            # the scheduled requests include the duplicates, which are dropped by the scheduler
+            ('requests scheduled', num_requests - site.request_counts['/robots.txt'] + totals['requests_dropped'],
+             totals['requests_scheduled']),
+            ('retries', sum(wiki_failures.values()), totals['retries']),
+            ('response bytes', _expected_bytes(site, wiki_failures), totals['response_bytes']),
+            ('robots.txt responses', 1, callbacks['robots.txt']['responses']),
+            ('parse responses', 1, callbacks['parse']['responses']),
+            # the season pages, the character list, the character pages, and the main page again: the start request is
+            # not recorded by the duplicate filter, so the first link back to the main page is followed
+            ('parse_wiki_page responses', len(seasons) + 1 + NUM_CHARACTER_PAGES + 1,
+             callbacks['parse_wiki_page']['responses']),
+            ('items scraped', len(items), totals['items_scraped']),
+            ('items dropped', len(seasons[0]), totals['items_dropped']),
+            # the other links from the character pages back to the main page, and the citation links of the season pages
+            ('duplicate requests', NUM_CHARACTER_PAGES - 1 + len(seasons), totals['requests_dropped'])
+        ])
+    finally:
+        site.stop()
+
+    print('\n{} mismatches. Reports and outputs: {}'.format(mismatches, work_dir))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Verify the crawl instrumentation (utils.crawl_metrics) against the requests served by a local '
+                    'stand-in site.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_path', type=str, required=False, default='scraped_data/star_trek_imdb.json',
+                        help='Pre-scraped episode data used for building the fixture site.')
+    parser.add_argument('-ns', '--num_seasons', type=int, required=False, default=3,
+                        help='Number of seasons of the fixture show.')
+    parser.add_argument('-ss', '--season_size', type=int, required=False, default=12,
+                        help='Number of episodes per season.')
+    parser.add_argument('-d', '--delay', type=float, required=False, default=0.05,
+                        help='Response latency of the fixture site in seconds.')
+    parser.add_argument('-i', '--interval', type=float, required=False, default=0.5,
+                        help='Sampling interval of the time series of the reports in seconds.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_check(args)
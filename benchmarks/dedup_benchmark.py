@@ -0,0 +1,68 @@
+import glob
+import time
+import random
+import argparse
+from utils.data import load_episode_data
+from utils.dedup import remove_near_duplicates
+
+
+def build_corpus(json_paths, corpus_size, edit_ratio, seed):
+    """
+    Build a synthetic corpus from the pre-scraped summaries: every summary is a lightly edited copy of a real one.
+
+    :return: List of strings
+    """
+    rng = random.Random(seed)
+    summaries = [ep_data['episode_summary'] for json_path in json_paths for ep_data in load_episode_data(json_path)]
+    vocab = [word for summary in summaries for word in summary.split()]
+
+    corpus = []
+    for i in range(corpus_size):
+        words = rng.choice(summaries).split()
+        # replace a few words, so the copies are near-duplicates instead of exact duplicates
+        for _ in range(int(len(words) * edit_ratio)):
+            words[rng.randrange(len(words))] = rng.choice(vocab)
+        corpus.append(' '.join(words))
+
+    return corpus
+
+
+def run_benchmark(args):
+    """Measure the run time of the near-duplicate removal for growing corpus sizes."""
+    json_paths = args.json_paths or sorted(glob.glob('scraped_data/*.json'))
+
+    print('{:>12}{:>12}{:>12}{:>12}{:>16}'.format('summaries', 'clusters', 'removed', 'seconds', 'summaries/sec'))
+    for corpus_size in args.corpus_sizes:
+        corpus = build_corpus(json_paths, corpus_size, args.edit_ratio, args.random_seed)
+
+        start = time.perf_counter()
+        to_keep, clusters = remove_near_duplicates(corpus, args.dedup_threshold)
+        elapsed = time.perf_counter() - start
+
+        print('{:>12}{:>12}{:>12}{:>12.2f}{:>16.1f}'.format(
+            corpus_size, len(clusters), corpus_size - len(to_keep), elapsed, corpus_size / elapsed
+        ))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the MinHash/LSH near-duplicate removal of the dataset creation.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_paths', nargs='*', required=False, default=[],
+                        help='Episode data used for building the synthetic corpora. Default: ./scraped_data/*.json')
+    parser.add_argument('-n', '--corpus_sizes', nargs='+', type=int, required=False, default=[10000, 50000, 200000],
+                        help='Sizes of the synthetic corpora.')
+    parser.add_argument('-e', '--edit_ratio', type=float, required=False, default=0.05,
+                        help='Ratio of the randomly replaced words in every copied summary.')
+    parser.add_argument('-dt', '--dedup_threshold', type=float, required=False, default=0.7,
+                        help='Similarity threshold of the near-duplicate removal.')
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,152 @@
+import io
+import os
+import copy
+import glob
+import time
+import argparse
+import tempfile
+import functools
+import contextlib
+import torch
+from torch.utils.data import DataLoader
+from pytorch_transformers import GPT2LMHeadModel
+from train import initialize_optimizer, train_step
+from distill import distill_step, evaluate_student, compare_models
+from utils.data import create_datasets_from_jsons
+from utils.gen_utils import set_random_seeds
+from utils.distillation import (load_or_compute_teacher_cache, DistillationDataset, pad_distillation_batch,
+                                keep_layers)
+from benchmarks.pipeline_benchmark import create_tokenizer, create_tiny_model
+
+
+def train_on_cache(student, dataloader, alpha, args):
+    """Train a student for args.train_steps steps on the cached teacher outputs."""
+    optimizer_args = argparse.Namespace(weight_decay=0.01, learning_rate=args.learning_rate, adam_epsilon=1e-8,
+                                        max_steps=args.train_steps)
+    optimizer, scheduler = initialize_optimizer(student, optimizer_args)
+
+    student.train()
+    steps = 0
+    while steps < args.train_steps:
+        for batch in dataloader:
+            distill_step(student, batch, optimizer, scheduler, 'cpu', args.temperature, alpha)
+            steps += 1
+            if steps >= args.train_steps:
+                break
+    student.eval()
+    return student
+
+
+def run_benchmark(args):
+    """Train a small teacher, distill it into smaller students, and compare their quality and latency."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+    json_paths = args.json_paths or sorted(glob.glob('scraped_data/*.json'))
+
+    tokenizer = create_tokenizer(max_num_words=80, size_var_handling='chop_at_sentence_end')
+    eos_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
+    with contextlib.redirect_stdout(io.StringIO()):
+        train_dataset, val_dataset = create_datasets_from_jsons(json_paths, tokenizer, 0.1)
+    datasets = {'train': train_dataset, 'val': val_dataset}
+
+    # the teacher is trained on the hard labels only, the same way as a fine-tuned model
+    print('Training the teacher for {} steps...'.format(args.teacher_steps))
+    teacher = create_tiny_model(len(tokenizer), argparse.Namespace(n_positions=512, n_embd=args.n_embd,
+                                                                   n_layer=args.n_layer, n_head=args.n_head))
+    optimizer, scheduler = initialize_optimizer(teacher, argparse.Namespace(
+        weight_decay=0.01, learning_rate=1e-3, adam_epsilon=1e-8, max_steps=args.teacher_steps
+    ))
+    teacher_loader = DataLoader(train_dataset, shuffle=True, batch_size=8, collate_fn=tokenizer.pad_batch_to_same_size)
+    teacher.train()
+    steps = 0
+    while steps < args.teacher_steps:
+        for batch in teacher_loader:
+            train_step(teacher, batch, optimizer, scheduler, 'cpu')
+            steps += 1
+            if steps >= args.teacher_steps:
+                break
+    teacher.eval()
+
+    # the first call runs the teacher, the second one only loads its outputs
+    cache_path = os.path.join(tempfile.mkdtemp(), 'teacher_logits.pt')
+    cache_seconds = []
+    for _ in range(2):
+        start = time.perf_counter()
+        teacher_outputs = load_or_compute_teacher_cache(teacher, 'benchmark teacher', datasets, cache_path, eos_id,
+                                                        args.top_k, batch_size=8)
+        cache_seconds.append(time.perf_counter() - start)
+    print('Teacher cache: {:.2f} s computed, {:.2f} s loaded, {:.1f} MB for {} tokens (top-{})\n'.format(
+        cache_seconds[0], cache_seconds[1], os.path.getsize(cache_path) / 2 ** 20,
+        sum(len(outputs['log_probs']) for outputs in teacher_outputs.values()), args.top_k
+    ))
+    os.remove(cache_path)
+
+    collate_fn = functools.partial(pad_distillation_batch, pad_token_id=eos_id)
+    train_loader = DataLoader(DistillationDataset(train_dataset.episode_summaries, teacher_outputs['train']),
+                              shuffle=True, batch_size=8, collate_fn=collate_fn)
+    val_loader = DataLoader(DistillationDataset(val_dataset.episode_summaries, teacher_outputs['val']),
+                            shuffle=False, batch_size=8, collate_fn=collate_fn)
+
+    narrow_config = copy.deepcopy(teacher.config)
+    narrow_config.n_layer, narrow_config.n_embd = args.student_n_layer, args.student_n_embd
+    students = [
+        ('fewer layers, distilled', lambda: keep_layers(copy.deepcopy(teacher), args.student_n_layer), args.alpha),
+        ('fewer layers, hard labels', lambda: keep_layers(copy.deepcopy(teacher), args.student_n_layer), 0.),
+        ('narrower, distilled', lambda: GPT2LMHeadModel(narrow_config), args.alpha),
+        ('narrower, hard labels', lambda: GPT2LMHeadModel(narrow_config), 0.),
+    ]
+    report_args = argparse.Namespace(batch_size=8, max_gen_len=args.gen_len, sampling_top_k=20,
+                                     latency_rounds=args.num_rounds, num_samples=args.num_samples)
+    for name, create_student, alpha in students:
+        print('=' * 20, name, '=' * 20)
+        set_random_seeds(args.random_seed)
+        student = train_on_cache(create_student(), train_loader, alpha, args)
+        val_loss, top1_agreement = evaluate_student(student, val_loader, 'cpu', args.temperature, args.alpha)
+        compare_models(teacher, student, tokenizer, val_dataset.episode_summaries, top1_agreement, report_args, 'cpu')
+        print()
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the distillation: train a small GPT-2 teacher, distill it into students with fewer '
+                    'layers or a narrower config, and compare the students to the teacher and to students trained '
+                    'on the hard labels only.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_paths', nargs='*', required=False, default=[],
+                        help='Episode data. Default: ./scraped_data/*.json')
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-ts', '--teacher_steps', type=int, required=False, default=300,
+                        help='Number of training steps of the teacher.')
+    parser.add_argument('-n', '--train_steps', type=int, required=False, default=150,
+                        help='Number of training steps of every student.')
+    parser.add_argument('-lr', '--learning_rate', type=float, required=False, default=1e-3,
+                        help='Learning rate of the students.')
+    parser.add_argument('-k', '--top_k', type=int, required=False, default=32,
+                        help='Number of the cached teacher log-probabilities per token.')
+    parser.add_argument('-tm', '--temperature', type=float, required=False, default=2.,
+                        help='Softmax temperature of the soft loss.')
+    parser.add_argument('-al', '--alpha', type=float, required=False, default=0.5, help='Weight of the soft loss.')
+    parser.add_argument('-ns', '--num_samples', type=int, required=False, default=8,
+                        help='Number of samples per generation in the latency measurement.')
+    parser.add_argument('-mg', '--gen_len', type=int, required=False, default=48,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-r', '--num_rounds', type=int, required=False, default=3,
+                        help='Number of generations per latency measurement.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=4, help='Number of teacher layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=256, help='Teacher embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    parser.add_argument('-sl', '--student_n_layer', type=int, required=False, default=2,
+                        help='Number of student layers.')
+    parser.add_argument('-se', '--student_n_embd', type=int, required=False, default=128,
+                        help='Embedding size of the narrower student.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,211 @@
+import json
+import time
+from html import escape
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SHOW_TITLE = 'Fixture Show'
+WIKI_SHOW_PATH = 'Fixture_Show'
+IMDB_SHOW_ID = 'tt9000000'
+
+# markup that mimics the weight of the navigation bars, ads and scripts of real pages
+FILLER = '<div class="nav">{}</div><script>{}</script>'.format(
+    ''.join('<a href="/nav/{0}">Navigation link {0}</a>'.format(i) for i in range(200)),
+    'var tracking = "{}";'.format('x' * 20000)
+)
+
+
+def load_seasons(json_path, num_seasons, season_size):
+    """
+    Group the episodes of a pre-scraped JSON file into seasons for the fixture site.
+
+    :param json_path: Path to a JSON file in ./scraped_data/
+    :param num_seasons: The number of seasons
+    :param season_size: The number of episodes per season
+    :return: List of seasons, each season is a list of (episode title, list of episode summaries) tuples,
+             the strings are HTML escaped
+    """
+    with open(json_path, 'r') as f:
+        json_data = json.load(f)
+
+    episodes = {}
+    for ep_data in json_data:
+        episodes.setdefault(escape(ep_data['episode_title']), []).append(escape(ep_data['episode_summary']))
+    episodes = sorted(episodes.items())
+
+    assert len(episodes) >= num_seasons * season_size, 'Not enough episodes in {}.'.format(json_path)
+
+    return [episodes[i * season_size:(i + 1) * season_size] for i in range(num_seasons)]
+
+
+def _page(title, body):
+    return '<html><head><title>{}</title></head><body>{}{}</body></html>'.format(title, FILLER, body)
+
+
+def build_imdb_pages(seasons, show_id=IMDB_SHOW_ID, show_title=SHOW_TITLE):
+    """Create the IMDb-like pages (title page, episode lists, episode pages, plot summaries) of a fixture show."""
+    pages = {}
+    season_links = ''.join('<a href="/title/{}/episodes?season={}">{}</a>'.format(show_id, i + 1, i + 1)
+                           for i in range(len(seasons)))
+    pages['/title/{}/'.format(show_id)] = _page(
+        show_title,
+        '<span itemprop="ratingCount">12,345</span>'
+        '<div class="seasons-and-year-nav"><div>{}</div></div>'.format(season_links)
+    )
+
+    for season_idx, season in enumerate(seasons):
+        ep_list = ''
+        for ep_idx, (ep_title, ep_sums) in enumerate(season):
+            ep_id = '{}{:02d}{:03d}'.format(show_id, season_idx + 1, ep_idx + 1)
+            ep_list += '<div class="info"><strong><a href="/title/{}/">{}</a></strong></div>'.format(ep_id, ep_title)
+
+            pages['/title/{}/'.format(ep_id)] = _page(
+                ep_title, '<a href="/title/{}/plotsummary">Plot Summary</a>'.format(ep_id)
+            )
+            pages['/title/{}/plotsummary'.format(ep_id)] = _page(
+                ep_title,
+                '<div class="subpage_title_block"><h4><a href="/title/{}/">{}</a></h4><h3><a href="/title/{}/">{}</a>'
+                '</h3></div><ul>{}</ul>'.format(
+                    show_id, show_title, ep_id, ep_title,
+                    ''.join('<li class="ipl-zebra-list__item" id="summary-{}"><p>{}</p></li>'.format(i, ep_sum)
+                            for i, ep_sum in enumerate(ep_sums))
+                )
+            )
+
+        pages['/title/{}/episodes?season={}'.format(show_id, season_idx + 1)] = _page(
+            show_title, '<div class="list detail eplist">{}</div>'.format(ep_list)
+        )
+
+    return pages
+
+
+def build_wiki_pages(seasons, show_path=WIKI_SHOW_PATH, show_title=SHOW_TITLE, num_character_pages=20):
+    """Create the Wikipedia-like pages (main page, season pages, character list and pages) of a fixture show."""
+    pages = {}
+    season_paths = ['/wiki/{}_(season_{})'.format(show_path, i + 1) for i in range(len(seasons))]
+    character_paths = ['/wiki/{}_character_{}'.format(show_path, i) for i in range(num_character_pages)]
+    list_path = '/wiki/List_of_{}_characters'.format(show_path)
+
+    pages['/wiki/{}'.format(show_path)] = _page(
+        '{} - Wikipedia'.format(show_title),
+        ''.join('<a href="{}">link</a>'.format(path) for path in season_paths + [list_path])
+    )
+    pages[list_path] = _page(
+        'List of {} characters - Wikipedia'.format(show_title),
+        ''.join('<a href="{}">link</a>'.format(path) for path in character_paths)
+    )
+    for path in character_paths:
+        pages[path] = _page('Character - Wikipedia', '<a href="/wiki/{}">back</a>'.format(show_path))
+
+    for season_path, season in zip(season_paths, seasons):
+        # table cells with the usual markup of Wikipedia: links, comments and citations
+        rows = ''.join(
+            '<tr class="vevent"><td class="summary">"<a href="/wiki/Episode">{}</a>"<!-- title --></td></tr>'
+            '<tr class="expand-child"><td class="description">{}<sup class="reference">'
+            '<a href="#cite_note-1">[1]</a></sup></td></tr>'.format(ep_title, ep_sums[0])
+            for ep_title, ep_sums in season
+        )
+        pages[season_path] = _page(
+            '{} (season) - Wikipedia'.format(show_title),
+            '<table class="wikitable plainrowheaders wikiepisodetable"><tbody>{}</tbody></table>'.format(rows)
+        )
+
+    return pages
+
+
+class _FixtureRequestHandler(BaseHTTPRequestHandler):
+    """Serve the pages of the fixture site, count the incoming requests, and track the concurrent requests."""
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.request_counts[self.path] += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+
+        try:
+            # simulate network and server latency
+            time.sleep(self.server.delay)
+            self._respond()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _respond(self):
+        # simulate server errors: the first requests of the failing paths get a 503 response
+        with self.server.lock:
+            fail = self.server.failures[self.path] > 0
+            self.server.failures[self.path] -= fail
+        if fail:
+            self.send_error(503)
+            return
+
+        if self.path == '/robots.txt':
+            body = 'User-agent: *\nDisallow:\n'
+        elif self.path in self.server.pages:
+            body = self.server.pages[self.path]
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureSite:
+    """A local HTTP server, which stands in for IMDb and Wikipedia during crawl checks and benchmarks."""
+
+    def __init__(self, pages, delay=0.0, failures=None):
+        """Initialize the FixtureSite object.
+
+        :param pages: Dictionary of URL paths (including the query string) and HTML strings
+        :param delay: Response latency in seconds
+        :param failures: Dictionary of URL paths and the number of their first requests that get a 503 response
+        """
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _FixtureRequestHandler)
+        self._server.pages = pages
+        self._server.delay = delay
+        self._server.request_counts = Counter()
+        self._server.failures = Counter(failures or {})
+        self._server.lock = threading.Lock()
+        self._server.in_flight = 0
+        self._server.max_in_flight = 0
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    @property
+    def pages(self):
+        return self._server.pages
+
+    @property
+    def request_counts(self):
+        return self._server.request_counts
+
+    @property
+    def max_in_flight(self):
+        """The maximum number of concurrent requests served by the site."""
+        return self._server.max_in_flight
+
+    def reset_counters(self):
+        """Reset the request counts and the maximum number of concurrent requests."""
+        with self._server.lock:
+            self._server.request_counts.clear()
+            self._server.max_in_flight = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
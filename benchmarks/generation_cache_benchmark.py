@@ -0,0 +1,137 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import torch
+from pytorch_transformers import GPT2LMHeadModel
+from utils.gen_utils import set_random_seeds, generate_sequence
+from utils.generation_cache import GenerationCache, cached_generate_sequence, weights_fingerprint
+from benchmarks.pipeline_benchmark import create_tokenizer, create_tiny_model
+
+CONTEXTS = ['Captain Picard', 'Kirk and Spock are trapped on a planet', 'Worf must defend his honor when', 'Quark']
+
+
+def run_requests(tokenizer, contexts, args, cache=None, model_dir=None, model=None):
+    """
+    Generate the samples of a list of contexts after seeding once, like generate.py. With a cache, the model is loaded
+    from model_dir on the first miss only.
+
+    :return: Tuple of the list of the samples of every context, the run time, and True if the model was loaded
+    """
+    loaded = []
+
+    def load_model():
+        if not loaded:
+            loaded.append(GPT2LMHeadModel.from_pretrained(model_dir).eval())
+        return loaded[0]
+
+    start = time.perf_counter()
+    if cache is None:
+        model = model or load_model()
+    # seeded after the model loading, like generate.py
+    set_random_seeds(args.random_seed)
+    model_fingerprint = cache.files_fingerprint([model_dir]) if cache is not None and model is None else None
+    results = []
+    for context in contexts:
+        if cache is None:
+            results.append(generate_sequence(model, tokenizer, args.gen_len, context, args.num_samples, top_k=20))
+        else:
+            results.append(cached_generate_sequence(cache, model, tokenizer, args.gen_len, context, args.num_samples,
+                                                    seeded=True, model_fingerprint=model_fingerprint,
+                                                    load_model=load_model, top_k=20))
+
+    return results, time.perf_counter() - start, bool(loaded)
+
+
+def run_benchmark(args):
+    """Check the cached samples against the uncached ones, and measure the run time of cold and warm requests."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+    tokenizer = create_tokenizer(max_num_words=80, size_var_handling='ignore')
+    work_dir = tempfile.mkdtemp(prefix='generation_cache_')
+    model_dir, cache_dir = '{}/model'.format(work_dir), '{}/cache'.format(work_dir)
+    # a model directory with the config and the weights, like the students of distill.py
+    os.makedirs(model_dir)
+    create_tiny_model(len(tokenizer), args).save_pretrained(model_dir)
+
+    try:
+        reference, uncached_seconds, _ = run_requests(tokenizer, CONTEXTS, args, model_dir=model_dir)
+        # the requests after a miss continue with the same random numbers as without the cache
+        changed_contexts = CONTEXTS[:2] + ['The Enterprise'] + CONTEXTS[3:]
+        changed_reference, _, _ = run_requests(tokenizer, changed_contexts, args, model_dir=model_dir)
+
+        print('{:<34}{:>10}{:>14}{:>16}'.format('run', 'seconds', 'model loaded', 'same samples'))
+        print('{:<34}{:>10.3f}{:>14}{:>16}'.format('no cache', uncached_seconds, 'yes', '-'))
+        runs = [
+            ('cold cache', lambda: GenerationCache(disk_dir=cache_dir), CONTEXTS, reference),
+            ('warm cache (new process)', lambda: GenerationCache(disk_dir=cache_dir), CONTEXTS, reference),
+            ('one context changed', lambda: GenerationCache(disk_dir=cache_dir), changed_contexts, changed_reference)
+        ]
+        for name, create_cache, contexts, expected in runs:
+            cache = create_cache()
+            results, seconds, loaded = run_requests(tokenizer, contexts, args, cache=cache, model_dir=model_dir)
+            print('{:<34}{:>10.3f}{:>14}{:>16}   {}'.format(name, seconds, 'yes' if loaded else 'no',
+                                                            str(results == expected), cache.stats))
+
+        # in-memory tier, with a loaded model: the fingerprint of the weights is memoized on the model
+        model = GPT2LMHeadModel.from_pretrained(model_dir).eval()
+        cache = GenerationCache()
+        for name in ['memory cache, cold', 'memory cache, warm']:
+            results, seconds, _ = run_requests(tokenizer, CONTEXTS, args, cache=cache, model=model)
+            print('{:<34}{:>10.3f}{:>14}{:>16}   {}'.format(name, seconds, '-', str(results == reference),
+                                                            cache.stats))
+
+        # unseeded sampling is not cached, greedy requests are (with normalized sampling parameters)
+        cached_generate_sequence(cache, model, tokenizer, args.gen_len, CONTEXTS[0], 2, top_k=20)
+        for top_k in [0, 20]:
+            cached_generate_sequence(cache, model, tokenizer, args.gen_len, CONTEXTS[0], 2, temperature=0, top_k=top_k)
+        print('\nUnseeded sampling, then greedy with top_k 0 and 20: {}'.format(cache.stats))
+
+        # updated weights get a new fingerprint
+        fingerprint = weights_fingerprint(model)
+        model.load_state_dict({name: tensor + 1e-3 if name.endswith('ln_f.weight') else tensor
+                               for name, tensor in model.state_dict().items()})
+        print('Fingerprint changed after a weight update: {}'.format(weights_fingerprint(model) != fingerprint))
+
+        # size-based eviction of the disk tier
+        cache = GenerationCache(max_memory_entries=0, disk_dir='{}/small_cache'.format(work_dir),
+                                max_disk_bytes=args.eviction_check_kb * 2 ** 10)
+        set_random_seeds(args.random_seed)
+        for seed in range(20):
+            set_random_seeds(seed)
+            cached_generate_sequence(cache, model, tokenizer, 16, CONTEXTS[0], 1, seeded=True, top_k=20)
+        print('Disk tier of {} KB after 20 requests: {:.1f} KB, {} evictions'.format(
+            args.eviction_check_kb, cache.disk_bytes / 2 ** 10, cache.stats['disk_evictions']))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Check and benchmark the generation cache (utils.generation_cache), with a tiny, randomly '
+                    'initialized GPT-2 model saved to a temporary directory.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-ns', '--num_samples', type=int, required=False, default=4,
+                        help='Number of samples per context.')
+    parser.add_argument('-mg', '--gen_len', type=int, required=False, default=48,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-ek', '--eviction_check_kb', type=float, required=False, default=40,
+                        help='Disk budget (KB) of the eviction check.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=6, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=384, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=6, help='Number of attention heads.')
+    parser.add_argument('-np', '--n_positions', type=int, required=False, default=512,
+                        help='Maximum sequence length of the model.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
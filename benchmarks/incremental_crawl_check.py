@@ -0,0 +1,129 @@
+import os
+import argparse
+import tempfile
+import multiprocessing
+from scrapy.crawler import CrawlerProcess
+from spiders.imdb_episode_summary_spider import ImdbEpisodeSummarySpider
+from spiders.wiki_episode_table_spider import WikiEpisodeTableSpider
+from utils.data import load_episode_data
+from utils.crawl_state import DEFAULT_MAX_LEAF_AGE
+from benchmarks.fixture_site import (FixtureSite, load_seasons, build_imdb_pages, build_wiki_pages,
+                                     IMDB_SHOW_ID, WIKI_SHOW_PATH)
+
+
+def _crawl(spider_cls, spider_kwargs, settings, stats_queue):
+    """Run a single crawl (in a child process, since the Twisted reactor can not be restarted)."""
+    process = CrawlerProcess(settings=settings)
+    crawler = process.create_crawler(spider_cls)
+    process.crawl(crawler, **spider_kwargs)
+    process.start()
+    stats_queue.put(crawler.stats.get_stats())
+
+
+def run_incremental_crawls(site, work_dir, max_leaf_age=DEFAULT_MAX_LEAF_AGE):
+    """Run the incremental IMDb and Wikipedia crawls against the fixture site, and collect their stats."""
+    # the offsite filter matches the host, while the link extractor matches the host + port of the URLs
+    allowed_domains = ['127.0.0.1', site.base_url.split('//')[1]]
+    crawls = {
+        'imdb': (ImdbEpisodeSummarySpider, {
+            'start_urls': ['{}/title/{}/'.format(site.base_url, IMDB_SHOW_ID)]
+        }, {}),
+        'wiki': (WikiEpisodeTableSpider, {
+            'start_url': '{}/wiki/{}'.format(site.base_url, WIKI_SHOW_PATH),
+            'allow': WIKI_SHOW_PATH,
+            'title_keywords': ['fixture', 'show']
+        }, {'DEPTH_LIMIT': 2})
+    }
+
+    results = {}
+    for name, (spider_cls, spider_kwargs, spider_settings) in crawls.items():
+        site.reset_counters()
+        spider_kwargs = dict(spider_kwargs, allowed_domains=allowed_domains, max_leaf_age=max_leaf_age,
+                             state_path=os.path.join(work_dir, '{}_state.json'.format(name)))
+        settings = dict(spider_settings, **{
+            'FEED_FORMAT': 'jsonlines',
+            'FEED_URI': os.path.join(work_dir, '{}.jl'.format(name)),
+            'ROBOTSTXT_OBEY': True,
+            'LOG_LEVEL': 'WARNING'
+        })
+
+        stats_queue = multiprocessing.Queue()
+        crawl_process = multiprocessing.Process(target=_crawl, args=(spider_cls, spider_kwargs, settings, stats_queue))
+        crawl_process.start()
+        stats = stats_queue.get()
+        crawl_process.join()
+
+        with open(settings['FEED_URI'], 'r') as f:
+            num_output_lines = len(f.readlines())
+
+        results[name] = {
+            'requests_made': sum(site.request_counts.values()),
+            'requests_saved': stats.get('incremental/requests_saved', 0),
+            'items_new': stats.get('incremental/items_new', 0),
+            'items_changed': stats.get('incremental/items_changed', 0),
+            'items_unchanged': stats.get('incremental/items_unchanged', 0),
+            'output_lines': num_output_lines,
+            # the items of the changed episodes supersede the ones of the previous crawl
+            'records': len(load_episode_data(settings['FEED_URI']))
+        }
+
+    return results
+
+
+def run_check(args):
+    """Crawl the fixture site, air a new season + edit an episode, then re-crawl it incrementally."""
+    seasons = load_seasons(args.json_path, args.num_seasons, args.season_size)
+    work_dir = tempfile.mkdtemp(prefix='incremental_crawl_')
+
+    site = FixtureSite({}).start()
+    try:
+        print('First crawl: {} seasons.'.format(len(seasons) - 1))
+        site.pages.update(build_imdb_pages(seasons[:-1]))
+        site.pages.update(build_wiki_pages(seasons[:-1]))
+        first = run_incremental_crawls(site, work_dir)
+
+        print('Re-crawl: a new season aired and the summary of an old episode was edited.')
+        ep_title, ep_sums = seasons[0][0]
+        seasons[0][0] = (ep_title, [ep_sums[0] + ' This sentence was added in an edit.'] + ep_sums[1:])
+        site.pages.update(build_imdb_pages(seasons))
+        site.pages.update(build_wiki_pages(seasons))
+        second = run_incremental_crawls(site, work_dir)
+
+        # the IMDb spider skips the plot summary pages of the collected episodes until they are old enough to revisit
+        print('Re-crawl after the revisit window: the edit of the IMDb summary is detected.')
+        third = run_incremental_crawls(site, work_dir, max_leaf_age=0)
+    finally:
+        site.stop()
+
+    print('\n{:<7}{:<10}{:>15}{:>16}{:>11}{:>15}{:>17}{:>14}{:>9}'.format(
+        'spider', 'crawl', 'requests_made', 'requests_saved', 'items_new', 'items_changed', 'items_unchanged',
+        'output_lines', 'records'
+    ))
+    for name in first:
+        for crawl, results in (('first', first), ('re-crawl', second), ('revisit', third)):
+            print('{:<7}{:<10}{requests_made:>15}{requests_saved:>16}{items_new:>11}{items_changed:>15}'
+                  '{items_unchanged:>17}{output_lines:>14}{records:>9}'.format(name, crawl, **results[name]))
+    print('\nSummaries on the site: {} (IMDb), {} (Wikipedia)'.format(
+        sum(len(ep_sums) for season in seasons for _, ep_sums in season), sum(len(season) for season in seasons)))
+    print('\nOutputs and crawl states: {}'.format(work_dir))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Verify the incremental re-crawl mode of the spiders against a local stand-in site.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_path', type=str, required=False, default='scraped_data/star_trek_imdb.json',
+                        help='Pre-scraped episode data used for building the fixture site.')
+    parser.add_argument('-ns', '--num_seasons', type=int, required=False, default=4,
+                        help='Number of seasons of the fixture show. The last one airs before the re-crawl.')
+    parser.add_argument('-ss', '--season_size', type=int, required=False, default=12,
+                        help='Number of episodes per season.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_check(args)
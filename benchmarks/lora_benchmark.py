@@ -0,0 +1,115 @@
+import os
+import time
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+import torch
+from pytorch_transformers import GPT2Config, GPT2LMHeadModel
+from train import initialize_optimizer, train_step
+from utils.gen_utils import set_random_seeds
+from utils.lora import add_lora_adapters, save_lora_adapters, merge_lora_adapters
+from utils.train_metrics import peak_rss_mb
+
+
+def optimizer_state_mb(optimizer):
+    """Size of the optimizer state tensors in MB."""
+    return sum(tensor.numel() * tensor.element_size() for state in optimizer.state.values()
+               for tensor in state.values() if torch.is_tensor(tensor)) / 2 ** 20
+
+
+def run_mode(args, lora, results_queue):
+    """Train a randomly initialized GPT-2 model for a few steps (full fine-tuning or adapters), and report the costs."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+
+    config = GPT2Config(vocab_size_or_config_json_file=args.vocab_size, n_positions=args.seq_len, n_ctx=args.seq_len,
+                        n_embd=args.n_embd, n_layer=args.n_layer, n_head=args.n_head)
+    model = GPT2LMHeadModel(config)
+    if lora:
+        model = add_lora_adapters(model, args.lora_rank, args.lora_alpha)
+    model.train()
+
+    optimizer_args = argparse.Namespace(weight_decay=0.01, learning_rate=1e-3, adam_epsilon=1e-8,
+                                        max_steps=args.num_steps + 1)
+    optimizer, scheduler = initialize_optimizer(model, optimizer_args)
+    batch = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len))
+
+    step_times = []
+    for _ in range(args.num_steps + 1):
+        start = time.perf_counter()
+        train_step(model, batch, optimizer, scheduler, 'cpu')
+        step_times.append(time.perf_counter() - start)
+
+    checkpoint_path = os.path.join(tempfile.mkdtemp(prefix='lora_benchmark_'), 'model.pth')
+    if lora:
+        save_lora_adapters(model, checkpoint_path)
+    else:
+        torch.save(model.state_dict(), checkpoint_path)
+
+    results = {
+        'mode': 'lora (rank {})'.format(args.lora_rank) if lora else 'full',
+        'trainable_params': sum(param.numel() for param in model.parameters() if param.requires_grad),
+        'optimizer_state_mb': optimizer_state_mb(optimizer),
+        'step_seconds': statistics.median(step_times[1:]),  # the first step is a warm-up
+        'peak_rss_mb': peak_rss_mb(),
+        'checkpoint_mb': os.path.getsize(checkpoint_path) / 2 ** 20
+    }
+
+    # the merged model has to give the same outputs as the model with adapters
+    if lora:
+        model.eval()
+        with torch.no_grad():
+            adapter_logits = model(batch)[0]
+            merged_logits = merge_lora_adapters(model)(batch)[0]
+        results['merge_max_abs_diff'] = (adapter_logits - merged_logits).abs().max().item()
+
+    os.remove(checkpoint_path)
+    results_queue.put(results)
+
+
+def run_benchmark(args):
+    """Compare full fine-tuning to the low-rank adapter mode, every mode in a fresh process for the peak memory."""
+    results_queue = multiprocessing.Queue()
+
+    all_results = []
+    for lora in [False, True]:
+        mode_process = multiprocessing.Process(target=run_mode, args=(args, lora, results_queue))
+        mode_process.start()
+        all_results.append(results_queue.get())
+        mode_process.join()
+
+    print('{:<16}{:>18}{:>18}{:>14}{:>14}{:>16}'.format('mode', 'trainable params', 'optimizer MB', 'step sec',
+                                                         'peak RSS MB', 'checkpoint MB'))
+    for results in all_results:
+        print('{mode:<16}{trainable_params:>18}{optimizer_state_mb:>18.1f}{step_seconds:>14.3f}'
+              '{peak_rss_mb:>14.1f}{checkpoint_mb:>16.2f}'.format(**results))
+    print('\nMax abs logit difference of the merged adapters: {:.2e}'.format(all_results[1]['merge_max_abs_diff']))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Compare the memory, step time and checkpoint size of full fine-tuning and low-rank adapters, '
+                    'with a randomly initialized GPT-2 model (pass -nl 12 -ne 768 -nh 12 for the size of "gpt2").',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-n', '--num_steps', type=int, required=False, default=3, help='Number of measured steps.')
+    parser.add_argument('-b', '--batch_size', type=int, required=False, default=4, help='Batch size.')
+    parser.add_argument('-sl', '--seq_len', type=int, required=False, default=64, help='Sequence length.')
+    parser.add_argument('-lk', '--lora_rank', type=int, required=False, default=8, help='Rank of the adapters.')
+    parser.add_argument('-la', '--lora_alpha', type=float, required=False, default=16., help='Scaling of the adapters.')
+    parser.add_argument('-v', '--vocab_size', type=int, required=False, default=50257, help='Vocabulary size.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=4, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=512, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=8, help='Number of attention heads.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
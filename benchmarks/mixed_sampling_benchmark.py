@@ -0,0 +1,192 @@
+import time
+import random
+import argparse
+import torch
+from torch.nn import functional as F
+from utils.gen_utils import (set_random_seeds, top_k_top_p_filtering, batch_top_k_top_p_filtering, compute_prefix_state,
+                             generate_sequence)
+from benchmarks.pipeline_benchmark import create_tokenizer, create_tiny_model
+
+# sampling settings of the requests: (temperature, top_k, top_p, repetition_penalty)
+SETTINGS = [(0, 0, 0, 1.0), (0, 0, 0, 1.3), (1.0, 0, 0, 1.0), (1.0, 20, 0, 1.0), (0.7, 40, 0, 1.0),
+            (0.9, 0, 0.9, 1.0), (0.8, 40, 0.95, 1.0), (1.0, 20, 0, 1.2), (0.7, 0, 0.9, 1.3)]
+
+
+def generate_sequence_single_setting(model, tokenizer, max_length, context='', num_samples=1, temperature=1,
+                                     top_k=0, top_p=0, repetition_penalty=1.0, device='cpu'):
+    """The previous generate_sequence: one temperature, top_k, top_p and repetition_penalty for the whole batch, and
+    the repetition penalty applied token by token."""
+    context = tokenizer.convert_tokens_to_ids(
+        tokenizer.tokenize('<|endoftext|> {}'.format(context))
+    )
+    context_len = len(context)
+
+    with torch.no_grad():
+        next_token_logits, past = compute_prefix_state(model, context, device)
+        next_token_logits = next_token_logits.repeat(num_samples, 1)
+        past = [layer_past.expand(-1, num_samples, -1, -1, -1) for layer_past in past]
+
+        generated = torch.tensor(context, dtype=torch.long, device=device)
+        generated = generated.unsqueeze(0).repeat(num_samples, 1)
+
+        for current_len in range(context_len, max_length):
+            if current_len > context_len:
+                outputs = model(next_token, past=past)
+                next_token_logits, past = outputs[0][:, -1, :], outputs[1]
+
+            next_token_logits = next_token_logits / (temperature if temperature > 0 else 1.)
+
+            for i in range(num_samples):
+                for _ in set(generated[i].tolist()):
+                    next_token_logits[i, _] /= repetition_penalty
+
+            filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)
+
+            if temperature == 0:
+                next_token = torch.argmax(filtered_logits, dim=-1).unsqueeze(-1)
+            else:
+                next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
+            generated = torch.cat((generated, next_token), dim=1)
+
+            if all(generated[:, generated.size()[1] - 1] == generated[:, generated.size()[1] - 2]):
+                break
+
+    generated = [tokenizer.decode(gen_ids.cpu().numpy()).replace('<|endoftext|>', '').strip() for gen_ids in generated]
+
+    return generated
+
+
+def check_filtering_parity(args):
+    """Compare the batch filtering with per-row parameters to top_k_top_p_filtering applied row by row."""
+    rng = random.Random(args.random_seed)
+    logits = torch.randn(64, args.filter_vocab_size) * 3
+    top_k = torch.tensor([rng.choice([0, 1, 5, 20, 100]) for _ in range(len(logits))])
+    top_p = torch.tensor([rng.choice([0, 0.5, 0.9, 0.95]) for _ in range(len(logits))])
+
+    filtered = batch_top_k_top_p_filtering(logits.clone(), top_k, top_p)
+    reference = torch.cat([top_k_top_p_filtering(row.clone().unsqueeze(0), top_k=int(k), top_p=float(p))
+                           for row, k, p in zip(logits, top_k, top_p)])
+    # the same values for every setting alone (the top-k only path) and for the mixed ones
+    same_settings = all(torch.equal(batch_top_k_top_p_filtering(logits.clone(), torch.full_like(top_k, k),
+                                                                torch.full_like(top_p, p)),
+                                    top_k_top_p_filtering(logits.clone(), top_k=k, top_p=p))
+                        for k, p in [(0, 0), (20, 0), (0, 0.9), (20, 0.9)])
+    return torch.equal(filtered, reference) and same_settings
+
+
+def check_generation_parity(model, tokenizer, args):
+    """Compare the generation with the previous implementation: every setting for the whole batch (the same random
+    numbers are drawn), and a batch of greedy samples with different repetition penalties and top-k."""
+    mismatches = []
+    for temperature, top_k, top_p, repetition_penalty in SETTINGS:
+        samples = []
+        for generate_fnc in [generate_sequence_single_setting, generate_sequence]:
+            set_random_seeds(args.random_seed)
+            samples.append(generate_fnc(model, tokenizer, args.gen_len, args.context, 4, temperature=temperature,
+                                        top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty))
+        if samples[0] != samples[1]:
+            mismatches.append((temperature, top_k, top_p, repetition_penalty))
+
+    penalties, top_ks = [1.0, 1.2, 1.5, 2.0], [0, 5, 0, 20]
+    mixed = generate_sequence(model, tokenizer, args.gen_len, args.context, len(penalties), temperature=0,
+                              top_k=top_ks, repetition_penalty=penalties)
+    for sample, penalty, top_k in zip(mixed, penalties, top_ks):
+        # a batch stops when all its samples end, so the samples of the mixed batch can be longer
+        if not sample.startswith(generate_sequence_single_setting(
+                model, tokenizer, args.gen_len, args.context, 1, temperature=0, top_k=top_k,
+                repetition_penalty=penalty)[0]):
+            mismatches.append((0, top_k, 0, penalty))
+
+    return mismatches
+
+
+def make_requests(args):
+    """Create the mixed traffic: requests with random settings and numbers of samples."""
+    rng = random.Random(args.random_seed)
+    return [(rng.choice(SETTINGS), rng.choice(args.num_samples)) for _ in range(args.num_requests)]
+
+
+def run_per_request(model, tokenizer, requests, generate_fnc, args):
+    """Generate the requests one by one, every request with its own setting."""
+    for (temperature, top_k, top_p, repetition_penalty), num_samples in requests:
+        generate_fnc(model, tokenizer, args.gen_len, args.context, num_samples, temperature=temperature, top_k=top_k,
+                     top_p=top_p, repetition_penalty=repetition_penalty)
+
+
+def run_mixed_batches(model, tokenizer, requests, args):
+    """Generate the samples of all the requests in batches of at most max_batch_size samples, with per-row settings."""
+    rows = [setting for setting, num_samples in requests for _ in range(num_samples)]
+    for start in range(0, len(rows), args.max_batch_size):
+        temperature, top_k, top_p, repetition_penalty = zip(*rows[start:start + args.max_batch_size])
+        generate_sequence(model, tokenizer, args.gen_len, args.context, len(temperature), temperature=temperature,
+                          top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty)
+
+
+def run_benchmark(args):
+    """Check the per-row sampling against the previous implementation, and measure the throughput of mixed traffic."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+
+    tokenizer = create_tokenizer(max_num_words=80, size_var_handling='ignore')
+    model = create_tiny_model(len(tokenizer), args)
+    model.eval()
+
+    print('Batch filtering matches top_k_top_p_filtering row by row: {}'.format(check_filtering_parity(args)))
+    mismatches = check_generation_parity(model, tokenizer, args)
+    print('Samples match the previous implementation for all {} settings and the mixed greedy batch: {}{}\n'.format(
+        len(SETTINGS), not mismatches, '' if not mismatches else ' (mismatches: {})'.format(mismatches)))
+
+    requests = make_requests(args)
+    num_samples = sum(num_samples for _, num_samples in requests)
+    modes = [
+        ('per request (previous)', lambda: run_per_request(model, tokenizer, requests,
+                                                           generate_sequence_single_setting, args)),
+        ('per request', lambda: run_per_request(model, tokenizer, requests, generate_sequence, args)),
+        ('mixed batches', lambda: run_mixed_batches(model, tokenizer, requests, args))
+    ]
+
+    print('{} requests, {} samples, batches of up to {} samples:'.format(len(requests), num_samples,
+                                                                         args.max_batch_size))
+    print('{:<26}{:>10}{:>16}'.format('mode', 'seconds', 'samples/sec'))
+    for name, run_fnc in modes:
+        set_random_seeds(args.random_seed)
+        start = time.perf_counter()
+        run_fnc()
+        seconds = time.perf_counter() - start
+        print('{:<26}{:>10.2f}{:>16.2f}'.format(name, seconds, num_samples / seconds))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Check and benchmark the generation with per-sample sampling parameters (mixed traffic in one '
+                    'batch), with a tiny, randomly initialized GPT-2 model.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-c', '--context', type=str, required=False, default='',
+                        help='Context of the requests.')
+    parser.add_argument('-n', '--num_requests', type=int, required=False, default=40,
+                        help='Number of generation requests.')
+    parser.add_argument('-ns', '--num_samples', nargs='+', type=int, required=False, default=[1, 2, 4],
+                        help='Number of samples per request, chosen randomly for every request.')
+    parser.add_argument('-mb', '--max_batch_size', type=int, required=False, default=16,
+                        help='Maximum number of samples of a mixed batch.')
+    parser.add_argument('-mg', '--gen_len', type=int, required=False, default=48,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-fv', '--filter_vocab_size', type=int, required=False, default=50257,
+                        help='Vocabulary size of the logits of the filtering check.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=4, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=256, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    parser.add_argument('-np', '--n_positions', type=int, required=False, default=512,
+                        help='Maximum sequence length of the model.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,179 @@
+import time
+import argparse
+from bs4 import BeautifulSoup
+from scrapy.http import HtmlResponse
+from spiders.imdb_episode_summary_spider import ImdbEpisodeSummarySpider
+from spiders.wiki_episode_table_spider import WikiEpisodeTableSpider
+from utils.text_cleansing import clean_ep_data
+from benchmarks.fixture_site import load_seasons, build_imdb_pages, build_wiki_pages
+
+
+class LegacyImdbEpisodeSummarySpider(ImdbEpisodeSummarySpider):
+    """The IMDb spider with the previous text extraction: every fragment is serialized and parsed again."""
+
+    def parse_plot_summary_page(self, response):
+        show_title = response.xpath('//*[@class="subpage_title_block"]//h4/a/text()').extract_first().strip()
+        ep_title = response.xpath('//*[@class="subpage_title_block"]//h3/a/text()').extract_first().strip()
+        summaries = response.xpath('//*[@class="ipl-zebra-list__item" and contains(@id, "summary")]/p').extract()
+
+        for ep_sum in summaries:
+            ep_sum = BeautifulSoup(ep_sum, 'lxml').get_text().strip()
+
+            if 'be the first to contribute' not in ep_sum.lower():
+                yield clean_ep_data({
+                    'source_url': response.url,
+                    'episode_title': ep_title,
+                    'episode_summary': ep_sum,
+                    'tv_show_title': show_title,
+                })
+
+
+class LegacyWikiEpisodeTableSpider(WikiEpisodeTableSpider):
+    """The Wiki spider with the previous text extraction: every fragment is serialized and parsed again."""
+
+    def parse_wiki_page(self, response):
+        page_header = response.xpath('//title').extract_first()
+
+        if page_header and all([keyword in page_header.lower() for keyword in self.title_keywords]):
+            ep_tables = response.xpath('//table[@class="wikitable plainrowheaders wikiepisodetable"]')
+            ep_titles, ep_sums = self.parse_episode_tables(ep_tables)
+
+            ep_sums = [BeautifulSoup(ep_sum.extract(), 'lxml').get_text().strip() for ep_sum in ep_sums]
+            ep_titles = [BeautifulSoup(ep_title.extract(), 'lxml').get_text().strip() for ep_title in ep_titles]
+
+            for ep_title, ep_sum in zip(ep_titles, ep_sums):
+                if ep_sum not in self.unique_episode_summaries:
+                    self.unique_episode_summaries.add(ep_sum)
+
+                    yield clean_ep_data({
+                        'source_url': response.url,
+                        'episode_title': ep_title,
+                        'episode_summary': ep_sum,
+                        'tv_show_title': '',
+                    })
+
+
+def load_responses(html_paths, url):
+    """Load saved HTML pages as Scrapy responses."""
+    responses = []
+    for html_path in html_paths:
+        with open(html_path, 'rb') as f:
+            responses.append(HtmlResponse(url=url, body=f.read(), encoding='utf-8'))
+
+    return responses
+
+
+def build_fixture_responses(json_path, num_seasons, season_size):
+    """Create Scrapy responses from the plot summary and season pages of the fixture site."""
+    seasons = load_seasons(json_path, num_seasons, season_size)
+    imdb_pages = build_imdb_pages(seasons)
+    wiki_pages = build_wiki_pages(seasons)
+
+    imdb_pages = {path: html for path, html in imdb_pages.items() if path.endswith('/plotsummary')}
+    wiki_pages = {path: html for path, html in wiki_pages.items() if '_(season_' in path}
+
+    # inline styles and scripts inside the extracted elements, like the TemplateStyles of the Wikipedia tables
+    path = next(iter(imdb_pages))
+    imdb_pages[path] = imdb_pages[path].replace('<p>', '<p><style>.summary{color:red}</style>', 1)
+    path = next(iter(wiki_pages))
+    wiki_pages[path] = wiki_pages[path].replace(
+        '<td class="description">', '<td class="description"><style>.mw-parser-output .plainlist{margin:0}</style>'
+                                    '<script>var rlconf = {};</script>', 1)
+
+    imdb_responses = [HtmlResponse(url='https://www.imdb.com' + path, body=html, encoding='utf-8')
+                      for path, html in imdb_pages.items()]
+    wiki_responses = [HtmlResponse(url='https://en.wikipedia.org' + path, body=html, encoding='utf-8')
+                      for path, html in wiki_pages.items()]
+
+    return imdb_responses, wiki_responses
+
+
+def run_callback(spider, callback_name, responses):
+    """Run a spider callback on every response, and collect the yielded items."""
+    items = []
+    for response in responses:
+        # the Wiki spider drops the already seen summaries, reset it to parse every page in every round
+        spider.unique_episode_summaries = set()
+        items.extend(getattr(spider, callback_name)(response))
+
+    return items
+
+
+def benchmark_callback(spider, callback_name, responses, num_rounds):
+    """Measure the throughput of a spider callback in pages/sec."""
+    run_callback(spider, callback_name, responses)  # warm-up
+
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        run_callback(spider, callback_name, responses)
+    elapsed = time.perf_counter() - start
+
+    return len(responses) * num_rounds / elapsed
+
+
+def run_benchmark(args):
+    """Compare the single-pass and the legacy text extraction of the spider callbacks."""
+    if args.imdb_html or args.wiki_html:
+        imdb_responses = load_responses(args.imdb_html, 'https://www.imdb.com/title/tt0000000/plotsummary')
+        wiki_responses = load_responses(args.wiki_html, 'https://en.wikipedia.org/wiki/Saved_page')
+    else:
+        imdb_responses, wiki_responses = build_fixture_responses(args.json_path, args.num_seasons, args.season_size)
+
+    spiders = {
+        'parse_plot_summary_page': (
+            ImdbEpisodeSummarySpider(start_urls=[]), LegacyImdbEpisodeSummarySpider(start_urls=[]), imdb_responses
+        ),
+        'parse_wiki_page': (
+            WikiEpisodeTableSpider(start_url='', allow='', title_keywords=args.title_keywords),
+            LegacyWikiEpisodeTableSpider(start_url='', allow='', title_keywords=args.title_keywords),
+            wiki_responses
+        )
+    }
+
+    print('{:<26}{:>8}{:>8}{:>12}{:>18}{:>10}{:>8}'.format(
+        'callback', 'pages', 'items', 'pages/sec', 'legacy pages/sec', 'speedup', 'parity'
+    ))
+    for callback_name, (spider, legacy_spider, responses) in spiders.items():
+        if not responses:
+            continue
+
+        # the cleaned items should be identical to the output of the legacy extraction
+        items = run_callback(spider, callback_name, responses)
+        parity = items == run_callback(legacy_spider, callback_name, responses)
+
+        pages_per_sec = benchmark_callback(spider, callback_name, responses, args.num_rounds)
+        legacy_pages_per_sec = benchmark_callback(legacy_spider, callback_name, responses, args.num_rounds)
+
+        print('{:<26}{:>8}{:>8}{:>12.1f}{:>18.1f}{:>9.2f}x{:>8}'.format(
+            callback_name, len(responses), len(items), pages_per_sec, legacy_pages_per_sec,
+            pages_per_sec / legacy_pages_per_sec, 'OK' if parity else 'FAILED'
+        ))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the HTML extraction of the spider callbacks on saved or fixture pages.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-i', '--imdb_html', nargs='*', required=False, default=[],
+                        help='Saved IMDb plot summary pages. If no saved pages are given, fixture pages are used.')
+    parser.add_argument('-w', '--wiki_html', nargs='*', required=False, default=[],
+                        help='Saved Wikipedia season/episode list pages.')
+    parser.add_argument('-t', '--title_keywords', nargs='*', required=False, default=['fixture', 'show'],
+                        help='Title keywords of the Wiki spider. Should match the titles of the saved Wikipedia pages.')
+    parser.add_argument('-j', '--json_path', type=str, required=False, default='scraped_data/star_trek_imdb.json',
+                        help='Pre-scraped episode data used for building the fixture pages.')
+    parser.add_argument('-ns', '--num_seasons', type=int, required=False, default=8,
+                        help='Number of seasons of the fixture show.')
+    parser.add_argument('-ss', '--season_size', type=int, required=False, default=20,
+                        help='Number of episodes per season.')
+    parser.add_argument('-r', '--num_rounds', type=int, required=False, default=5,
+                        help='Number of measured passes over the pages.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
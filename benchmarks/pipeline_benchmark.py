@@ -0,0 +1,265 @@
+import io
+import os
+import glob
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+import torch
+from torch.utils.data import DataLoader
+from pytorch_transformers import GPT2Config, GPT2LMHeadModel
+from train import initialize_optimizer, train_step
+from utils.data import EpisodeSummaryTokenizer, create_datasets_from_jsons
+from utils.gen_utils import set_random_seeds, generate_sequence, top_k_top_p_filtering
+
+# small BPE vocabulary learned from ./scraped_data/ with benchmarks/train_bpe_vocab.py, so nothing is downloaded
+BPE_VOCAB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bpe_vocab')
+
+
+def create_tokenizer(max_num_words, size_var_handling):
+    """Create an episode summary tokenizer with the bundled BPE vocabulary."""
+    return EpisodeSummaryTokenizer(
+        os.path.join(BPE_VOCAB_DIR, 'vocab.json'), os.path.join(BPE_VOCAB_DIR, 'merges.txt'),
+        max_num_words=max_num_words, size_variance_handling=size_var_handling
+    )
+
+
+def create_tiny_model(vocab_size, args):
+    """Create a small, randomly initialized GPT-2 model."""
+    config = GPT2Config(vocab_size_or_config_json_file=vocab_size, n_positions=args.n_positions, n_ctx=args.n_positions,
+                        n_embd=args.n_embd, n_layer=args.n_layer, n_head=args.n_head)
+    return GPT2LMHeadModel(config)
+
+
+def measure(fnc, num_rounds):
+    """Run a function num_rounds times (after a warm-up run), and return the median run time in seconds."""
+    fnc()
+    run_times = []
+    for _ in range(num_rounds):
+        start = time.perf_counter()
+        fnc()
+        run_times.append(time.perf_counter() - start)
+
+    return statistics.median(run_times)
+
+
+def benchmark_corpus_build(json_paths, tokenizer, args):
+    """Measure the run time of create_datasets_from_jsons."""
+    def build():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return create_datasets_from_jsons(json_paths, tokenizer, args.val_split,
+                                              dedup_threshold=args.dedup_threshold)
+
+    train_dataset, val_dataset = build()
+    return {
+        'seconds': measure(build, args.num_rounds),
+        'num_summaries': len(train_dataset) + len(val_dataset)
+    }, train_dataset
+
+
+def benchmark_padding(dataset, tokenizer, args):
+    """Measure the throughput of pad_batch_to_same_size on the batches of the training set."""
+    batches = [dataset.episode_summaries[i:i + args.batch_size]
+               for i in range(0, len(dataset), args.batch_size)]
+
+    seconds = measure(lambda: [tokenizer.pad_batch_to_same_size(batch) for batch in batches], args.num_rounds)
+    return {'batches_per_sec': len(batches) / seconds}
+
+
+def benchmark_training(model, dataset, tokenizer, device, args):
+    """Measure the training throughput (data loading + collate + optimization steps) in tokens/sec."""
+    optimizer_args = argparse.Namespace(weight_decay=0.01, learning_rate=5e-5, adam_epsilon=1e-8,
+                                        max_steps=args.train_steps + 1)
+    optimizer, scheduler = initialize_optimizer(model, optimizer_args)
+    dataloader = DataLoader(dataset, shuffle=True, batch_size=args.batch_size,
+                            collate_fn=tokenizer.pad_batch_to_same_size)
+    model.train()
+
+    # warm-up step
+    train_step(model, next(iter(dataloader)), optimizer, scheduler, device)
+
+    num_tokens = 0
+    num_steps = 0
+    start = time.perf_counter()
+    while num_steps < args.train_steps:
+        for batch in dataloader:
+            train_step(model, batch, optimizer, scheduler, device)
+            num_tokens += batch.numel()
+            num_steps += 1
+
+            if num_steps >= args.train_steps:
+                break
+    seconds = time.perf_counter() - start
+
+    return {'tokens_per_sec': num_tokens / seconds, 'steps_per_sec': num_steps / seconds}
+
+
+def benchmark_filtering(args):
+    """Measure the run time of top_k_top_p_filtering on random GPT-2 sized logits."""
+    results = {}
+    for batch_size in args.gen_batch_sizes:
+        logits = torch.randn(batch_size, args.filter_vocab_size)
+        seconds = measure(lambda: top_k_top_p_filtering(logits.clone(), top_k=20, top_p=0.9), args.num_rounds * 10)
+        results['batch_size_{}'.format(batch_size)] = {'ms_per_call': seconds * 1000}
+
+    return results
+
+
+def benchmark_generation(model, tokenizer, device, args):
+    """Measure the per-token latency of generate_sequence at several batch sizes."""
+    model.eval()
+
+    # count the forward passes, since the generation can stop before max_length
+    num_forward_calls = [0]
+
+    def count_forward_calls(module, inputs, outputs):
+        num_forward_calls[0] += 1
+    hook = model.register_forward_hook(count_forward_calls)
+
+    results = {}
+    for batch_size in args.gen_batch_sizes:
+        generate = lambda: generate_sequence(model, tokenizer, max_length=args.gen_len, num_samples=batch_size,
+                                             top_k=20, device=device)
+        generate()  # warm-up
+
+        num_forward_calls[0] = 0
+        start = time.perf_counter()
+        for _ in range(args.num_rounds):
+            generate()
+        seconds = time.perf_counter() - start
+
+        results['batch_size_{}'.format(batch_size)] = {
+            'ms_per_token': seconds / num_forward_calls[0] * 1000,
+            'tokens_per_sec': num_forward_calls[0] * batch_size / seconds
+        }
+
+    hook.remove()
+    return results
+
+
+def get_metadata(args):
+    """Collect information about the environment of the benchmark run."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'num_threads': torch.get_num_threads(),
+        'args': vars(args)
+    }
+
+
+def compare_results(results, baseline, path=''):
+    """Print the ratio of every numeric result to the same result of a baseline run."""
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+
+        if isinstance(value, dict):
+            compare_results(value, baseline[key], '{}{}/'.format(path, key))
+        elif isinstance(value, (int, float)) and baseline[key]:
+            print('  {:<60}{:>14.4f}{:>14.4f}{:>9.2f}x'.format(path + key, baseline[key], value, value / baseline[key]))
+
+
+def run_benchmark(args):
+    """Run the offline benchmarks of the data pipeline, the training and the generation."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+    device = torch.device('cpu')
+    json_paths = args.json_paths or sorted(glob.glob('scraped_data/*.json'))
+
+    tokenizer = create_tokenizer(args.max_num_words, args.size_var_handling)
+    model = create_tiny_model(len(tokenizer), args).to(device)
+
+    results = {}
+    print('Benchmarking the corpus build...')
+    results['corpus_build'], train_dataset = benchmark_corpus_build(json_paths, tokenizer, args)
+    print('Benchmarking the padding...')
+    results['pad_batch_to_same_size'] = benchmark_padding(train_dataset, tokenizer, args)
+    print('Benchmarking the training...')
+    results['training'] = benchmark_training(model, train_dataset, tokenizer, device, args)
+    print('Benchmarking the filtering...')
+    results['top_k_top_p_filtering'] = benchmark_filtering(args)
+    print('Benchmarking the generation...')
+    random.seed(args.random_seed)
+    results['generate_sequence'] = benchmark_generation(model, tokenizer, device, args)
+
+    report = {'metadata': get_metadata(args), 'results': results}
+    with open(args.output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print('Saved results to {}.'.format(args.output_path))
+
+    if args.baseline_path:
+        with open(args.baseline_path, 'r') as f:
+            baseline = json.load(f)
+
+        print('\nComparison to {}:'.format(args.baseline_path))
+        print('  {:<60}{:>14}{:>14}{:>10}'.format('metric', 'baseline', 'current', 'ratio'))
+        compare_results(results, baseline['results'])
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks for the training, generation and data pipeline hot paths, with a tiny, '
+                    'randomly initialized GPT-2 model and the bundled BPE vocabulary.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-o', '--output_path', type=str, required=False, default='benchmark_results.json',
+                        help='Path to the output JSON file.')
+    parser.add_argument('-bp', '--baseline_path', type=str, required=False, default=None,
+                        help='Path to the output JSON of a previous run. If set, the results are compared to it.')
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-r', '--num_rounds', type=int, required=False, default=3,
+                        help='Number of measured rounds per benchmark.')
+
+    # data args
+    parser.add_argument('-j', '--json_paths', nargs='*', required=False, default=[],
+                        help='Episode data for the corpus build. Default: ./scraped_data/*.json')
+    parser.add_argument('-v', '--val_split', type=float, required=False, default=0.1,
+                        help='Ratio of the validation subset size compared to all available data.')
+    parser.add_argument('-m', '--max_num_words', type=int, required=False, default=80,
+                        help='Maximum number of words per summary in the training set.')
+    parser.add_argument('-sv', '--size_var_handling', type=str, required=False, default='chop_at_sentence_end',
+                        choices=['chop_at_sentence_end', 'chop', 'ignore'],
+                        help='Handling of training sequences with different lengths, see train.py.')
+    parser.add_argument('-dt', '--dedup_threshold', type=float, required=False, default=0,
+                        help='Similarity threshold of the near-duplicate removal. 0: no removal.')
+
+    # model, training and generation args
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=2, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=128, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    parser.add_argument('-np', '--n_positions', type=int, required=False, default=512,
+                        help='Maximum sequence length of the model.')
+    parser.add_argument('-b', '--batch_size', type=int, required=False, default=8, help='Training batch size.')
+    parser.add_argument('-ts', '--train_steps', type=int, required=False, default=20,
+                        help='Number of measured training steps.')
+    parser.add_argument('-gb', '--gen_batch_sizes', nargs='+', type=int, required=False, default=[1, 4, 16],
+                        help='Batch sizes (number of samples) for the generation and filtering benchmarks.')
+    parser.add_argument('-mg', '--gen_len', type=int, required=False, default=64,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-fv', '--filter_vocab_size', type=int, required=False, default=50257,
+                        help='Vocabulary size of the logits in the filtering benchmark (GPT-2: 50257).')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,130 @@
+import time
+import random
+import argparse
+import torch
+from torch.nn import functional as F
+from utils.gen_utils import set_random_seeds, top_k_top_p_filtering, generate_sequence
+from utils.prefix_cache import PrefixCache
+from benchmarks.pipeline_benchmark import create_tokenizer, create_tiny_model
+
+PROMPTS = ['Captain Picard', 'Captain Picard and Data', 'Captain Picard and Data must stop the Borg', 'Kirk and Spock',
+           'Kirk and Spock are trapped on a planet', 'Worf', 'Worf must defend his honor when', 'Quark',
+           'Quark and Rom open a new bar on the station', 'The Enterprise']
+
+
+def generate_sequence_without_past(model, tokenizer, max_length, context='', num_samples=1, temperature=1,
+                                   top_k=0, top_p=0, repetition_penalty=1.0, device='cpu'):
+    """The previous generate_sequence: the context is repeated for every sample, and every step recomputes all the
+    tokens."""
+    context = tokenizer.convert_tokens_to_ids(
+        tokenizer.tokenize('<|endoftext|> {}'.format(context))
+    )
+    context_len = len(context)
+    context = torch.tensor(context, dtype=torch.long, device=device)
+    context = context.unsqueeze(0).repeat(num_samples, 1)
+
+    generated = context
+    with torch.no_grad():
+        for current_len in range(context_len, max_length):
+            inputs = {'input_ids': generated}
+
+            outputs = model(**inputs)
+            next_token_logits = outputs[0][:, -1, :] / (temperature if temperature > 0 else 1.)
+
+            for i in range(num_samples):
+                for _ in set(generated[i].tolist()):
+                    next_token_logits[i, _] /= repetition_penalty
+
+            filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)
+
+            if temperature == 0:
+                next_token = torch.argmax(filtered_logits, dim=-1).unsqueeze(-1)
+            else:
+                next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
+            generated = torch.cat((generated, next_token), dim=1)
+
+            if all(generated[:, generated.size()[1] - 1] == generated[:, generated.size()[1] - 2]):
+                break
+
+    generated = [tokenizer.decode(gen_ids.cpu().numpy()).replace('<|endoftext|>', '').strip() for gen_ids in generated]
+
+    return generated
+
+
+def time_requests(generate_fnc, requests):
+    """Run a list of (context, num_samples) requests, and return the run time."""
+    start = time.perf_counter()
+    for context, num_samples in requests:
+        generate_fnc(context, num_samples)
+    return time.perf_counter() - start
+
+
+def run_benchmark(args):
+    """Compare the generation with and without the shared prefix state and the prefix cache."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+
+    tokenizer = create_tokenizer(max_num_words=80, size_var_handling='ignore')
+    model = create_tiny_model(len(tokenizer), args)
+    model.eval()
+
+    # greedy generation has to give the same samples
+    context = PROMPTS[2]
+    reference = generate_sequence_without_past(model, tokenizer, args.gen_len, context, temperature=0)
+    generated = generate_sequence(model, tokenizer, args.gen_len, context, temperature=0)
+    print('Greedy samples match the previous implementation: {}\n'.format(reference == generated))
+
+    # the prompts follow a skewed popularity distribution, like the requests of users
+    rng = random.Random(args.random_seed)
+    requests = [(rng.choices(PROMPTS, weights=[1 / (rank + 1) for rank in range(len(PROMPTS))])[0],
+                 rng.choice(args.num_samples)) for _ in range(args.num_requests)]
+    prefix_cache = PrefixCache(args.cache_mb * 2 ** 20)
+
+    modes = [
+        ('recompute', lambda context, num_samples: generate_sequence_without_past(
+            model, tokenizer, args.gen_len, context, num_samples, top_k=20)),
+        ('shared prefix', lambda context, num_samples: generate_sequence(
+            model, tokenizer, args.gen_len, context, num_samples, top_k=20)),
+        ('+ prefix cache', lambda context, num_samples: generate_sequence(
+            model, tokenizer, args.gen_len, context, num_samples, top_k=20, prefix_cache=prefix_cache))
+    ]
+
+    print('{:<20}{:>12}{:>16}'.format('mode', 'seconds', 'requests/sec'))
+    for name, generate_fnc in modes:
+        set_random_seeds(args.random_seed)
+        seconds = time_requests(generate_fnc, requests)
+        print('{:<20}{:>12.2f}{:>16.2f}'.format(name, seconds, len(requests) / seconds))
+
+    print('\nPrefix cache: {} entries, {:.2f} MB, stats: {}'.format(len(prefix_cache), prefix_cache.num_bytes / 2 ** 20,
+                                                                     prefix_cache.stats))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the shared context state and the prefix cache of the generation, with a tiny, '
+                    'randomly initialized GPT-2 model.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-n', '--num_requests', type=int, required=False, default=40,
+                        help='Number of generation requests.')
+    parser.add_argument('-ns', '--num_samples', nargs='+', type=int, required=False, default=[1, 4, 8],
+                        help='Number of samples per request, chosen randomly for every request.')
+    parser.add_argument('-mg', '--gen_len', type=int, required=False, default=48,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-cm', '--cache_mb', type=float, required=False, default=64, help='Prefix cache budget in MB.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=4, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=256, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    parser.add_argument('-np', '--n_positions', type=int, required=False, default=512,
+                        help='Maximum sequence length of the model.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,135 @@
+import io
+import glob
+import copy
+import time
+import argparse
+import contextlib
+import torch
+from torch.utils.data import DataLoader
+from pytorch_transformers import GPT2Config, GPT2LMHeadModel
+from train import initialize_optimizer, train_step
+from utils.data import create_datasets_from_jsons
+from utils.gen_utils import set_random_seeds, generate_sequence
+from utils.scoring import score_token_ids, corpus_perplexity
+from utils.restricted_vocab import corpus_token_ids, restrict_output_vocabulary
+from benchmarks.pipeline_benchmark import create_tokenizer
+
+
+def train_model(model, dataset, tokenizer, args):
+    """Train the model for a few steps, so its output distribution is not uniform."""
+    optimizer_args = argparse.Namespace(weight_decay=0.01, learning_rate=1e-3, adam_epsilon=1e-8,
+                                        max_steps=args.train_steps)
+    optimizer, scheduler = initialize_optimizer(model, optimizer_args)
+    dataloader = DataLoader(dataset, shuffle=True, batch_size=8, collate_fn=tokenizer.pad_batch_to_same_size)
+
+    model.train()
+    steps = 0
+    while steps < args.train_steps:
+        for batch in dataloader:
+            train_step(model, batch, optimizer, scheduler, 'cpu')
+            steps += 1
+            if steps >= args.train_steps:
+                break
+    model.eval()
+
+
+def time_generation(model, tokenizer, num_samples, args):
+    """Return the generation time per step in ms, and the generated samples."""
+    num_forward_calls = [0]
+
+    def count_forward_calls(module, inputs, outputs):
+        num_forward_calls[0] += 1
+    hook = model.register_forward_hook(count_forward_calls)
+
+    set_random_seeds(args.random_seed)
+    start = time.perf_counter()
+    for _ in range(args.num_rounds):
+        generated = generate_sequence(model, tokenizer, args.gen_len, num_samples=num_samples, top_k=20)
+    seconds = time.perf_counter() - start
+    hook.remove()
+
+    return seconds / num_forward_calls[0] * 1000, generated
+
+
+def run_benchmark(args):
+    """Compare the generation speed and the held-out perplexity of the full and the restricted output vocabulary."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+    json_paths = args.json_paths or sorted(glob.glob('scraped_data/*.json'))
+
+    # the bundled vocabulary is small, so the model gets the GPT-2 vocabulary size: the unused ids act as the part of
+    # the GPT-2 vocabulary that the episode summaries never use
+    tokenizer = create_tokenizer(max_num_words=80, size_var_handling='chop_at_sentence_end')
+    with contextlib.redirect_stdout(io.StringIO()):
+        train_dataset, val_dataset = create_datasets_from_jsons(json_paths, tokenizer, 0.1)
+    config = GPT2Config(vocab_size_or_config_json_file=args.vocab_size, n_positions=512, n_ctx=512,
+                        n_embd=args.n_embd, n_layer=args.n_layer, n_head=args.n_head)
+    model = GPT2LMHeadModel(config)
+
+    print('Training the model for {} steps...'.format(args.train_steps))
+    train_model(model, train_dataset, tokenizer, args)
+
+    # the vocabulary comes from the training subset only, the validation subset is held-out data
+    eos_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
+    token_ids = corpus_token_ids([train_dataset], args.vocab_size, margin=args.margin, extra_token_ids=[eos_id])
+    restricted_model = restrict_output_vocabulary(copy.deepcopy(model), token_ids)
+
+    val_summaries = val_dataset.episode_summaries
+    kept = set(token_ids)
+    num_val_tokens = sum(len(summary) - 1 for summary in val_summaries)
+    num_oov_tokens = sum(token_id not in kept for summary in val_summaries for token_id in summary[1:])
+    in_vocab_summaries = [summary for summary in val_summaries if all(token_id in kept for token_id in summary)]
+
+    print('\nOutput vocabulary: {} / {} tokens (margin: {})'.format(len(token_ids), args.vocab_size, args.margin))
+    print('Held-out tokens outside of the restricted vocabulary: {} / {} ({:.3%}), in {} / {} summaries'.format(
+        num_oov_tokens, num_val_tokens, num_oov_tokens / num_val_tokens,
+        len(val_summaries) - len(in_vocab_summaries), len(val_summaries)
+    ))
+
+    full_scores = score_token_ids(model, in_vocab_summaries, eos_id)
+    restricted_scores = score_token_ids(restricted_model, in_vocab_summaries, eos_id)
+    print('Held-out perplexity (summaries inside the restricted vocabulary): full {:.3f}, restricted {:.3f}'.format(
+        corpus_perplexity([{'log_likelihood': ll, 'num_tokens': n} for ll, n in full_scores]),
+        corpus_perplexity([{'log_likelihood': ll, 'num_tokens': n} for ll, n in restricted_scores])
+    ))
+
+    print('\n{:>12}{:>20}{:>20}{:>12}'.format('samples', 'full ms/step', 'restricted ms/step', 'speedup'))
+    for num_samples in args.num_samples:
+        full_ms, _ = time_generation(model, tokenizer, num_samples, args)
+        restricted_ms, _ = time_generation(restricted_model, tokenizer, num_samples, args)
+        print('{:>12}{:>20.2f}{:>20.2f}{:>11.2f}x'.format(num_samples, full_ms, restricted_ms, full_ms / restricted_ms))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the restricted output vocabulary: generation speed and held-out perplexity, with a '
+                    'small GPT-2 model trained for a few steps.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_paths', nargs='*', required=False, default=[],
+                        help='Episode data. Default: ./scraped_data/*.json')
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-ts', '--train_steps', type=int, required=False, default=100,
+                        help='Number of training steps before the comparison.')
+    parser.add_argument('-mr', '--margin', type=int, required=False, default=1000,
+                        help='Number of the most frequent token ids always kept in the restricted vocabulary.')
+    parser.add_argument('-ns', '--num_samples', nargs='+', type=int, required=False, default=[1, 8],
+                        help='Numbers of samples per generation.')
+    parser.add_argument('-mg', '--gen_len', type=int, required=False, default=48,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-r', '--num_rounds', type=int, required=False, default=3,
+                        help='Number of generations per measurement.')
+    parser.add_argument('-v', '--vocab_size', type=int, required=False, default=50257, help='Vocabulary size.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=2, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=128, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,92 @@
+import os
+import json
+import random
+import shutil
+import argparse
+import tempfile
+from unittest import mock
+import torch
+import score
+import generate
+from utils.data import load_episode_data
+from utils.gen_utils import set_random_seeds
+from benchmarks.pipeline_benchmark import create_tokenizer, create_tiny_model
+
+# characters outside of the episode summaries: their byte tokens are not in the restricted vocabulary
+OUT_OF_VOCABULARY_TEXTS = ['The crew finds a ∑∫∂ artifact.', 'こんにちは']
+
+
+def run_check(args):
+    """Run score.py with a restricted output vocabulary, and check the order and the scores of its output."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+    # the bundled BPE vocabulary replaces the downloaded GPT-2 tokenizer, so nothing is downloaded
+    tokenizer = create_tokenizer(max_num_words=0, size_var_handling='ignore')
+    work_dir = tempfile.mkdtemp(prefix='score_vocab_')
+    model_dir = os.path.join(work_dir, 'model')
+    os.makedirs(model_dir)
+    create_tiny_model(len(tokenizer), args).save_pretrained(model_dir)
+
+    texts = [ep_data['episode_summary'] for ep_data in load_episode_data(args.json_path)]
+    texts = random.Random(args.random_seed).sample(texts, args.num_texts) + OUT_OF_VOCABULARY_TEXTS
+    input_path, output_path = os.path.join(work_dir, 'candidates.jsonl'), os.path.join(work_dir, 'reranked.jsonl')
+    with open(input_path, 'w') as f:
+        for i, text in enumerate(texts):
+            f.write(json.dumps({'id': i, 'text': text}) + '\n')
+
+    try:
+        with mock.patch.object(score.GPT2Tokenizer, 'from_pretrained', lambda *a, **k: tokenizer), \
+                mock.patch.object(generate.EpisodeSummaryTokenizer, 'from_pretrained', lambda *a, **k: tokenizer):
+            for sort_by in ['perplexity', 'log_likelihood']:
+                score.rerank_candidates(score.get_arguments([
+                    '-i', input_path, '-o', output_path, '-mp', model_dir, '-sb', sort_by,
+                    '-vj', args.json_path, '-vm', '0'
+                ]))
+                with open(output_path, 'r') as f:
+                    candidates = [json.loads(line) for line in f]
+
+                num_scored = len(texts) - len(OUT_OF_VOCABULARY_TEXTS)
+                scored, not_scored = candidates[:num_scored], candidates[num_scored:]
+                values = [candidate[sort_by] for candidate in scored]
+                checks = {
+                    'all candidates saved': len(candidates) == len(texts),
+                    'summaries scored': all(not candidate['out_of_vocabulary'] and candidate['perplexity'] is not None
+                                            for candidate in scored),
+                    'out of vocabulary last, null scores': all(
+                        candidate['out_of_vocabulary'] and candidate['log_likelihood'] is None and
+                        candidate['perplexity'] is None for candidate in not_scored
+                    ) and {candidate['text'] for candidate in not_scored} == set(OUT_OF_VOCABULARY_TEXTS),
+                    'sorted by {}'.format(sort_by): values == sorted(values, reverse=sort_by == 'log_likelihood')
+                }
+                print('\n--sort_by {}'.format(sort_by))
+                for name, passed in checks.items():
+                    print('{:<40}{:>8}'.format(name, 'ok' if passed else 'FAILED'))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Check score.py --vocab_json_paths with a tiny, randomly initialized GPT-2 model.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_path', type=str, required=False, default='scraped_data/star_trek_imdb.json',
+                        help='Episode data of the restricted vocabulary, and of the candidates.')
+    parser.add_argument('-n', '--num_texts', type=int, required=False, default=20,
+                        help='Number of candidates from the episode data.')
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=2, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=64, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    parser.add_argument('-np', '--n_positions', type=int, required=False, default=1024,
+                        help='Maximum sequence length of the model.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_check(args)
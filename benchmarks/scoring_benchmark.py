@@ -0,0 +1,88 @@
+import glob
+import math
+import time
+import random
+import argparse
+import torch
+from utils.data import load_episode_data
+from utils.gen_utils import set_random_seeds
+from utils.scoring import inference_mode, tokenize_for_scoring, score_texts
+from benchmarks.pipeline_benchmark import create_tokenizer, create_tiny_model
+
+
+def score_texts_one_by_one(model, tokenizer, texts):
+    """Reference scoring: one text per forward pass, with the mean loss of the LM head."""
+    scores = []
+    with inference_mode():
+        for text in texts:
+            inputs = torch.tensor([tokenize_for_scoring(tokenizer, text)])
+            loss = model(inputs, labels=inputs)[0].item()
+            num_tokens = inputs.size()[1] - 1
+            scores.append({'log_likelihood': -loss * num_tokens, 'num_tokens': num_tokens,
+                           'perplexity': math.exp(loss)})
+
+    return scores
+
+
+def run_benchmark(args):
+    """Check the batched scoring against one-by-one scoring, and compare their throughput."""
+    set_random_seeds(args.random_seed)
+    torch.set_num_threads(args.num_threads)
+
+    json_paths = args.json_paths or sorted(glob.glob('scraped_data/*.json'))
+    texts = [ep_data['episode_summary'] for json_path in json_paths for ep_data in load_episode_data(json_path)]
+    texts = random.Random(args.random_seed).sample(texts, args.num_texts)
+
+    tokenizer = create_tokenizer(max_num_words=80, size_var_handling='ignore')
+    model = create_tiny_model(len(tokenizer), args)
+    model.eval()
+
+    start = time.perf_counter()
+    reference_scores = score_texts_one_by_one(model, tokenizer, texts)
+    reference_seconds = time.perf_counter() - start
+    num_tokens = sum(score['num_tokens'] for score in reference_scores)
+
+    print('{:<24}{:>12}{:>16}{:>16}{:>20}'.format('mode', 'seconds', 'texts/sec', 'tokens/sec', 'max abs LL diff'))
+    print('{:<24}{:>12.2f}{:>16.1f}{:>16.1f}{:>20}'.format('one by one (labels)', reference_seconds,
+                                                          len(texts) / reference_seconds,
+                                                          num_tokens / reference_seconds, '-'))
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        scores = score_texts(model, tokenizer, texts, batch_size=batch_size, max_batch_tokens=args.max_batch_tokens)
+        seconds = time.perf_counter() - start
+
+        max_diff = max(abs(score['log_likelihood'] - reference['log_likelihood'])
+                       for score, reference in zip(scores, reference_scores))
+        print('{:<24}{:>12.2f}{:>16.1f}{:>16.1f}{:>20.2e}'.format('batched ({})'.format(batch_size), seconds,
+                                                                 len(texts) / seconds, num_tokens / seconds, max_diff))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the batched likelihood scoring with a tiny, randomly initialized GPT-2 model.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_paths', nargs='*', required=False, default=[],
+                        help='Episode data used as candidates. Default: ./scraped_data/*.json')
+    parser.add_argument('-n', '--num_texts', type=int, required=False, default=500, help='Number of scored texts.')
+    parser.add_argument('-b', '--batch_sizes', nargs='+', type=int, required=False, default=[1, 8, 32],
+                        help='Batch sizes of the batched scoring.')
+    parser.add_argument('-mt', '--max_batch_tokens', type=int, required=False, default=4096,
+                        help='Maximum number of (padded) tokens per forward pass of the batched scoring.')
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-t', '--num_threads', type=int, required=False, default=1,
+                        help='Number of intra-op threads of torch.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=2, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=128, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    parser.add_argument('-np', '--n_positions', type=int, required=False, default=1024,
+                        help='Maximum sequence length of the model.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,65 @@
+import os
+import time
+import argparse
+import torch
+from utils.sharded_gen import generate_sharded
+from utils.train_metrics import peak_rss_mb
+from benchmarks.pipeline_benchmark import create_tokenizer, create_tiny_model
+
+
+def run_benchmark(args):
+    """Measure the throughput of the sharded generation for growing numbers of worker processes."""
+    torch.manual_seed(args.random_seed)
+    tokenizer = create_tokenizer(max_num_words=80, size_var_handling='ignore')
+    model = create_tiny_model(len(tokenizer), args)
+    model.eval()
+
+    requests = [('', args.num_samples)]
+    gen_kwargs = {'max_length': args.gen_len, 'top_k': 20}
+
+    print('CPUs: {}'.format(os.cpu_count()))
+    print('{:>10}{:>12}{:>16}{:>18}{:>24}'.format('workers', 'seconds', 'samples/sec', 'same samples',
+                                                  'parent peak RSS MB'))
+    reference = None
+    for num_workers in args.num_workers:
+        start = time.perf_counter()
+        samples = generate_sharded(model, tokenizer, requests, args.random_seed, num_workers=num_workers,
+                                   threads_per_worker=args.threads_per_worker, shard_size=args.shard_size,
+                                   **gen_kwargs)
+        seconds = time.perf_counter() - start
+
+        # the samples must not depend on the number of workers
+        reference = reference or samples
+        print('{:>10}{:>12.2f}{:>16.2f}{:>18}{:>24.1f}'.format(num_workers, seconds, args.num_samples / seconds,
+                                                              str(samples == reference), peak_rss_mb()))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the throughput of the sharded multi-process generation against the number of workers, '
+                    'with a randomly initialized GPT-2 model.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-w', '--num_workers', nargs='+', type=int, required=False, default=[0, 1, 2, 4],
+                        help='Numbers of worker processes. 0: generation in the benchmark process.')
+    parser.add_argument('-tw', '--threads_per_worker', type=int, required=False, default=1,
+                        help='Number of intra-op threads per worker.')
+    parser.add_argument('-ns', '--num_samples', type=int, required=False, default=32, help='Number of samples.')
+    parser.add_argument('-ss', '--shard_size', type=int, required=False, default=4,
+                        help='Maximum number of samples per shard.')
+    parser.add_argument('-mg', '--gen_len', type=int, required=False, default=48,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-nl', '--n_layer', type=int, required=False, default=4, help='Number of layers.')
+    parser.add_argument('-ne', '--n_embd', type=int, required=False, default=256, help='Embedding size.')
+    parser.add_argument('-nh', '--n_head', type=int, required=False, default=4, help='Number of attention heads.')
+    parser.add_argument('-np', '--n_positions', type=int, required=False, default=512,
+                        help='Maximum sequence length of the model.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_benchmark(args)
@@ -0,0 +1,102 @@
+import os
+import glob
+import json
+import argparse
+import regex as re
+from collections import Counter
+from pytorch_transformers.tokenization_gpt2 import bytes_to_unicode
+from utils.data import load_episode_data
+
+# pre-tokenization pattern of the GPT-2 tokenizer
+GPT2_PATTERN = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+
+
+def count_words(texts):
+    """Pre-tokenize the texts like GPT-2, and count the byte-level words."""
+    byte_encoder = bytes_to_unicode()
+    words = Counter()
+    for text in texts:
+        for token in re.findall(GPT2_PATTERN, text):
+            words[tuple(byte_encoder[b] for b in token.encode('utf-8'))] += 1
+
+    return words
+
+
+def learn_merges(words, num_merges):
+    """
+    Learn byte-pair encoding merges: repeatedly merge the most frequent pair of adjacent symbols.
+
+    :param words: Counter of words (tuples of symbols)
+    :param num_merges: Number of merges to learn
+    :return: List of merged symbol pairs, in the order of their priority
+    """
+    merges = []
+    for _ in range(num_merges):
+        pairs = Counter()
+        for word, freq in words.items():
+            for pair in zip(word[:-1], word[1:]):
+                pairs[pair] += freq
+
+        if not pairs:
+            break
+
+        best = max(pairs, key=lambda pair: (pairs[pair], pair))
+        merges.append(best)
+
+        merged_words = Counter()
+        for word, freq in words.items():
+            merged_word = []
+            i = 0
+            while i < len(word):
+                if i < len(word) - 1 and (word[i], word[i + 1]) == best:
+                    merged_word.append(word[i] + word[i + 1])
+                    i += 2
+                else:
+                    merged_word.append(word[i])
+                    i += 1
+            merged_words[tuple(merged_word)] += freq
+        words = merged_words
+
+    return merges
+
+
+def train_bpe_vocab(args):
+    """Learn a small byte-level BPE vocabulary from the episode summaries, in the GPT-2 vocab/merges format."""
+    json_paths = args.json_paths or sorted(glob.glob('scraped_data/*.json'))
+    texts = [' {}'.format(ep_data['episode_summary']) for json_path in json_paths
+             for ep_data in load_episode_data(json_path)]
+
+    merges = learn_merges(count_words(texts), args.num_merges)
+
+    vocab = list(bytes_to_unicode().values()) + [left + right for left, right in merges] + ['<|endoftext|>']
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump({token: idx for idx, token in enumerate(vocab)}, f, ensure_ascii=False)
+
+    with open(os.path.join(args.output_dir, 'merges.txt'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+        for left, right in merges:
+            f.write('{} {}\n'.format(left, right))
+
+    print('Saved a vocabulary of {} tokens to {}.'.format(len(vocab), args.output_dir))
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Learn the small BPE vocabulary bundled with the offline benchmarks.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-j', '--json_paths', nargs='*', required=False, default=[],
+                        help='Episode data used for learning the vocabulary. Default: ./scraped_data/*.json')
+    parser.add_argument('-n', '--num_merges', type=int, required=False, default=2000,
+                        help='Number of BPE merges.')
+    parser.add_argument('-o', '--output_dir', type=str, required=False, default='benchmarks/bpe_vocab',
+                        help='Output directory for vocab.json and merges.txt.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    train_bpe_vocab(args)
@@ -0,0 +1,330 @@
+import os
+import copy
+import json
+import argparse
+import functools
+import torch
+from torch.utils.data import DataLoader
+from pytorch_transformers import GPT2LMHeadModel, WEIGHTS_NAME
+from train import make_train_state, update_train_state, initialize_optimizer, add_data_arguments
+from generate import load_trained_model
+from utils.data import EpisodeSummaryTokenizer, create_datasets_from_jsons
+from utils.gen_utils import set_random_seeds, generate_sequence
+from utils.scoring import inference_mode, score_token_ids, corpus_perplexity
+from utils.file_fingerprint import files_fingerprint
+from utils.distillation import (load_or_compute_teacher_cache, DistillationDataset, pad_distillation_batch,
+                                distillation_loss, keep_layers, count_parameters, measure_generation_latency)
+
+
+def create_student_model(teacher, args):
+    """
+    Create the student model.
+
+    - with --student_n_embd: a narrower, randomly initialized model with the config of the teacher otherwise
+    - otherwise: the --student_size model (or a copy of the fine-tuned teacher), shrunk to --student_n_layer blocks
+    """
+    if args.student_n_embd:
+        config = copy.deepcopy(teacher.config)
+        config.n_layer = args.student_n_layer
+        config.n_embd = args.student_n_embd
+        config.n_head = args.student_n_head
+        return GPT2LMHeadModel(config)
+
+    if args.student_size == 'teacher':
+        student = copy.deepcopy(teacher)
+        # the base weights of a teacher with merged low-rank adapters are frozen, the student trains all of them
+        for p in student.parameters():
+            p.requires_grad_(True)
+    else:
+        student = GPT2LMHeadModel.from_pretrained(args.student_size)
+
+    return keep_layers(student, args.student_n_layer)
+
+
+def initialize_distillation(args, device):
+    """Initialize the tokenizer, the teacher and its cached outputs, the data loaders, the student and the optimizer."""
+    tokenizer = EpisodeSummaryTokenizer.from_pretrained(
+        args.teacher_size, max_num_words=args.max_num_words, size_variance_handling=args.size_var_handling
+    )
+    train_dataset, val_dataset = create_datasets_from_jsons(
+        args.json_paths, tokenizer, args.val_split, dedup_threshold=args.dedup_threshold
+    )
+    eos_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
+
+    # Run the teacher once, later runs load its top-k outputs from the cache
+    print('Loading the teacher...')
+    teacher = load_trained_model(args.teacher_size, args.teacher_load_path, device, args.teacher_adapter_path,
+                                 merge_adapter=True)
+    # the cache belongs to the content of the weights, so it is recomputed after the teacher is retrained or replaced
+    weights_path = args.teacher_adapter_path or args.teacher_load_path
+    teacher_name = '{} {}'.format(args.teacher_size, files_fingerprint([weights_path]))
+    teacher_outputs = load_or_compute_teacher_cache(
+        teacher, teacher_name, {'train': train_dataset, 'val': val_dataset}, args.teacher_cache_path, eos_id,
+        args.teacher_top_k, batch_size=args.batch_size, device=device
+    )
+
+    collate_fn = functools.partial(pad_distillation_batch, pad_token_id=eos_id)
+    dataloaders = {
+        'train': DataLoader(DistillationDataset(train_dataset.episode_summaries, teacher_outputs['train']),
+                            shuffle=True,
+                            batch_size=args.batch_size,
+                            collate_fn=collate_fn),
+        'val': DataLoader(DistillationDataset(val_dataset.episode_summaries, teacher_outputs['val']),
+                          shuffle=False,
+                          batch_size=args.batch_size,
+                          collate_fn=collate_fn)
+    }
+
+    student = create_student_model(teacher, args).to(device)
+    optimizer, scheduler = initialize_optimizer(student, args)
+    student.zero_grad()
+
+    # the student is saved in the pytorch-transformers format, so generate.py can load it without its config
+    os.makedirs(args.student_save_dir, exist_ok=True)
+    student.config.save_pretrained(args.student_save_dir)
+    train_state = make_train_state(save_path=os.path.join(args.student_save_dir, WEIGHTS_NAME),
+                                   early_stopping_patience=args.early_stopping_patience)
+
+    return tokenizer, val_dataset, dataloaders, teacher, student, optimizer, scheduler, train_state
+
+
+def distill_step(student, batch, optimizer, scheduler, device, temperature, alpha):
+    """Run a single optimization step of the student on a batch of data, and return the loss."""
+    inputs, teacher_log_probs, teacher_token_ids, mask = (tensor.to(device) for tensor in batch)
+    optimizer.zero_grad()
+
+    logits = student(inputs)[0]
+    loss, soft_loss, hard_loss = distillation_loss(logits, inputs, teacher_log_probs, teacher_token_ids, mask,
+                                                   temperature, alpha)
+    loss.backward()
+
+    optimizer.step()
+    scheduler.step()
+    student.zero_grad()
+
+    return loss
+
+
+def evaluate_student(student, dataloader, device, temperature, alpha):
+    """
+    Compute the token-weighted distillation loss of the student on a dataset, and the ratio of the tokens where the
+    most likely token of the student is the most likely token of the teacher.
+    """
+    running_loss = 0
+    num_agreements = 0
+    num_tokens = 0
+
+    with inference_mode():
+        for batch in dataloader:
+            inputs, teacher_log_probs, teacher_token_ids, mask = (tensor.to(device) for tensor in batch)
+            logits = student(inputs)[0]
+            loss, soft_loss, hard_loss = distillation_loss(logits, inputs, teacher_log_probs, teacher_token_ids,
+                                                           mask, temperature, alpha)
+
+            batch_tokens = mask.sum().item()
+            running_loss += loss.item() * batch_tokens
+            num_agreements += ((logits[:, :-1].argmax(-1) == teacher_token_ids[..., 0]) & mask).sum().item()
+            num_tokens += batch_tokens
+
+    return running_loss / max(num_tokens, 1), num_agreements / max(num_tokens, 1)
+
+
+def compare_models(teacher, student, tokenizer, val_summaries, top1_agreement, args, device):
+    """Compare the held-out quality and the generation latency of the teacher and the student."""
+    eos_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
+    report = {'top1_agreement': top1_agreement}
+
+    for name, model in [('teacher', teacher), ('student', student)]:
+        model.eval()
+        scores = score_token_ids(model, val_summaries, eos_id, batch_size=args.batch_size, device=device)
+        report[name] = {
+            'num_parameters': count_parameters(model),
+            'val_perplexity': corpus_perplexity([{'log_likelihood': ll, 'num_tokens': n} for ll, n in scores]),
+            'latency': {
+                num_samples: measure_generation_latency(model, tokenizer, args.max_gen_len, num_samples,
+                                                        args.sampling_top_k, args.latency_rounds, device)
+                for num_samples in [1, args.num_samples]
+            }
+        }
+
+    print('\n{:>10}{:>16}{:>18}'.format('', 'parameters', 'val perplexity'), end='')
+    for num_samples in report['teacher']['latency']:
+        print('{:>22}'.format('ms/step ({} samples)'.format(num_samples)), end='')
+    print()
+    for name in ['teacher', 'student']:
+        print('{:>10}{:>16,}{:>18.3f}'.format(name, report[name]['num_parameters'], report[name]['val_perplexity']),
+              end='')
+        for latency in report[name]['latency'].values():
+            print('{:>22.2f}'.format(latency['ms_per_step']), end='')
+        print()
+    print('Top-1 agreement of the student with the teacher on the validation set: {:.2%}'.format(top1_agreement))
+
+    for num_samples in report['teacher']['latency']:
+        report['speedup_{}_samples'.format(num_samples)] = (report['teacher']['latency'][num_samples]['ms_per_sample'] /
+                                                           report['student']['latency'][num_samples]['ms_per_sample'])
+
+    return report
+
+
+def run_distillation(args):
+    """Run the distillation process."""
+    set_random_seeds(args.random_seed)
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    print('Device: {}'.format(str(device)))
+
+    tokenizer, val_dataset, dataloaders, teacher, student, optimizer, scheduler, train_state = \
+        initialize_distillation(args, device)
+    print('Teacher: {:,} parameters, student: {:,} parameters'.format(count_parameters(teacher),
+                                                                      count_parameters(student)))
+
+    steps = 0
+    print('\nRunning distillation:')
+
+    while steps < args.max_steps and not train_state['stop_early']:
+        student.train()
+
+        running_train_loss = 0
+        num_train_tokens = 0
+
+        for train_batch in dataloaders['train']:
+            loss = distill_step(student, train_batch, optimizer, scheduler, device, args.temperature, args.alpha)
+            # the loss is the mean over the real (not padding) targets of the batch
+            batch_tokens = train_batch[3].sum().item()
+            running_train_loss += loss.item() * batch_tokens
+            num_train_tokens += batch_tokens
+
+            steps += 1
+
+            # Checkpoint
+            if steps % args.checkpoint_steps == 0:
+                student.eval()
+                val_loss, top1_agreement = evaluate_student(student, dataloaders['val'], device, args.temperature,
+                                                            args.alpha)
+                train_state = update_train_state(student, train_state, steps, running_train_loss / num_train_tokens,
+                                                 val_loss)
+
+                print('\n============== {} / {} =============='.format(steps, args.max_steps))
+                print('train loss: {:.4f} | val loss: {:.4f} | top-1 agreement: {:.2%}'.format(
+                    train_state['train_loss'][-1], train_state['val_loss'][-1], top1_agreement
+                ))
+                generated = generate_sequence(student, tokenizer, max_length=args.max_gen_len, num_samples=2,
+                                              top_k=args.sampling_top_k, device=device)
+                print('-' * 41)
+                print(*generated, sep='\n')
+                print('-' * 41)
+
+                if train_state['stop_early']:
+                    print('\nDistillation finished with early stopping.')
+                    print('best loss: {:.4f}'.format(train_state['min_val_loss']))
+                    break
+
+                running_train_loss = 0
+                num_train_tokens = 0
+                student.train()
+
+            if steps >= args.max_steps:
+                break
+
+    # Compare the best student with the teacher
+    if os.path.exists(train_state['save_path']):
+        student.load_state_dict(torch.load(train_state['save_path'], map_location=device))
+    student.eval()
+    val_loss, top1_agreement = evaluate_student(student, dataloaders['val'], device, args.temperature, args.alpha)
+    report = compare_models(teacher, student, tokenizer, val_dataset.episode_summaries, top1_agreement, args, device)
+    report.update(steps=steps, val_loss=val_loss, student_config=student.config.to_dict())
+
+    if args.report_path:
+        with open(args.report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Saved the report to {}.'.format(args.report_path))
+
+
+def get_arguments():
+    """Collect command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Distill a fine-tuned GPT-2 model (the teacher) into a smaller GPT-2 model (the student).',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    # Args related to the data
+    # the same data preparation as train.py, so the student is trained and validated on the split of the teacher
+    add_data_arguments(parser)
+    parser.add_argument('-j', '--json_paths', nargs='*', required=False,
+                        default=['wiki_episode_summaries.json', 'imdb_episode_summaries.json'],
+                        help='Path to the JSON files which contain the episode data (the outputs of the spiders). '
+                             'Use the training data of the teacher, with the same data arguments (e.g. --random_seed, '
+                             '--val_split and --dedup_threshold).')
+
+    # teacher args
+    parser.add_argument('-g', '--teacher_size', type=str, required=False, default='gpt2-medium',
+                        choices=['gpt2', 'gpt2-medium', 'gpt2-large'],
+                        help='GPT-2 architecture of the teacher.')
+    parser.add_argument('-tp', '--teacher_load_path', type=str, required=False, default='ep_summary_gen_model.pth',
+                        help='Path to the weights of the fine-tuned teacher (train.py --model_save_path).')
+    parser.add_argument('-ta', '--teacher_adapter_path', type=str, required=False, default=None,
+                        help='Path to the low-rank adapters of the teacher (train.py --lora_rank). If set, they are '
+                             'merged into the pre-trained weights instead of loading --teacher_load_path.')
+    parser.add_argument('-tc', '--teacher_cache_path', type=str, required=False, default='teacher_logits.pt',
+                        help='Cache file of the top-k teacher log-probabilities of every token of the data. The '
+                             'teacher runs only if the file is missing, or if it belongs to other data or weights.')
+    parser.add_argument('-k', '--teacher_top_k', type=int, required=False, default=32,
+                        help='Number of the cached teacher log-probabilities per token (6 bytes each).')
+
+    # student args
+    parser.add_argument('-ss', '--student_size', type=str, required=False, default='gpt2',
+                        choices=['teacher', 'gpt2', 'gpt2-medium'],
+                        help='Initialization of the student: a pre-trained GPT-2 model, or the fine-tuned teacher. '
+                             'Its blocks are reduced to --student_n_layer evenly spaced blocks. Not used if '
+                             '--student_n_embd is set.')
+    parser.add_argument('-sl', '--student_n_layer', type=int, required=False, default=6,
+                        help='Number of transformer blocks of the student.')
+    parser.add_argument('-se', '--student_n_embd', type=int, required=False, default=0,
+                        help='Embedding size of a narrower student. If set, the student is randomly initialized with '
+                             'the config of the teacher, --student_n_layer, --student_n_embd and --student_n_head. '
+                             '0: the embedding size of --student_size.')
+    parser.add_argument('-sh', '--student_n_head', type=int, required=False, default=8,
+                        help='Number of attention heads of a narrower student.')
+    parser.add_argument('-sd', '--student_save_dir', type=str, required=False, default='ep_summary_student_model',
+                        help='Save directory of the best student (config and weights). Generate with it with '
+                             'generate.py --model_load_path <DIR>.')
+
+    # Training and optimization args
+    parser.add_argument('-t', '--temperature', type=float, required=False, default=2.,
+                        help='Softmax temperature of the soft loss on the teacher outputs.')
+    parser.add_argument('-al', '--alpha', type=float, required=False, default=0.5,
+                        help='Weight of the soft loss, the loss on the real next tokens has the weight 1 - alpha.')
+    parser.add_argument('-b', '--batch_size', type=int, required=False, default=8, help='Batch size.')
+    parser.add_argument('-w', '--weight_decay', type=float, required=False, default=0.01, help='Weight decay.')
+    parser.add_argument('-lr', '--learning_rate', type=float, required=False, default=1e-4,
+                        help='Initial learning rate.')
+    parser.add_argument('-a', '--adam_epsilon', type=float, required=False, default=1e-8,
+                        help='Epsilon param of the Adam optimizer.')
+    parser.add_argument('-ms', '--max_steps', type=int, required=False, default=4000,
+                        help='Maximum number of training steps.')
+    parser.add_argument('-cs', '--checkpoint_steps', type=int, required=False, default=50,
+                        help='Checkpoint frequency during the training process.')
+    parser.add_argument('-e', '--early_stopping_patience', type=int, required=False, default=3,
+                        help='Patience before initiating early stopping.')
+
+    # report args
+    parser.add_argument('-rp', '--report_path', type=str, required=False, default='distill_report.json',
+                        help='Output path of the JSON report comparing the student and the teacher: parameters, '
+                             'validation perplexity, top-1 agreement and generation latency.')
+    parser.add_argument('-ns', '--num_samples', type=int, required=False, default=8,
+                        help='Number of samples per generation in the latency measurement (it is also measured with '
+                             '1 sample).')
+    parser.add_argument('-r', '--latency_rounds', type=int, required=False, default=3,
+                        help='Number of generations per latency measurement.')
+    parser.add_argument('-mg', '--max_gen_len', type=int, required=False, default=135,
+                        help='Max length of the generated samples.')
+    parser.add_argument('-tk', '--sampling_top_k', type=int, required=False, default=20,
+                        help='The number of highest probability vocabulary tokens to keep during top-k-filtering '
+                             'in the sample generation.')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_distillation(args)
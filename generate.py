@@ -1,41 +1,185 @@
+import os
+import random
 import argparse
 import torch
 from pytorch_transformers import GPT2Config, GPT2Tokenizer, GPT2LMHeadModel
+from utils.data import EpisodeSummaryTokenizer, create_datasets_from_jsons
 from utils.gen_utils import set_random_seeds, generate_sequence
+from utils.lora import load_lora_adapters
+from utils.prefix_cache import PrefixCache
+from utils.generation_cache import (GenerationCache, request_cache_key, cached_model_loading,
+                                    cached_generate_sequence)
+from utils.sharded_gen import generate_sharded
+from utils.restricted_vocab import corpus_token_ids, restrict_output_vocabulary
+
+
+def load_trained_model(gpt2_size, model_load_path, device, adapter_path=None, merge_adapter=False):
+    """
+    Load the weights of a trained GPT-2 model, and prepare the model for inference.
+
+    :param gpt2_size: GPT-2 architecture
+    :param model_load_path: Path to the weights of the fine-tuned model, or to a directory with the config and the
+                            weights (e.g. a student model of distill.py). Not used if adapter_path is set
+    :param device: 'cuda' or 'cpu'
+    :param adapter_path: Path to low-rank adapters trained with train.py --lora_rank. They are applied to the
+                         pre-trained weights
+    :param merge_adapter: If True, merge the adapters into the pre-trained weights
+    :return: The model
+    """
+    if adapter_path:
+        model = GPT2LMHeadModel.from_pretrained(gpt2_size)
+        model = load_lora_adapters(model, adapter_path, merge=merge_adapter)
+    elif os.path.isdir(model_load_path):
+        model = GPT2LMHeadModel.from_pretrained(model_load_path)
+    else:
+        config = GPT2Config.from_pretrained(gpt2_size)
+        model = GPT2LMHeadModel(config)
+        model.load_state_dict(torch.load(model_load_path, map_location=device))
+    model = model.to(device)
+    model.eval()
+
+    return model
+
+
+def restrict_to_corpus_vocabulary(model, tokenizer, gpt2_size, vocab_json_paths, vocab_margin):
+    """
+    Restrict the output vocabulary of a model to the tokens of episode summaries.
+
+    :param model: GPT-2 model
+    :param tokenizer: GPT-2 tokenizer of the model
+    :param gpt2_size: GPT-2 architecture, for the tokenizer of the summaries
+    :param vocab_json_paths: Paths to the episode data
+    :param vocab_margin: Number of the most frequent GPT-2 tokens always kept
+    :return: The restricted model
+    """
+    corpus_tokenizer = EpisodeSummaryTokenizer.from_pretrained(gpt2_size, max_num_words=0,
+                                                               size_variance_handling='ignore')
+    datasets = create_datasets_from_jsons(vocab_json_paths, corpus_tokenizer, val_split_ratio=0)
+    token_ids = corpus_token_ids(datasets, len(tokenizer), margin=vocab_margin,
+                                 extra_token_ids=[tokenizer.convert_tokens_to_ids('<|endoftext|>')])
+    model = restrict_output_vocabulary(model, token_ids)
+    print('Restricted the output vocabulary to {} tokens.'.format(len(token_ids)))
+
+    return model
+
+
+def load_generation_model(args, tokenizer, device):
+    """Load the model of generate.py, and restrict its output vocabulary if needed."""
+    # Load pre-trained network weights
+    print('Loading pre-trained model...')
+    model = load_trained_model(args.gpt2_size, args.model_load_path, device, args.adapter_path, args.merge_adapter)
+
+    # Restrict the output vocabulary to the tokens of the training corpus
+    if args.vocab_json_paths:
+        model = restrict_to_corpus_vocabulary(model, tokenizer, args.gpt2_size, args.vocab_json_paths,
+                                              args.vocab_margin)
+
+    return model
+
+
+def model_files_fingerprint(args, generation_cache):
+    """Fingerprint of the model of generate.py, from its files and loading arguments (without loading it)."""
+    paths = [args.adapter_path] if args.adapter_path else [args.model_load_path]
+    return generation_cache.files_fingerprint(paths + args.vocab_json_paths, extra={
+        'gpt2_size': args.gpt2_size,
+        'adapter': bool(args.adapter_path),
+        'merge_adapter': args.merge_adapter,
+        'vocab_margin': args.vocab_margin if args.vocab_json_paths else None
+    })
 
 
 def generate_samples(args):
     """Use a pre-trained GPT-2 model to generate a set of samples from scratch."""
-    # Set seed
-    set_random_seeds(args.random_seed)
+    # Set seed. without a seed, the samples are different in every run, and the sampling is not cached
+    seeded = not args.unseeded
+    if seeded:
+        set_random_seeds(args.random_seed)
 
     # Initialize training
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     print('Device: {}'.format(str(device)))
 
-    # Load pre-trained network weights
-    print('Loading pre-trained model...')
-    config = GPT2Config.from_pretrained(args.gpt2_size)
-    model = GPT2LMHeadModel(config)
-    model.load_state_dict(torch.load(args.model_load_path))
-    model = model.to(device)
-    model.eval()
-
     # Create tokenizer
     tokenizer = GPT2Tokenizer.from_pretrained(args.gpt2_size)
 
-    # Generate some samples
-    print('Generating...')
-    generated = generate_sequence(
-        model, tokenizer,
-        context=args.context,
-        max_length=args.max_gen_len,
-        num_samples=args.num_samples,
-        top_k=args.sampling_top_k,
-        device=device
-    )
-    print('Generated samples:')
-    print(*generated, sep="\n---\n")
+    # Cache of the generated samples: with a cache hit for every request, the model is not even loaded
+    generation_cache, model_fingerprint = None, None
+    if args.generation_cache_dir:
+        generation_cache = GenerationCache(disk_dir=args.generation_cache_dir,
+                                           max_disk_bytes=args.generation_cache_mb * 2 ** 20)
+        model_fingerprint = model_files_fingerprint(args, generation_cache)
+
+    model = []
+
+    def get_model():
+        if not model:
+            model.append(load_generation_model(args, tokenizer, device))
+        return model[0]
+
+    # the model is loaded before the generation, and its initialization draws random numbers. with the cache, a
+    # seeded run restores the state of the generator after the loading instead, so the samples are the same as
+    # without the cache, and the model is only loaded on a miss
+    if generation_cache is None:
+        get_model()
+    elif seeded and not args.num_workers:
+        cached_model_loading(generation_cache, model_fingerprint, get_model, device)
+
+    # Generate some samples for every context in worker processes, sharing the weights
+    if args.num_workers:
+        requests = [(context, args.num_samples) for context in args.context]
+        seed = args.random_seed if seeded else random.randrange(2 ** 31)
+        # the shards have their own seeds, so the samples only depend on the requests, the seed and the shard size
+        cache_key = request_cache_key(model_fingerprint, {
+            'requests': requests, 'seed': seed, 'shard_size': args.shard_size,
+            'max_length': args.max_gen_len, 'top_k': args.sampling_top_k, 'torch_version': torch.__version__
+        }) if generation_cache is not None and seeded else None
+        all_generated = generation_cache.get(cache_key) if cache_key is not None else None
+
+        if all_generated is None:
+            print('Generating with {} worker processes...'.format(args.num_workers))
+            all_generated = generate_sharded(
+                get_model().cpu(), tokenizer,
+                requests=requests,
+                seed=seed,
+                num_workers=args.num_workers,
+                threads_per_worker=args.threads_per_worker,
+                shard_size=args.shard_size,
+                prefix_cache_mb=args.prefix_cache_mb,
+                max_length=args.max_gen_len,
+                top_k=args.sampling_top_k
+            )
+            if cache_key is not None:
+                generation_cache.put(cache_key, all_generated)
+
+        for generated in all_generated:
+            print('Generated samples:')
+            print(*generated, sep="\n---\n")
+
+    else:
+        # Generate some samples for every context, the contexts share the prefix cache
+        prefix_cache = PrefixCache(args.prefix_cache_mb * 2 ** 20)
+        for context in args.context:
+            print('Generating...')
+            gen_kwargs = dict(
+                context=context,
+                max_length=args.max_gen_len,
+                num_samples=args.num_samples,
+                top_k=args.sampling_top_k,
+                device=device,
+                prefix_cache=prefix_cache
+            )
+            if generation_cache is not None:
+                generated = cached_generate_sequence(generation_cache, None, tokenizer, seeded=seeded,
+                                                     model_fingerprint=model_fingerprint, load_model=get_model,
+                                                     **gen_kwargs)
+            else:
+                generated = generate_sequence(get_model(), tokenizer, **gen_kwargs)
+            print('Generated samples:')
+            print(*generated, sep="\n---\n")
+
+    if generation_cache is not None:
+        print('Generation cache: {} ({:.2f} MB on disk)'.format(generation_cache.stats,
+                                                               generation_cache.disk_bytes / 2 ** 20))
 
 
 def get_arguments():
@@ -45,17 +189,52 @@ def get_arguments():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
+    parser.add_argument('-us', '--unseeded', action='store_true',
+                        help='Do not seed the random number generators (--random_seed is not used): the samples are '
+                             'different in every run, and they are not cached.')
     parser.add_argument('-g', '--gpt2_size', type=str, required=False, default='gpt2',
                         choices=['gpt2', 'gpt2-medium', 'gpt2-large'],
                         help='Which GPT-2 architecture to use from pytorch-transformers.')
     parser.add_argument('-mp', '--model_load_path', type=str, required=False, default='ep_summary_gen_model.pth',
-                        help='Save path for the trained model or checkpoints during training.')
+                        help='Save path for the trained model or checkpoints during training. A directory with a '
+                             'config and weights (e.g. distill.py --student_save_dir) is loaded with its own config.')
+    parser.add_argument('-ap', '--adapter_path', type=str, required=False, default=None,
+                        help='Path to low-rank adapters (train.py --lora_rank). If set, the adapters are applied to '
+                             'the pre-trained GPT-2 weights instead of loading --model_load_path.')
+    parser.add_argument('-ma', '--merge_adapter', action='store_true',
+                        help='Merge the adapters into the pre-trained weights at load time, so the generation has no '
+                             'adapter overhead.')
     parser.add_argument('-ns', '--num_samples', type=int, required=False, default=8,
                         help='Number of samples generated and displayed at every checkpoint.')
     parser.add_argument('-mg', '--max_gen_len', type=int, required=False, default=135,
                         help='Max length of the generated samples.')
-    parser.add_argument('-c', '--context', type=str, required=False, default='',
-                        help='Initial context string used for generation.')
+    parser.add_argument('-c', '--context', nargs='+', type=str, required=False, default=[''],
+                        help='Initial context string used for generation. If more contexts are given, samples are '
+                             'generated for every one of them.')
+    parser.add_argument('-pc', '--prefix_cache_mb', type=float, required=False, default=256,
+                        help='Memory budget (MB) of the cache of the context states: repeated contexts and contexts '
+                             'extending a previous one skip (part of) the context computation.')
+    parser.add_argument('-gc', '--generation_cache_dir', type=str, required=False, default=None,
+                        help='Directory of a cache of the generated samples, keyed by the fingerprint of the model '
+                             'files and the request (context, seed, sampling parameters). Repeated runs are served '
+                             'from the cache, without loading the model. If not set, the cache is turned off.')
+    parser.add_argument('-gm', '--generation_cache_mb', type=float, required=False, default=512,
+                        help='Disk budget (MB) of the generation cache. The least recently used entries are evicted.')
+    parser.add_argument('-vj', '--vocab_json_paths', nargs='*', required=False, default=[],
+                        help='Episode data (e.g. the training data of the model). If set, the output vocabulary of '
+                             'the model is restricted to the tokens of these summaries plus --vocab_margin tokens, '
+                             'which makes the LM head and the sampling cheaper.')
+    parser.add_argument('-vm', '--vocab_margin', type=int, required=False, default=1000,
+                        help='Number of the most frequent GPT-2 tokens always kept in the restricted vocabulary.')
+    parser.add_argument('-w', '--num_workers', type=int, required=False, default=0,
+                        help='Number of worker processes for the generation on the CPU. The model weights are shared '
+                             'by the workers, and the samples are generated in shards of --shard_size samples, with '
+                             'per-shard seeds derived from --random_seed (the samples do not depend on the number of '
+                             'workers). 0: generate in the main process.')
+    parser.add_argument('-tw', '--threads_per_worker', type=int, required=False, default=1,
+                        help='Number of intra-op threads of every worker process.')
+    parser.add_argument('-ss', '--shard_size', type=int, required=False, default=4,
+                        help='Maximum number of samples per shard in the worker processes.')
     parser.add_argument('-tk', '--sampling_top_k', type=int, required=False, default=20,
                         help='The number of highest probability vocabulary tokens to keep during top-k-filtering '
                              'in the sample generation. Should be between 1 and inf.')
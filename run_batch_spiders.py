@@ -0,0 +1,199 @@
+import json
+import time
+import argparse
+from collections import defaultdict
+from urllib.parse import urlparse
+from twisted.internet import defer
+from scrapy.crawler import Crawler, CrawlerProcess
+from spiders.imdb_episode_summary_spider import ImdbEpisodeSummarySpider
+from spiders.wiki_episode_table_spider import WikiEpisodeTableSpider
+from run_imdb_spider import download_and_uncompress_imdb_data, get_start_urls_for_shows
+from run_imdb_spider import get_crawl_settings as get_imdb_crawl_settings
+from run_wiki_spider import get_crawl_settings as get_wiki_crawl_settings
+
+
+def create_crawl_jobs(manifest, imdb_data_path):
+    """
+    Create the crawl jobs (spider class, spider arguments and settings) for the shows of a manifest.
+
+    :param manifest: List of dictionaries, one for every crawl. See get_arguments() for the format
+    :param imdb_data_path: Download and extraction path for the IMDb data subset used for URL extraction
+    :return: List of crawl job dictionaries
+    """
+    # look up the start urls of all the IMDb crawls with a single pass over the IMDb data
+    imdb_searches = [entry for entry in manifest if entry['spider'] == 'imdb' and 'start_urls' not in entry]
+    if imdb_searches:
+        imdb_tsv_path = download_and_uncompress_imdb_data(imdb_data_path)
+        start_urls_list = get_start_urls_for_shows([entry['search_keywords'] for entry in imdb_searches], imdb_tsv_path)
+        for entry, start_urls in zip(imdb_searches, start_urls_list):
+            entry['start_urls'] = start_urls
+
+    jobs = []
+    for entry in manifest:
+        crawl_args = argparse.Namespace(output_path=entry['output_path'], state_path=entry.get('state_path'),
+                                        metrics_path=entry.get('metrics_path'))
+        spider_kwargs = {
+            'state_path': entry.get('state_path'),
+            'max_leaf_age': entry.get('revisit_after_days', 30) * 86400,
+            'allowed_domains': entry.get('allowed_domains')
+        }
+
+        if entry['spider'] == 'imdb':
+            # if the search was unsuccessful or we have too many matches, skip the show
+            if not entry['start_urls'] or len(entry['start_urls']) > 99:
+                print('{} title matches were found for {}. Skipping it, please refine search!'.format(
+                    len(entry['start_urls']), entry['output_path']
+                ))
+                continue
+
+            spider_cls = ImdbEpisodeSummarySpider
+            spider_kwargs['start_urls'] = entry['start_urls']
+            settings = get_imdb_crawl_settings(crawl_args)
+            domain = urlparse(entry['start_urls'][0]).hostname
+
+        else:
+            spider_cls = WikiEpisodeTableSpider
+            spider_kwargs.update(start_url=entry['start_url'], allow=entry['url_substring'],
+                                 title_keywords=entry['title_keywords'])
+            settings = get_wiki_crawl_settings(crawl_args)
+            domain = urlparse(entry['start_url']).hostname
+
+        jobs.append({
+            'name': entry['output_path'],
+            'spider_cls': spider_cls,
+            'spider_kwargs': spider_kwargs,
+            'settings': settings,
+            'domain': domain
+        })
+
+    return jobs
+
+
+def run_batch_crawl(jobs, max_crawls_per_domain, max_requests_per_domain, log_level='INFO'):
+    """
+    Run many crawls concurrently in a single process and reactor.
+
+    Politeness is kept per domain: at most max_crawls_per_domain crawls run against the same domain at the same time,
+    and each of them gets an equal share of the max_requests_per_domain concurrent requests (at least one, so at most
+    max_requests_per_domain crawls run against the same domain).
+
+    :param jobs: List of crawl jobs from create_crawl_jobs()
+    :param max_crawls_per_domain: Maximum number of concurrent crawls per domain
+    :param max_requests_per_domain: Maximum number of concurrent requests per domain, summed over the crawls
+    :param log_level: Scrapy log level
+    :return: Dictionary of per-crawl and aggregate stats
+    """
+    process = CrawlerProcess(settings={'LOG_LEVEL': log_level})
+    # every crawl needs at least one request slot, so there can not be more concurrent crawls than requests per domain
+    max_crawls_per_domain = min(max_crawls_per_domain, max_requests_per_domain)
+    semaphores = defaultdict(lambda: defer.DeferredSemaphore(max_crawls_per_domain))
+    requests_per_crawl = max(1, max_requests_per_domain // max_crawls_per_domain)
+
+    from twisted.internet import reactor
+
+    crawlers, runs, errors = {}, [], {}
+
+    def record_error(failure, name):
+        errors[name] = failure.getErrorMessage()
+
+    for job in jobs:
+        settings = dict(job['settings'], **{
+            'CONCURRENT_REQUESTS_PER_DOMAIN': requests_per_crawl,
+            'TELNETCONSOLE_ENABLED': False,
+            'LOG_LEVEL': log_level
+        })
+        crawler = Crawler(job['spider_cls'], settings)
+        crawlers[job['name']] = crawler
+        run = semaphores[job['domain']].run(process.crawl, crawler, **job['spider_kwargs'])
+        runs.append(run.addErrback(record_error, job['name']))
+
+    # the reactor is stopped after all the crawls, including the ones waiting for a semaphore, so the batch does not
+    # depend on how CrawlerProcess.join() handles the crawls started after it was called
+    reactor.callWhenRunning(lambda: defer.DeferredList(runs).addBoth(lambda _: reactor.stop()))
+    start_time = time.time()
+    process.start(stop_after_crawl=False)
+    elapsed = time.time() - start_time
+
+    # collect stats. crawls failing before their start have no start or finish time
+    batch_stats = {'crawls': {}}
+    for name, crawler in crawlers.items():
+        stats = crawler.stats.get_stats() if crawler.stats else {}
+        crawl_start_time, crawl_finish_time = stats.get('start_time'), stats.get('finish_time')
+        batch_stats['crawls'][name] = {
+            'items': stats.get('item_scraped_count', 0),
+            'requests': stats.get('downloader/request_count', 0),
+            'response_bytes': stats.get('downloader/response_bytes', 0),
+            'seconds': (crawl_finish_time - crawl_start_time).total_seconds()
+            if crawl_start_time and crawl_finish_time else None,
+            'finish_reason': stats.get('finish_reason'),
+            'error': errors.get(name)
+        }
+
+    batch_stats.update({
+        'num_crawls': len(crawlers),
+        'seconds': elapsed,
+        'items': sum(crawl['items'] for crawl in batch_stats['crawls'].values()),
+        'requests': sum(crawl['requests'] for crawl in batch_stats['crawls'].values()),
+        'response_bytes': sum(crawl['response_bytes'] for crawl in batch_stats['crawls'].values()),
+    })
+    batch_stats['items_per_sec'] = batch_stats['items'] / elapsed
+    batch_stats['requests_per_sec'] = batch_stats['requests'] / elapsed
+
+    return batch_stats
+
+
+def run_batch_spiders(args):
+    """Create and run the crawls of a manifest, then report the throughput."""
+    with open(args.manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    print('Preparing spiders...')
+    jobs = create_crawl_jobs(manifest, args.imdb_data_path)
+    batch_stats = run_batch_crawl(jobs, args.max_crawls_per_domain, args.max_requests_per_domain)
+
+    print('\n{:<40}{:>10}{:>10}{:>12}'.format('output', 'items', 'requests', 'seconds'))
+    for name, crawl_stats in batch_stats['crawls'].items():
+        seconds = '-' if crawl_stats['seconds'] is None else '{:.1f}'.format(crawl_stats['seconds'])
+        print('{:<40}{:>10}{:>10}{:>12}'.format(name, crawl_stats['items'], crawl_stats['requests'], seconds))
+        if crawl_stats['error'] or crawl_stats['finish_reason'] != 'finished':
+            print('    crawl failed: {}'.format(crawl_stats['error'] or crawl_stats['finish_reason']))
+    print('{} crawls finished in {:.1f} seconds: {:.2f} items/sec, {:.2f} requests/sec.'.format(
+        batch_stats['num_crawls'], batch_stats['seconds'], batch_stats['items_per_sec'], batch_stats['requests_per_sec']
+    ))
+
+    if args.stats_path:
+        with open(args.stats_path, 'w') as f:
+            json.dump(batch_stats, f, indent=2)
+
+
+def get_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Run the IMDb and Wikipedia spiders for many shows concurrently, in a single process.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-m', '--manifest_path', type=str, required=True,
+                        help='Path to a JSON manifest: a list of crawls. Every crawl is a dictionary with the keys '
+                             '"spider" ("imdb" or "wiki"), "output_path", the arguments of the spider '
+                             '(imdb: "search_keywords" or "start_urls", '
+                             'wiki: "start_url", "url_substring" and "title_keywords"), '
+                             'and optionally "state_path" and "revisit_after_days" for incremental crawls, '
+                             '"metrics_path" for a JSON report of the crawl instrumentation, and "allowed_domains" '
+                             '(list of domains) to override the domains the spider may crawl. '
+                             'See run_imdb_spider.py and run_wiki_spider.py for the details.')
+    parser.add_argument('-d', '--imdb_data_path', type=str, required=False, default='.',
+                        help='Download and extraction path for the IMDb data subset used for URL extraction.')
+    parser.add_argument('-c', '--max_crawls_per_domain', type=int, required=False, default=4,
+                        help='Maximum number of crawls running concurrently against the same domain. At most '
+                             '--max_requests_per_domain, since every crawl needs at least one request slot.')
+    parser.add_argument('-r', '--max_requests_per_domain', type=int, required=False, default=8,
+                        help='Maximum number of concurrent requests per domain, shared by the concurrent crawls.')
+    parser.add_argument('-st', '--stats_path', type=str, required=False, default=None,
+                        help='Path to a JSON file for the per-crawl and aggregate throughput stats.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    run_batch_spiders(args)
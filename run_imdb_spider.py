@@ -6,6 +6,8 @@ import shutil
 import csv
 from scrapy.crawler import CrawlerProcess
 from spiders.imdb_episode_summary_spider import ImdbEpisodeSummarySpider
+from utils.crawl_metrics import crawl_metrics_settings
+from utils.crawl_state import convert_json_output
 
 
 def download_and_uncompress_imdb_data(imdb_data_path):
@@ -26,12 +28,18 @@ def download_and_uncompress_imdb_data(imdb_data_path):
 
 def get_start_urls(search_keywords, imdb_tsv_path):
     """Run a quick search to filter out possible start URLs for the spider."""
+    return get_start_urls_for_shows([search_keywords], imdb_tsv_path)[0]
+
+
+def get_start_urls_for_shows(search_keywords_list, imdb_tsv_path):
+    """Run a quick search to filter out possible start URLs for multiple shows, with a single pass over the data."""
     # run some filtering on the title keywords
-    search_keywords = [w.lower().strip() for w in search_keywords if len(w)]
-    assert(len(search_keywords) > 0)
+    search_keywords_list = [[w.lower().strip() for w in search_keywords if len(w)]
+                            for search_keywords in search_keywords_list]
+    assert(all([len(search_keywords) > 0 for search_keywords in search_keywords_list]))
 
     # get start urls from the csv file
-    start_urls = []
+    start_urls_list = [[] for _ in search_keywords_list]
     with open(imdb_tsv_path, 'r') as f:
         reader = csv.reader(f, delimiter='\t')
 
@@ -42,17 +50,19 @@ def get_start_urls(search_keywords, imdb_tsv_path):
             if title_type == 'tvseries':
                 title = row[2].lower().split()
 
-                # if we have multiple search keywords, check for titles containing all of them
-                if len(search_keywords) > 1:
-                    if all([any([search_kw in title_word for title_word in title]) for search_kw in search_keywords]):
-                        start_urls.append('https://www.imdb.com/title/{}/'.format(row[0]))
+                for search_keywords, start_urls in zip(search_keywords_list, start_urls_list):
+                    # if we have multiple search keywords, check for titles containing all of them
+                    if len(search_keywords) > 1:
+                        if all([any([search_kw in title_word for title_word in title])
+                                for search_kw in search_keywords]):
+                            start_urls.append('https://www.imdb.com/title/{}/'.format(row[0]))
 
-                # if there is just 1 keyword, look for an exact match
-                elif len(search_keywords) == 1:
-                    if search_keywords == title:
-                        start_urls.append('https://www.imdb.com/title/{}/'.format(row[0]))
+                    # if there is just 1 keyword, look for an exact match
+                    elif len(search_keywords) == 1:
+                        if search_keywords == title:
+                            start_urls.append('https://www.imdb.com/title/{}/'.format(row[0]))
 
-    return start_urls
+    return start_urls_list
 
 
 def run_imdb_spider(args):
@@ -76,20 +86,45 @@ def run_imdb_spider(args):
         ))
         return
 
-    # overwrite output. not too elegant, but there is no better way to do it at the moment.
-    with open(args.output_path, 'w') as f:
-        pass
-
     # run spider
-    process = CrawlerProcess(settings={
-        'FEED_FORMAT': 'json',
-        'FEED_URI': args.output_path,
-        'ROBOTSTXT_OBEY': True
-    })
-    process.crawl(ImdbEpisodeSummarySpider, start_urls=start_urls)
+    process = CrawlerProcess(settings=get_crawl_settings(args))
+    process.crawl(ImdbEpisodeSummarySpider, start_urls=start_urls, state_path=args.state_path,
+                  max_leaf_age=args.revisit_after_days * 86400)
     process.start()
 
 
+def get_crawl_settings(args):
+    """Prepare the output file and collect the Scrapy settings for a full or an incremental crawl."""
+    # incremental crawl: append new and changed episodes to the JSON Lines output
+    if args.state_path:
+        # the JSON list output of a previous full crawl can not be appended to
+        if convert_json_output(args.output_path):
+            print('Converted the JSON output {} to JSON Lines.'.format(args.output_path))
+
+        settings = {
+            'FEED_FORMAT': 'jsonlines',
+            'FEED_URI': args.output_path,
+            'ROBOTSTXT_OBEY': True
+        }
+
+    else:
+        # overwrite output. not too elegant, but there is no better way to do it at the moment.
+        with open(args.output_path, 'w') as f:
+            pass
+
+        settings = {
+            'FEED_FORMAT': 'json',
+            'FEED_URI': args.output_path,
+            'ROBOTSTXT_OBEY': True
+        }
+
+    # throughput and latency instrumentation
+    if getattr(args, 'metrics_path', None):
+        settings.update(crawl_metrics_settings(args.metrics_path))
+
+    return settings
+
+
 def get_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -104,6 +139,20 @@ def get_arguments():
                         help='Download and extraction path for the IMDb data subset used for URL extraction.')
     parser.add_argument('-o', '--output_path', type=str, required=False, default='imdb_episode_summaries.json',
                         help='Path to the output JSON file. If the file already exists, it will be overwritten.')
+    parser.add_argument('-st', '--state_path', type=str, required=False, default=None,
+                        help='Path to a crawl state file. If set, the spider runs in incremental mode: the episodes '
+                             'collected in previous crawls are skipped, and only new or changed episodes are appended '
+                             'to the output in JSON Lines format.')
+    parser.add_argument('-r', '--revisit_after_days', type=float, required=False, default=30,
+                        help='In incremental mode, episodes visited more than this many days ago are crawled again. '
+                             'The plot summary pages of the already collected episodes are not requested before, so '
+                             'the edits of their summaries are only detected (and appended as changed episodes) after '
+                             'this many days.')
+    parser.add_argument('-mt', '--metrics_path', type=str, required=False, default=None,
+                        help='Path to a JSON report of the crawl instrumentation: per-callback response counts, bytes, '
+                             'download latency and callback run time, requests/sec, duplicate requests, dropped and '
+                             'duplicate items, retries, and the scheduler queue depth over time. If not set, the '
+                             'instrumentation is turned off.')
     args = parser.parse_args()
     return args
 
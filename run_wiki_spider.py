@@ -1,27 +1,55 @@
 import argparse
 from scrapy.crawler import CrawlerProcess
 from spiders.wiki_episode_table_spider import WikiEpisodeTableSpider
+from utils.crawl_metrics import crawl_metrics_settings
+from utils.crawl_state import convert_json_output
 
 
 def run_wiki_spider(args):
     """Define and start process for Wikipedia scraping."""
-    # overwrite output
-    with open(args.output_path, 'w') as f:
-        pass
-
     # run spider
-    process = CrawlerProcess(settings={
-        'FEED_FORMAT': 'json',
-        'FEED_URI': args.output_path,
-        'ROBOTSTXT_OBEY': True,
-        'DEPTH_LIMIT': 2
-    })
+    process = CrawlerProcess(settings=get_crawl_settings(args))
     process.crawl(
-        WikiEpisodeTableSpider, start_url=args.start_url, allow=args.url_substring, title_keywords=args.title_keywords
+        WikiEpisodeTableSpider, start_url=args.start_url, allow=args.url_substring, title_keywords=args.title_keywords,
+        state_path=args.state_path, max_leaf_age=args.revisit_after_days * 86400
     )
     process.start()
 
 
+def get_crawl_settings(args):
+    """Prepare the output file and collect the Scrapy settings for a full or an incremental crawl."""
+    # incremental crawl: append new and changed episodes to the JSON Lines output
+    if args.state_path:
+        # the JSON list output of a previous full crawl can not be appended to
+        if convert_json_output(args.output_path):
+            print('Converted the JSON output {} to JSON Lines.'.format(args.output_path))
+
+        settings = {
+            'FEED_FORMAT': 'jsonlines',
+            'FEED_URI': args.output_path,
+            'ROBOTSTXT_OBEY': True,
+            'DEPTH_LIMIT': 2
+        }
+
+    else:
+        # overwrite output
+        with open(args.output_path, 'w') as f:
+            pass
+
+        settings = {
+            'FEED_FORMAT': 'json',
+            'FEED_URI': args.output_path,
+            'ROBOTSTXT_OBEY': True,
+            'DEPTH_LIMIT': 2
+        }
+
+    # throughput and latency instrumentation
+    if getattr(args, 'metrics_path', None):
+        settings.update(crawl_metrics_settings(args.metrics_path))
+
+    return settings
+
+
 def get_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -44,6 +72,18 @@ def get_arguments():
                              'Example: star trek')
     parser.add_argument('-o', '--output_path', type=str, required=False, default='wiki_episode_summaries.json',
                         help='Path to the output JSON file. If the file already exists, it will be overwritten.')
+    parser.add_argument('-st', '--state_path', type=str, required=False, default=None,
+                        help='Path to a crawl state file. If set, the spider runs in incremental mode: the dead-end '
+                             'pages of previous crawls are skipped, and only new or changed episodes are appended '
+                             'to the output in JSON Lines format.')
+    parser.add_argument('-r', '--revisit_after_days', type=float, required=False, default=30,
+                        help='In incremental mode, dead-end pages visited more than this many days ago are crawled '
+                             'again.')
+    parser.add_argument('-mt', '--metrics_path', type=str, required=False, default=None,
+                        help='Path to a JSON report of the crawl instrumentation: per-callback response counts, bytes, '
+                             'download latency and callback run time, requests/sec, duplicate requests, dropped and '
+                             'duplicate items, retries, and the scheduler queue depth over time. If not set, the '
+                             'instrumentation is turned off.')
 
     args = parser.parse_args()
     return args
@@ -0,0 +1,108 @@
+import json
+import time
+import argparse
+import torch
+from pytorch_transformers import GPT2Tokenizer
+from generate import load_trained_model, restrict_to_corpus_vocabulary
+from utils.scoring import score_texts, corpus_perplexity
+
+
+def rerank_candidates(args):
+    """Score the candidates of a JSONL file with a trained GPT-2 model, and save them sorted by their score."""
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    print('Device: {}'.format(str(device)))
+
+    print('Loading pre-trained model...')
+    model = load_trained_model(args.gpt2_size, args.model_load_path, device, args.adapter_path, merge_adapter=True)
+    tokenizer = GPT2Tokenizer.from_pretrained(args.gpt2_size)
+    # the texts with tokens outside of the restricted vocabulary can not be generated by generate.py --vocab_json_paths
+    if args.vocab_json_paths:
+        model = restrict_to_corpus_vocabulary(model, tokenizer, args.gpt2_size, args.vocab_json_paths,
+                                              args.vocab_margin)
+
+    with open(args.input_path, 'r') as f:
+        candidates = [json.loads(line) for line in f if line.strip()]
+
+    print('Scoring {} candidates...'.format(len(candidates)))
+    start = time.perf_counter()
+    scores = score_texts(model, tokenizer, [candidate[args.text_field] for candidate in candidates],
+                         batch_size=args.batch_size, max_batch_tokens=args.max_batch_tokens, device=device)
+    elapsed = time.perf_counter() - start
+
+    for candidate, score in zip(candidates, scores):
+        candidate.update(score)
+
+    # the highest log-likelihood per token is the lowest perplexity. the candidates without a score (tokens outside of a
+    # restricted output vocabulary) are the last ones
+    if args.sort_by == 'perplexity':
+        candidates.sort(key=lambda candidate: (candidate['out_of_vocabulary'], candidate['perplexity'] or 0))
+    else:
+        candidates.sort(key=lambda candidate: (not candidate['out_of_vocabulary'], candidate['log_likelihood'] or 0),
+                        reverse=True)
+    if args.num_keep:
+        candidates = candidates[:args.num_keep]
+
+    with open(args.output_path, 'w') as f:
+        for candidate in candidates:
+            f.write(json.dumps(candidate) + '\n')
+
+    print('Scored {} candidates ({} tokens) in {:.2f} seconds: {:.1f} candidates/sec, {:.1f} tokens/sec.'.format(
+        len(scores), sum(score['num_tokens'] for score in scores), elapsed, len(scores) / elapsed,
+        sum(score['num_tokens'] for score in scores) / elapsed
+    ))
+    num_out_of_vocabulary = sum(score['out_of_vocabulary'] for score in scores)
+    if num_out_of_vocabulary:
+        print('{} candidates have tokens outside of the output vocabulary, they are not scored.'.format(
+            num_out_of_vocabulary))
+    print('Perplexity of all the candidates: {:.2f}'.format(corpus_perplexity(scores)))
+    print('Saved {} reranked candidates to {}.'.format(len(candidates), args.output_path))
+
+
+def get_arguments(argv=None):
+    """Collect command line arguments (from argv, or from sys.argv if argv is None)."""
+    parser = argparse.ArgumentParser(
+        description='Score episode summary candidates with a trained GPT-2 model, and rerank them.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-i', '--input_path', type=str, required=True,
+                        help='Path to a JSONL file of candidates: one JSON object per line, with the text in the '
+                             'text field.')
+    parser.add_argument('-o', '--output_path', type=str, required=False, default='reranked_candidates.jsonl',
+                        help='Output JSONL file: the candidates with their "log_likelihood", "num_tokens", '
+                             '"perplexity" and "out_of_vocabulary", sorted from best to worst. The candidates with '
+                             'tokens outside of a restricted output vocabulary have null scores and come last.')
+    parser.add_argument('-f', '--text_field', type=str, required=False, default='text',
+                        help='Field of the candidate text in the JSON objects.')
+    parser.add_argument('-sb', '--sort_by', type=str, required=False, default='perplexity',
+                        choices=['perplexity', 'log_likelihood'],
+                        help='Ranking criterion. The perplexity is normalized with the length of the text, the total '
+                             'log-likelihood prefers short texts.')
+    parser.add_argument('-k', '--num_keep', type=int, required=False, default=0,
+                        help='Number of best candidates to keep. 0: keep all of them.')
+    parser.add_argument('-b', '--batch_size', type=int, required=False, default=32,
+                        help='Maximum number of candidates per forward pass.')
+    parser.add_argument('-mt', '--max_batch_tokens', type=int, required=False, default=4096,
+                        help='Maximum number of (padded) tokens per forward pass. The candidates are batched by '
+                             'length, so long candidates are scored in smaller batches.')
+    parser.add_argument('-g', '--gpt2_size', type=str, required=False, default='gpt2',
+                        choices=['gpt2', 'gpt2-medium', 'gpt2-large'],
+                        help='Which GPT-2 architecture to use from pytorch-transformers.')
+    parser.add_argument('-mp', '--model_load_path', type=str, required=False, default='ep_summary_gen_model.pth',
+                        help='Path to the trained model.')
+    parser.add_argument('-ap', '--adapter_path', type=str, required=False, default=None,
+                        help='Path to low-rank adapters (train.py --lora_rank). If set, the adapters are merged into '
+                             'the pre-trained GPT-2 weights instead of loading --model_load_path.')
+    parser.add_argument('-vj', '--vocab_json_paths', nargs='*', required=False, default=[],
+                        help='Episode data (e.g. the training data of the model). If set, the output vocabulary of '
+                             'the model is restricted to the tokens of these summaries plus --vocab_margin tokens, '
+                             'like generate.py --vocab_json_paths: the candidates with other tokens are not scored.')
+    parser.add_argument('-vm', '--vocab_margin', type=int, required=False, default=1000,
+                        help='Number of the most frequent GPT-2 tokens always kept in the restricted vocabulary.')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    rerank_candidates(args)
@@ -1,6 +1,6 @@
 import scrapy
-from bs4 import BeautifulSoup
 from utils.text_cleansing import clean_ep_data
+from utils.crawl_state import CrawlState, DEFAULT_MAX_LEAF_AGE
 
 
 class ImdbEpisodeSummarySpider(scrapy.Spider):
@@ -8,12 +8,21 @@ class ImdbEpisodeSummarySpider(scrapy.Spider):
 
     name = 'imdb_episode_summary_spider'
 
-    def __init__(self, start_urls, *args, **kwargs):
+    def __init__(self, start_urls, allowed_domains=None, state_path=None, max_leaf_age=DEFAULT_MAX_LEAF_AGE, *args,
+                 **kwargs):
         super(ImdbEpisodeSummarySpider, self).__init__(*args, **kwargs)
 
-        self.allowed_domains = ['www.imdb.com']
+        self.allowed_domains = allowed_domains or ['www.imdb.com']
         self.start_urls = start_urls
 
+        # incremental mode: skip the already processed episodes and only yield new or changed items
+        self.crawl_state = CrawlState(state_path, max_leaf_age) if state_path else None
+
+    def closed(self, reason):
+        """Save the crawl state at the end of the crawl."""
+        if self.crawl_state:
+            self.crawl_state.save()
+
     def parse(self, response):
         """Look up the episode list urls."""
         # get the rating count. if its > 500, this might be a real TV show, not some fan-made project
@@ -35,9 +44,14 @@ class ImdbEpisodeSummarySpider(scrapy.Spider):
         """Look up the episode urls from an episode list page."""
         episode_list = response.xpath('//*[@class="list detail eplist"]')
         episode_page_urls = episode_list.xpath('//*[@class="info"]/strong/a/@href').extract()
-        episode_page_urls = ['https://www.imdb.com{}'.format(e) for e in episode_page_urls]
+        episode_page_urls = [response.urljoin(e) for e in episode_page_urls]
 
         for url in episode_page_urls:
+            # the summaries of this episode were already collected, skip the episode and the plot summary page
+            if self.crawl_state and self.crawl_state.is_leaf(url):
+                self.crawler.stats.inc_value('incremental/requests_saved', 2)
+                continue
+
             yield scrapy.Request(url, callback=self.parse_episode_page)
 
         # look up the page for the previous/next season
@@ -58,18 +72,22 @@ class ImdbEpisodeSummarySpider(scrapy.Spider):
     def parse_episode_page(self, response):
         """Look up the link to the plot summary page from episode page and process it accordingly."""
         plot_summary_url = response.xpath('//*[text()="Plot Summary"]/@href').extract_first()
-        plot_summary_url = 'https://www.imdb.com{}'.format(plot_summary_url)
+        plot_summary_url = response.urljoin(plot_summary_url)
 
-        yield scrapy.Request(plot_summary_url, callback=self.parse_plot_summary_page)
+        yield scrapy.Request(plot_summary_url, callback=self.parse_plot_summary_page,
+                             meta={'episode_url': response.url})
 
     def parse_plot_summary_page(self, response):
         """Create and load the episode summary items."""
         show_title = response.xpath('//*[@class="subpage_title_block"]//h4/a/text()').extract_first().strip()
         ep_title = response.xpath('//*[@class="subpage_title_block"]//h3/a/text()').extract_first().strip()
-        summaries = response.xpath('//*[@class="ipl-zebra-list__item" and contains(@id, "summary")]/p').extract()
+        summaries = response.xpath('//*[@class="ipl-zebra-list__item" and contains(@id, "summary")]/p')
+        ep_datas = []
 
         for ep_sum in summaries:
-            ep_sum = BeautifulSoup(ep_sum, 'lxml').get_text().strip()
+            # text content of the paragraph without inline styles and scripts, extracted from the already parsed tree
+            ep_sum = ep_sum.xpath('.//text()[not(ancestor::style) and not(ancestor::script)]').extract()
+            ep_sum = ''.join(ep_sum).strip()
 
             if 'be the first to contribute' not in ep_sum.lower():
                 ep_data = {
@@ -78,5 +96,18 @@ class ImdbEpisodeSummarySpider(scrapy.Spider):
                     'episode_summary': ep_sum,
                     'tv_show_title': show_title,
                 }
+                ep_datas.append(clean_ep_data(ep_data))
+
+        # episodes without summaries are revisited during the next crawl
+        if self.crawl_state and ep_datas:
+            self.crawl_state.mark_leaf(response.meta['episode_url'])
+
+            # all summaries of a new or changed episode are yielded, they supersede the ones of the previous crawls
+            item_status = self.crawl_state.check_episode(ep_datas)
+            self.crawler.stats.inc_value('incremental/items_{}'.format(item_status or 'unchanged'), len(ep_datas))
+
+            if not item_status:
+                return
 
-                yield clean_ep_data(ep_data)
+        for ep_data in ep_datas:
+            yield ep_data
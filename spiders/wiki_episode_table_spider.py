@@ -1,7 +1,7 @@
-from bs4 import BeautifulSoup
 from scrapy.spiders import CrawlSpider, Rule
 from scrapy.linkextractors import LinkExtractor
 from utils.text_cleansing import clean_ep_data
+from utils.crawl_state import CrawlState, DEFAULT_MAX_LEAF_AGE
 
 
 class WikiEpisodeTableSpider(CrawlSpider):
@@ -9,7 +9,8 @@ class WikiEpisodeTableSpider(CrawlSpider):
 
     name = 'wiki_episode_table_spider'
 
-    def __init__(self, start_url, allow, title_keywords, *args, **kwargs):
+    def __init__(self, start_url, allow, title_keywords, allowed_domains=None, state_path=None,
+                 max_leaf_age=DEFAULT_MAX_LEAF_AGE, *args, **kwargs):
         super(WikiEpisodeTableSpider, self).__init__(*args, **kwargs)
 
         self.start_urls = [start_url]
@@ -17,8 +18,11 @@ class WikiEpisodeTableSpider(CrawlSpider):
         self.title_keywords = [word.lower() for word in title_keywords]
         self.unique_episode_summaries = set()
 
+        # incremental mode: skip the already visited dead-end pages and only yield new or changed items
+        self.crawl_state = CrawlState(state_path, max_leaf_age) if state_path else None
+
         # set Wiki specific stuff
-        self.allowed_domains = ['en.wikipedia.org']
+        self.allowed_domains = allowed_domains or ['en.wikipedia.org']
         self.to_deny = ['/Talk:', '/Wikipedia_talk:', '/Category:', '/Wikipedia:', '/Template:']
 
         # set rules
@@ -26,47 +30,79 @@ class WikiEpisodeTableSpider(CrawlSpider):
                                          deny=self.to_deny,
                                          allow_domains=self.allowed_domains),
                            callback='parse_wiki_page',
+                           process_request='skip_known_leaf',
                            follow=True),)
         super(WikiEpisodeTableSpider, self)._compile_rules()
 
+    def closed(self, reason):
+        """Save the crawl state at the end of the crawl."""
+        if self.crawl_state:
+            self.crawl_state.save()
+
+    def skip_known_leaf(self, request, response=None):
+        """Drop requests for the dead-end pages of previous crawls, which have neither episodes nor followed links."""
+        if self.crawl_state and self.crawl_state.is_leaf(request.url):
+            self.crawler.stats.inc_value('incremental/requests_saved')
+            return None
+
+        return request
+
     def parse_wiki_page(self, response):
         """Parse and yield all relevant episode data from a Wikipedia page."""
         page_header = response.xpath('//title').extract_first()
+        ep_titles, ep_sums = [], []
 
         if page_header and all([keyword in page_header.lower() for keyword in self.title_keywords]):
             # parse episode tables
             ep_tables = response.xpath('//table[@class="wikitable plainrowheaders wikiepisodetable"]')
             ep_titles, ep_sums = self.parse_episode_tables(ep_tables)
 
-            if not ep_sums:
-                return
-
-            # prettify data
-            ep_sums = [BeautifulSoup(ep_sum, 'lxml').get_text().strip() for ep_sum in ep_sums]
-            ep_titles = [BeautifulSoup(ep_title, 'lxml').get_text().strip() for ep_title in ep_titles]
-
-            # parse unique items
-            for ep_title, ep_sum in zip(ep_titles, ep_sums):
-                if ep_sum not in self.unique_episode_summaries:
-                    self.unique_episode_summaries.add(ep_sum)
-
-                    ep_data = {
-                        'source_url': response.url,
-                        'episode_title': ep_title,
-                        'episode_summary': ep_sum,
-                        'tv_show_title': '',
-                    }
-
-                    yield clean_ep_data(ep_data)
+        if not ep_sums:
+            # the links of the pages at the depth limit are not followed, so pages without episodes are dead-ends there
+            if self.crawl_state and 0 < self.settings.getint('DEPTH_LIMIT') <= response.meta.get('depth', 0):
+                self.crawl_state.mark_leaf(response.url)
+            return
+
+        # prettify data: text content of the table cells without inline styles (e.g. TemplateStyles) and scripts,
+        # extracted from the already parsed tree of the response
+        text_xpath = './/text()[not(ancestor::style) and not(ancestor::script)]'
+        ep_sums = [''.join(ep_sum.xpath(text_xpath).extract()).strip() for ep_sum in ep_sums]
+        ep_titles = [''.join(ep_title.xpath(text_xpath).extract()).strip() for ep_title in ep_titles]
+
+        # parse unique items, grouped by episode title
+        episodes = {}
+        for ep_title, ep_sum in zip(ep_titles, ep_sums):
+            if ep_sum not in self.unique_episode_summaries:
+                self.unique_episode_summaries.add(ep_sum)
+
+                ep_data = {
+                    'source_url': response.url,
+                    'episode_title': ep_title,
+                    'episode_summary': ep_sum,
+                    'tv_show_title': '',
+                }
+                ep_data = clean_ep_data(ep_data)
+                episodes.setdefault(ep_data['episode_title'], []).append(ep_data)
+
+        for ep_datas in episodes.values():
+            if self.crawl_state:
+                item_status = self.crawl_state.check_episode(ep_datas)
+                self.crawler.stats.inc_value('incremental/items_{}'.format(item_status or 'unchanged'), len(ep_datas))
+
+                if not item_status:
+                    continue
+
+            for ep_data in ep_datas:
+                yield ep_data
 
     def parse_episode_tables(self, ep_tables):
-        """Collect the data from a list of Wikipedia episode tables into a list of titles and a list of summaries."""
+        """Collect the cells from a list of Wikipedia episode tables into a list of titles and a list of summaries."""
         ep_titles = []
         ep_sums = []
 
         for ep_table in ep_tables:
-            ep_table_titles = ep_table.xpath('.//tbody/tr[@class="vevent"]/td[@class="summary"]').extract()
-            ep_table_sums = ep_table.xpath('.//tbody/tr[@class="expand-child"]/td[@class="description"]').extract()
+            ep_table_titles = ep_table.xpath('.//tbody/tr[@class="vevent"]/td[@class="summary"]')
+            ep_table_sums = ep_table.xpath('.//tbody/tr[@class="expand-child"]/td[@class="description"]')
 
             # some episode tables only contain the episode titles + other information, but not the ep summaries
             # also, so episode tables have missing summaries for some (yet to be aired) episodes. SKIP these.
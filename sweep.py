@@ -0,0 +1,203 @@
+import os
+import io
+import copy
+import time
+import argparse
+import traceback
+import contextlib
+import torch
+import torch.multiprocessing as mp
+from train import run_training, get_arguments as get_train_arguments
+from utils.data import EpisodeSummaryTokenizer, EpisodeSummaryDataset, create_datasets_from_jsons
+from utils.gen_utils import set_random_seeds
+from utils.sweep import (load_sweep_spec, make_trials, data_key, PackedSequences, core_allotments, MedianPruner,
+                         write_results_table)
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def make_trial_args(base_args, params, trial_idx, output_dir):
+    """Create the training arguments of a trial: the base arguments, overwritten by the parameters of the trial."""
+    trial_args = copy.deepcopy(base_args)
+    for name, value in params.items():
+        setattr(trial_args, name, value)
+
+    # every trial saves its best model separately, and the samples and the metrics are turned off
+    trial_args.model_save_path = os.path.join(output_dir, 'trial_{}.pth'.format(trial_idx))
+    trial_args.num_samples = 0
+    trial_args.metrics_path = None
+    return trial_args
+
+
+def tokenize_trial_data(all_trial_args):
+    """
+    Tokenize the data of the trials once per distinct data config (see utils.sweep.DATA_ARGS).
+
+    :param all_trial_args: List of the training arguments of the trials
+    :return: Dictionary of the data key -> tuple of the train and val PackedSequences (in shared memory)
+    """
+    data = {}
+    for trial_args in all_trial_args:
+        key = data_key(trial_args)
+        if key in data:
+            continue
+
+        tokenizer = EpisodeSummaryTokenizer.from_pretrained(
+            trial_args.gpt2_size, max_num_words=trial_args.max_num_words,
+            size_variance_handling=trial_args.size_var_handling
+        )
+        # the same seed as in run_training, so the split is the same as in a train.py run
+        set_random_seeds(trial_args.random_seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            datasets = create_datasets_from_jsons(trial_args.json_paths, tokenizer, trial_args.val_split,
+                                                  dedup_threshold=trial_args.dedup_threshold)
+        data[key] = tuple(PackedSequences(dataset.episode_summaries).share_memory_() for dataset in datasets)
+        print('Tokenized the data of max_num_words={}, size_var_handling={}: {} train, {} val summaries'.format(
+            trial_args.max_num_words, trial_args.size_var_handling, len(data[key][0]), len(data[key][1])
+        ))
+
+    return data
+
+
+def run_trial(trial_idx, trial_args, data, curves, cores, prune_warmup, prune_min_trials, log_path):
+    """Run a trial, with its output redirected to a log file, and return its results."""
+    pruner = MedianPruner(curves, trial_idx, warmup_checkpoints=prune_warmup, min_trials=prune_min_trials)
+    datasets = tuple(EpisodeSummaryDataset(packed_sequences) for packed_sequences in data[data_key(trial_args)])
+
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file, contextlib.redirect_stdout(log_file):
+        try:
+            train_state = run_training(trial_args, datasets=datasets, checkpoint_callback=pruner)
+            status = 'pruned' if train_state['pruned'] else \
+                'early_stopped' if train_state['stop_early'] else 'completed'
+        except Exception:
+            traceback.print_exc(file=log_file)
+            train_state = {'steps': 0, 'min_val_loss': float('Inf'), 'train_loss': []}
+            status = 'failed'
+
+    return {
+        'trial': trial_idx,
+        'status': status,
+        'steps': train_state['steps'],
+        'best_val_loss': train_state['min_val_loss'],
+        'final_train_loss': train_state['train_loss'][-1] if train_state['train_loss'] else float('NaN'),
+        'seconds': time.perf_counter() - start,
+        'cores': ' '.join(str(core) for core in cores)
+    }
+
+
+def _init_worker(data, curves, core_slots, threads_per_trial, pin_cores):
+    """Set up a worker process: it takes a slot of CPU cores, and receives the tokenized data as shared memory."""
+    cores = core_slots.get()
+    if pin_cores:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads_per_trial)
+    _worker.update(data=data, curves=curves, cores=cores)
+
+
+def _run_trial_in_worker(task):
+    """Run a trial in a worker process."""
+    trial_idx, trial_args, prune_warmup, prune_min_trials, log_path = task
+    return run_trial(trial_idx, trial_args, _worker['data'], _worker['curves'], _worker['cores'], prune_warmup,
+                     prune_min_trials, log_path)
+
+
+def run_sweep(args, base_args):
+    """Run the trials of a hyperparameter sweep, and write the results table."""
+    spec = load_sweep_spec(args.spec_path, vars(base_args))
+    trials = make_trials(spec, seed=args.sweep_seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    all_trial_args = [make_trial_args(base_args, params, trial_idx, args.output_dir)
+                      for trial_idx, params in enumerate(trials)]
+    tasks = [(trial_idx, trial_args, args.prune_warmup, args.prune_min_trials,
+              os.path.join(args.output_dir, 'trial_{}.log'.format(trial_idx)))
+             for trial_idx, trial_args in enumerate(all_trial_args)]
+    print('Running {} trials ({} search), {} at a time with {} threads each.'.format(
+        len(trials), spec['method'], max(args.num_parallel, 1), args.threads_per_trial
+    ))
+
+    data = tokenize_trial_data(all_trial_args)
+
+    results = []
+    if args.num_parallel == 0:
+        torch.set_num_threads(args.threads_per_trial)
+        curves = {}
+        for task in tasks:
+            results.append(run_trial(task[0], task[1], data, curves, [], *task[2:]))
+            print('Trial {}: {status}, best val loss {best_val_loss:.4f}'.format(task[0], **results[-1]))
+    else:
+        # spawn: forking a process with an initialized OpenMP thread pool can hang
+        context = mp.get_context('spawn')
+        manager = context.Manager()
+        curves = manager.dict()
+        core_slots = manager.Queue()
+        for cores in core_allotments(args.num_parallel, args.threads_per_trial, os.cpu_count()):
+            core_slots.put(cores)
+
+        pool = context.Pool(args.num_parallel, initializer=_init_worker,
+                            initargs=(data, curves, core_slots, args.threads_per_trial, args.pin_cores))
+        try:
+            for result in pool.imap_unordered(_run_trial_in_worker, tasks):
+                results.append(result)
+                print('Trial {trial}: {status}, best val loss {best_val_loss:.4f}'.format(**result))
+        finally:
+            pool.close()
+            pool.join()
+            manager.shutdown()
+
+    for result in results:
+        result.update(trials[result['trial']])
+    best_trial = min(results, key=lambda result: result['best_val_loss'])['trial']
+    if not args.keep_all_models:
+        for trial_args in all_trial_args:
+            if trial_args.model_save_path != all_trial_args[best_trial].model_save_path and \
+                    os.path.exists(trial_args.model_save_path):
+                os.remove(trial_args.model_save_path)
+
+    print()
+    write_results_table(results, sorted(spec['parameters']), os.path.join(args.output_dir, 'results.csv'))
+    print('Best trial: {} ({})'.format(best_trial, all_trial_args[best_trial].model_save_path))
+
+
+def get_arguments():
+    """Collect command line arguments: the sweep arguments, and the base training arguments of the trials."""
+    parser = argparse.ArgumentParser(
+        description='Hyperparameter sweep of train.py. Every other argument is passed to train.py as the base '
+                    'arguments of the trials, e.g. python3 sweep.py -sp sweep.json -j data.json -ms 500.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        allow_abbrev=False
+    )
+    parser.add_argument('-sp', '--spec_path', type=str, required=False, default='sweep.json',
+                        help='Path to the JSON sweep spec: the search method ("grid" or "random"), the number of '
+                             'random trials ("num_trials"), and the values or ranges of the searched train.py '
+                             'arguments ("parameters"). See utils.sweep.load_sweep_spec.')
+    parser.add_argument('-od', '--output_dir', type=str, required=False, default='sweep',
+                        help='Output directory of the results table (results.csv), the trial logs and the models.')
+    parser.add_argument('-np', '--num_parallel', type=int, required=False, default=1,
+                        help='Number of concurrent trials (worker processes). 0: run the trials one by one in the '
+                             'main process.')
+    parser.add_argument('-tt', '--threads_per_trial', type=int, required=False, default=1,
+                        help='Number of intra-op threads (and CPU cores, with --pin_cores) of every trial. '
+                             'Use num_parallel * threads_per_trial <= number of cores.')
+    parser.add_argument('-pc', '--pin_cores', action='store_true',
+                        help='Pin every worker process to its own threads_per_trial cores (Linux only).')
+    parser.add_argument('-pw', '--prune_warmup', type=int, required=False, default=2,
+                        help='Number of checkpoints before a trial can be pruned.')
+    parser.add_argument('-pm', '--prune_min_trials', type=int, required=False, default=2,
+                        help='A trial is pruned if its best val loss is worse than the median of at least this many '
+                             'other trials at the same checkpoint. A very high value turns the pruning off.')
+    parser.add_argument('-ka', '--keep_all_models', action='store_true',
+                        help='Keep the best model of every trial, not only the model of the best trial.')
+    parser.add_argument('-ss', '--sweep_seed', type=int, required=False, default=0,
+                        help='Random seed of the random search.')
+
+    args, train_argv = parser.parse_known_args()
+    base_args = get_train_arguments(train_argv)
+    return args, base_args
+
+
+if __name__ == '__main__':
+    args, base_args = get_arguments()
+    run_sweep(args, base_args)
@@ -4,6 +4,8 @@ from torch.utils.data import DataLoader
 from pytorch_transformers import GPT2LMHeadModel, AdamW, WarmupLinearSchedule
 from utils.data import EpisodeSummaryTokenizer, create_datasets_from_jsons
 from utils.gen_utils import set_random_seeds, generate_sequence
+from utils.train_metrics import TrainingMetrics, null_phase
+from utils.lora import LORA_TARGET_MODULES, add_lora_adapters, has_lora_adapters, save_lora_adapters
 
 
 def make_train_state(save_path, early_stopping_patience):
@@ -15,6 +17,7 @@ def make_train_state(save_path, early_stopping_patience):
             'min_val_loss': float('Inf'),
             'train_loss': [],
             'val_loss': [],
+            'pruned': False,
             'save_path': save_path}
 
 
@@ -46,9 +49,12 @@ def update_train_state(model, train_state, steps, train_loss, val_loss):
 
     # Loss decreased
     else:
-        # Save the best model
+        # Save the best model (only the adapters, in the low-rank adapter mode)
         train_state['min_val_loss'] = loss_t
-        torch.save(model.state_dict(), train_state['save_path'])
+        if has_lora_adapters(model):
+            save_lora_adapters(model, train_state['save_path'])
+        else:
+            torch.save(model.state_dict(), train_state['save_path'])
 
         # Reset early stopping step
         train_state['early_stopping_step'] = 0
@@ -59,13 +65,22 @@ def update_train_state(model, train_state, steps, train_loss, val_loss):
     return train_state
 
 
-def initialize_training(args, device):
-    """Initialize the tokenizer, the data loaders, the model and other components for the optimization process."""
+def initialize_training(args, device, datasets=None):
+    """
+    Initialize the tokenizer, the data loaders, the model and other components for the optimization process.
+
+    The datasets are created from args.json_paths, unless already tokenized datasets (a tuple of the train and val
+    EpisodeSummaryDataset objects) are given, e.g. shared by the trials of a hyperparameter sweep.
+    """
     # Create tokenizer, datasets and loaders
     tokenizer = EpisodeSummaryTokenizer.from_pretrained(
         args.gpt2_size, max_num_words=args.max_num_words, size_variance_handling=args.size_var_handling
     )
-    train_dataset, val_dataset = create_datasets_from_jsons(args.json_paths, tokenizer, args.val_split)
+    if datasets is None:
+        datasets = create_datasets_from_jsons(
+            args.json_paths, tokenizer, args.val_split, dedup_threshold=args.dedup_threshold
+        )
+    train_dataset, val_dataset = datasets
 
     dataloaders = {
         'train': DataLoader(train_dataset,
@@ -80,32 +95,72 @@ def initialize_training(args, device):
 
     # Load pre-trained network weights
     model = GPT2LMHeadModel.from_pretrained(args.gpt2_size)
+    if args.lora_rank:
+        model = add_lora_adapters(model, args.lora_rank, args.lora_alpha, args.lora_dropout, args.lora_targets)
     model = model.to(device)
 
     # Prepare optimizer and scheduler
+    optimizer, scheduler = initialize_optimizer(model, args)
+    model.zero_grad()
+
+    train_state = make_train_state(save_path=args.model_save_path, early_stopping_patience=args.early_stopping_patience)
+
+    return tokenizer, dataloaders, model, optimizer, scheduler, train_state
+
+
+def initialize_optimizer(model, args):
+    """
+    Create the AdamW optimizer (with weight decay groups) and the linear learning rate scheduler for a model.
+
+    Frozen parameters (e.g. the base weights in the low-rank adapter mode) are left out of the optimizer, so they have
+    no optimizer state.
+    """
     no_decay = ['bias', 'LayerNorm.weight']  # no decay for biases and layer norm
+    named_parameters = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+    if not named_parameters:
+        raise ValueError('The model has no trainable parameters.')
+
     optimizer_grouped_parameters = [
         {
-            'params': [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+            'params': [p for n, p in named_parameters if not any(nd in n for nd in no_decay)],
             'weight_decay': args.weight_decay
         },
         {
-            'params': [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)],
+            'params': [p for n, p in named_parameters if any(nd in n for nd in no_decay)],
             'weight_decay': 0.0
         }
     ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = WarmupLinearSchedule(optimizer, warmup_steps=0, t_total=args.max_steps)
-    model.zero_grad()
 
-    train_state = make_train_state(save_path=args.model_save_path, early_stopping_patience=args.early_stopping_patience)
+    return optimizer, scheduler
 
-    return tokenizer, dataloaders, model, optimizer, scheduler, train_state
 
+def padding_mask(batch, pad_token_id):
+    """
+    Mask of the padding of a batch (see EpisodeSummaryTokenizer.pad_batch_to_same_size).
+
+    Every summary ends with an "<|endoftext|>" token, and the padding is the "<|endoftext|>" tokens after it.
+
+    :param batch: Padded batch (batch x length)
+    :param pad_token_id: Id of the "<|endoftext|>" token
+    :return: Boolean tensor, True at the padding positions
+    """
+    positions = torch.arange(batch.size()[1], device=batch.device)
+    last_text_position = ((batch != pad_token_id).long() * positions).max(dim=1)[0]
+    return positions.unsqueeze(0) > last_text_position.unsqueeze(1) + 1
+
+
+def forward_batch(model, batch, device, pad_token_id=None):
+    """
+    Run a batch of data through a network/model.
 
-def forward_batch(model, batch, device):
-    """Run a batch of data through a network/model."""
+    If pad_token_id is set, the padding is left out of the loss (label -1), i.e. the loss is the mean over the real
+    tokens. Otherwise every token of the padded batch is predicted.
+    """
     inputs, labels = (batch, batch)
+    if pad_token_id is not None:
+        labels = batch.masked_fill(padding_mask(batch, pad_token_id), -1)
     inputs, labels = inputs.to(device), labels.to(device)
 
     outputs = model(inputs, labels=labels)
@@ -113,8 +168,46 @@ def forward_batch(model, batch, device):
     return outputs[:2]
 
 
-def run_training(args):
-    """Run training process."""
+def num_predicted_tokens(batch, pad_token_id=None):
+    """
+    The number of tokens the loss of a batch (see forward_batch) is averaged over: every token except the first one of
+    the sequences, and except the padding if pad_token_id is set.
+    """
+    num_tokens = batch.size()[0] * (batch.size()[1] - 1)
+    if pad_token_id is not None:
+        num_tokens -= padding_mask(batch, pad_token_id).sum().item()
+    return num_tokens
+
+
+def train_step(model, batch, optimizer, scheduler, device, metrics=None, pad_token_id=None):
+    """Run a single optimization step on a batch of data, and return the loss (see forward_batch for pad_token_id)."""
+    phase = metrics.phase if metrics is not None else null_phase
+    optimizer.zero_grad()
+
+    with phase('forward'):
+        loss, logits = forward_batch(model, batch, device, pad_token_id)
+
+    with phase('backward'):
+        loss.backward()
+
+    with phase('optimizer'):
+        optimizer.step()
+        scheduler.step()
+        model.zero_grad()
+
+    return loss
+
+
+def run_training(args, datasets=None, checkpoint_callback=None):
+    """
+    Run training process.
+
+    :param args: Training arguments (see get_arguments)
+    :param datasets: Tuple of already tokenized train and val datasets. None: create them from args.json_paths
+    :param checkpoint_callback: Function called with the train_state at every checkpoint. If it returns True, the
+                                training is stopped (e.g. a losing trial of a hyperparameter sweep is pruned)
+    :return: The final train_state
+    """
     # Set seed
     set_random_seeds(args.random_seed)
 
@@ -122,7 +215,17 @@ def run_training(args):
     print('Device: {}'.format(str(device)))
 
     # Initialize training
-    tokenizer, dataloaders, model, optimizer, scheduler, train_state = initialize_training(args, device)
+    tokenizer, dataloaders, model, optimizer, scheduler, train_state = initialize_training(args, device, datasets)
+
+    # the padding of the batches is left out of the losses
+    pad_token_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
+
+    # Optional per-step instrumentation
+    metrics = None
+    if args.metrics_path:
+        metrics = TrainingMetrics(args.metrics_path, device, pad_token_id, profile_steps=args.profile_steps,
+                                  profile_path=args.profile_path)
+    phase = metrics.phase if metrics is not None else null_phase
 
     # Run training process
     steps = 0
@@ -133,53 +236,68 @@ def run_training(args):
         model.train()
 
         running_train_loss = 0
-        num_train_samples = 0
+        num_train_tokens = 0
         running_val_loss = 0
-        num_val_samples = 0
+        num_val_tokens = 0
 
-        for train_batch in dataloaders['train']:
-            optimizer.zero_grad()
+        train_batches = metrics.timed_batches(dataloaders['train']) if metrics is not None else dataloaders['train']
+        for train_batch in train_batches:
+            loss = train_step(model, train_batch, optimizer, scheduler, device, metrics, pad_token_id)
 
-            loss, logits = forward_batch(model, train_batch, device)
-
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            model.zero_grad()
-
-            running_train_loss += loss.item()
-            num_train_samples += train_batch.size()[0]
+            # the loss is the mean over the predicted tokens of the batch, the running losses are weighted by them
+            train_loss = loss.item()
+            batch_tokens = num_predicted_tokens(train_batch, pad_token_id)
+            running_train_loss += train_loss * batch_tokens
+            num_train_tokens += batch_tokens
 
             steps += 1
 
+            if metrics is not None:
+                metrics.end_step(steps, train_batch, train_loss, optimizer.param_groups[0]['lr'])
+
             # Checkpoint
             if steps > 0 and steps % args.checkpoint_steps == 0:
                 model.eval()
 
-                for val_batch in dataloaders['val']:
-                    loss, logits = forward_batch(model, val_batch, device)
+                with phase('validation'):
+                    for val_batch in dataloaders['val']:
+                        loss, logits = forward_batch(model, val_batch, device, pad_token_id)
 
-                    running_val_loss += loss.item()
-                    num_val_samples += val_batch.size()[0]
+                        batch_tokens = num_predicted_tokens(val_batch, pad_token_id)
+                        running_val_loss += loss.item() * batch_tokens
+                        num_val_tokens += batch_tokens
 
-                train_state = update_train_state(model, train_state, steps,
-                                                 running_train_loss / num_train_samples,
-                                                 running_val_loss / num_val_samples)
+                with phase('save'):
+                    train_state = update_train_state(model, train_state, steps,
+                                                     running_train_loss / num_train_tokens,
+                                                     running_val_loss / num_val_tokens)
 
                 print('\n============== {} / {} =============='.format(steps, args.max_steps))
                 print('train loss: {:.4f} | val loss: {:.4f}'.format(train_state['train_loss'][-1],
                                                                      train_state['val_loss'][-1]))
                 # Generate some samples
-                generated = generate_sequence(
-                    model, tokenizer,
-                    max_length=args.max_gen_len,
-                    num_samples=args.num_samples,
-                    top_k=args.sampling_top_k,
-                    device=device
-                )
-                print('-' * 41)
-                print(*generated, sep='\n')
-                print('-' * 41)
+                if args.num_samples > 0:
+                    with phase('generation'):
+                        generated = generate_sequence(
+                            model, tokenizer,
+                            max_length=args.max_gen_len,
+                            num_samples=args.num_samples,
+                            top_k=args.sampling_top_k,
+                            device=device
+                        )
+                    print('-' * 41)
+                    print(*generated, sep='\n')
+                    print('-' * 41)
+
+                if metrics is not None:
+                    metrics.end_checkpoint(steps, train_state['train_loss'][-1], train_state['val_loss'][-1])
+
+                # Stop the training if the callback says so
+                if checkpoint_callback is not None and checkpoint_callback(train_state):
+                    print('\nTraining stopped by the checkpoint callback (pruned).')
+                    train_state['pruned'] = True
+                    train_state['stop_early'] = True
+                    break
 
                 # Check for early stopping
                 if train_state['stop_early']:
@@ -189,19 +307,25 @@ def run_training(args):
 
                 # Reset sums and set model back to train
                 running_train_loss = 0
-                num_train_samples = 0
+                num_train_tokens = 0
                 running_val_loss = 0
-                num_val_samples = 0
+                num_val_tokens = 0
                 model.train()
 
+            if steps >= args.max_steps:
+                break
 
-def get_arguments():
-    """Collect command line arguments."""
-    parser = argparse.ArgumentParser(
-        description='GPT-2 model training for text generation.',
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
-    # Args related to the data
+    if metrics is not None:
+        metrics.close()
+
+    return train_state
+
+
+def add_data_arguments(parser):
+    """
+    Add the arguments of the data preparation, shared with distill.py: the data split of the student is the same as
+    the one of the teacher if these arguments are the same.
+    """
     parser.add_argument('-s', '--random_seed', type=int, required=False, default=0, help='Random seed.')
     parser.add_argument('-v', '--val_split', type=float, required=False, default=0.1,
                         help='Ratio of the validation subset size compared to all available data.')
@@ -217,6 +341,21 @@ def get_arguments():
                              'It is okay to chop after any word.'
                              ' -"ignore": Ignore size variance and tokenize all text without chopping.'
                              'In this case, max_num_words has no effect.')
+    parser.add_argument('-dt', '--dedup_threshold', type=float, required=False, default=0,
+                        help='Similarity threshold (Jaccard similarity of word 3-grams, estimated with MinHash/LSH) '
+                             'for removing near-duplicate episode summaries, e.g. the same summary from IMDb and '
+                             'Wikipedia. Only the longest summary of every near-duplicate cluster is kept. '
+                             '0: no removal. 0.7 works well for the IMDb + Wikipedia data.')
+
+
+def get_arguments(argv=None):
+    """Collect command line arguments (from argv, or from sys.argv if argv is None)."""
+    parser = argparse.ArgumentParser(
+        description='GPT-2 model training for text generation.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    # Args related to the data
+    add_data_arguments(parser)
     parser.add_argument('-j', '--json_paths', nargs='*', required=False,
                         default=['wiki_episode_summaries.json', 'imdb_episode_summaries.json'],
                         help='Path to the JSON files which contain the episode data (the outputs of the spiders).')
@@ -240,16 +379,47 @@ def get_arguments():
     parser.add_argument('-mp', '--model_save_path', type=str, required=False, default='ep_summary_gen_model.pth',
                         help='Save path for the trained model or checkpoints during training.')
 
+    # low-rank adapter args
+    parser.add_argument('-lk', '--lora_rank', type=int, required=False, default=0,
+                        help='Rank of the low-rank adapters (LoRA). If > 0, the pre-trained weights are frozen, only '
+                             'the adapters of the projections in --lora_targets are trained, and only the adapter '
+                             'weights are saved to --model_save_path. Adapters usually need a higher learning rate '
+                             '(e.g. 1e-4 - 1e-3) than full fine-tuning. 0: full fine-tuning.')
+    parser.add_argument('-la', '--lora_alpha', type=float, required=False, default=16.,
+                        help='Scaling of the low-rank adapters: the adapter outputs are scaled by alpha / rank.')
+    parser.add_argument('-ld', '--lora_dropout', type=float, required=False, default=0.05,
+                        help='Dropout probability of the adapter inputs.')
+    parser.add_argument('-lt', '--lora_targets', nargs='+', type=str, required=False, default=LORA_TARGET_MODULES,
+                        choices=LORA_TARGET_MODULES,
+                        help='Adapted projections: c_attn (attention QKV), c_proj (attention and MLP output), '
+                             'c_fc (MLP input).')
+
+    # instrumentation args
+    parser.add_argument('-mt', '--metrics_path', type=str, required=False, default=None,
+                        help='Path to a JSON Lines file for per-step metrics: the wall time of the training phases '
+                             '(data loading + collate, forward, backward, optimizer step) and the checkpoint phases '
+                             '(validation, saving, sample generation), tokens/sec, padding ratio and peak memory. '
+                             'If not set, the instrumentation is turned off.')
+    parser.add_argument('-ps', '--profile_steps', nargs=2, type=int, required=False, default=None,
+                        metavar=('FIRST', 'LAST'),
+                        help='Trace the training steps FIRST to LAST (1-based) with the autograd profiler. '
+                             'Requires --metrics_path.')
+    parser.add_argument('-pp', '--profile_path', type=str, required=False, default='train_profile.json',
+                        help='Output path of the profiler trace (Chrome trace format, open it in chrome://tracing).')
+
     # sampling args
     parser.add_argument('-ns', '--num_samples', type=int, required=False, default=8,
-                        help='Number of samples generated and displayed at every checkpoint.')
+                        help='Number of samples generated and displayed at every checkpoint. 0: no samples.')
     parser.add_argument('-mg', '--max_gen_len', type=int, required=False, default=135,
                         help='Max length of the generated samples.')
     parser.add_argument('-tk', '--sampling_top_k', type=int, required=False, default=20,
                         help='The number of highest probability vocabulary tokens to keep during top-k-filtering '
                              'in the sample generation. Should be between 1 and inf.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.profile_steps and not args.metrics_path:
+        parser.error('--profile_steps requires --metrics_path.')
+
     return args
 
 
@@ -0,0 +1,323 @@
+import json
+import time
+import hashlib
+from collections import Counter, defaultdict
+from twisted.internet import task
+from scrapy import signals
+from scrapy.http import Request
+from scrapy.exceptions import NotConfigured
+
+# module paths of the extension and the spider middleware, for the EXTENSIONS and SPIDER_MIDDLEWARES settings
+EXTENSION_PATH = 'utils.crawl_metrics.CrawlMetrics'
+MIDDLEWARE_PATH = 'utils.crawl_metrics.CrawlMetricsMiddleware'
+
+
+def crawl_metrics_settings(metrics_path, interval=5.):
+    """
+    Scrapy settings that turn on the crawl instrumentation.
+
+    :param metrics_path: Path to the output JSON report
+    :param interval: Sampling interval of the time series (queue depth, throughput) in seconds
+    :return: Dictionary of settings
+    """
+    return {
+        'EXTENSIONS': {EXTENSION_PATH: 500},
+        # close to the spider, so the timings only contain the callbacks
+        'SPIDER_MIDDLEWARES': {MIDDLEWARE_PATH: 950},
+        'CRAWL_METRICS_PATH': metrics_path,
+        'CRAWL_METRICS_INTERVAL': interval
+    }
+
+
+def _new_callback_stats():
+    return {'responses': 0, 'response_bytes': 0, 'download_seconds': 0., 'max_download_seconds': 0.,
+            'calls': 0, 'seconds': 0., 'max_seconds': 0., 'items': 0, 'requests': 0, 'errors': 0}
+
+
+class CrawlMetrics:
+    """
+    Scrapy extension for the throughput and latency instrumentation of a crawl.
+
+    Records, per callback of the spider (the robots.txt downloads separately):
+    - the number of responses, their bytes and their download latency
+    - the run time of the callback, and the number of items and requests it yielded (e.g. the links followed by the
+      rules of a CrawlSpider: the callback time of a CrawlSpider also contains the link extraction of its rules)
+    and for the whole crawl: the scheduled requests and the ones dropped by the scheduler (duplicates), the responses
+    per crawl depth, the scraped, dropped and duplicate items (the same "episode_summary", or the same item if it has
+    no such field), and a time series of the throughput and of the scheduler queue depth. The report is written to a
+    JSON file at the end of the crawl, together with the Scrapy stats (retries, response codes, offsite and robots.txt
+    filtering, ...).
+
+    Enabled with the CRAWL_METRICS_PATH setting (see crawl_metrics_settings), the callback timings need the
+    CrawlMetricsMiddleware spider middleware.
+    """
+
+    def __init__(self, crawler, metrics_path, interval):
+        """
+        Initialize the CrawlMetrics object.
+
+        :param crawler: Scrapy crawler
+        :param metrics_path: Path to the output JSON report
+        :param interval: Sampling interval of the time series in seconds
+        """
+        self.crawler = crawler
+        self.metrics_path = metrics_path
+        self.interval = interval
+
+        self.callbacks = defaultdict(_new_callback_stats)
+        self.depths = Counter()
+        self.counts = Counter()
+        self.drop_reasons = Counter()
+        self.item_fingerprints = set()
+        self.time_series = []
+        self.start_time = None
+        self._sampler = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics_path = crawler.settings.get('CRAWL_METRICS_PATH')
+        if not metrics_path:
+            raise NotConfigured
+
+        extension = cls(crawler, metrics_path, crawler.settings.getfloat('CRAWL_METRICS_INTERVAL', 5.))
+        # the spider middleware reports the callback timings to the extension
+        crawler.crawl_metrics = extension
+
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(extension.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(extension.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(extension.item_error, signal=signals.item_error)
+        return extension
+
+    @staticmethod
+    def callback_name(request, spider):
+        """Name of the spider callback of a request (the rule callback for the links of a CrawlSpider)."""
+        if request.url.endswith('/robots.txt'):
+            return 'robots.txt'
+
+        rule_idx = request.meta.get('rule')
+        if rule_idx is not None and hasattr(spider, '_rules'):
+            callback = spider._rules[rule_idx].callback
+        else:
+            callback = request.callback if callable(request.callback) else spider.parse
+
+        return getattr(callback, '__name__', str(callback))
+
+    def spider_opened(self, spider):
+        self.start_time = time.perf_counter()
+        self._sampler = task.LoopingCall(self._sample)
+        self._sampler.start(self.interval, now=True)
+
+    def request_scheduled(self, request, spider):
+        self.counts['requests_scheduled'] += 1
+
+    def request_dropped(self, request, spider):
+        # rejected by the scheduler, i.e. filtered as a duplicate request
+        self.counts['requests_dropped'] += 1
+
+    def response_received(self, response, request, spider):
+        callback_stats = self.callbacks[self.callback_name(request, spider)]
+        download_seconds = request.meta.get('download_latency', 0.)
+        callback_stats['responses'] += 1
+        callback_stats['response_bytes'] += len(response.body)
+        callback_stats['download_seconds'] += download_seconds
+        callback_stats['max_download_seconds'] = max(callback_stats['max_download_seconds'], download_seconds)
+
+        self.counts['responses'] += 1
+        self.counts['response_bytes'] += len(response.body)
+        self.depths[request.meta.get('depth', 0)] += 1
+
+    def item_scraped(self, item, response, spider):
+        self.counts['items_scraped'] += 1
+
+        content = item.get('episode_summary', None) if hasattr(item, 'get') else None
+        if content is None:
+            content = json.dumps(dict(item), sort_keys=True, default=str)
+        fingerprint = hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+        if fingerprint in self.item_fingerprints:
+            self.counts['duplicate_items'] += 1
+        self.item_fingerprints.add(fingerprint)
+
+    def item_dropped(self, item, response, exception, spider):
+        self.counts['items_dropped'] += 1
+        self.drop_reasons[str(exception)] += 1
+
+    def item_error(self, item, response, spider, failure):
+        self.counts['item_errors'] += 1
+
+    def record_callback(self, name, seconds, output=None, error=False):
+        """Record a step of a callback (the production of one output): its run time and the type of the output."""
+        callback_stats = self.callbacks[name]
+        callback_stats['seconds'] += seconds
+        if isinstance(output, Request):
+            callback_stats['requests'] += 1
+        elif output is not None:
+            callback_stats['items'] += 1
+        if error:
+            callback_stats['errors'] += 1
+
+    def record_callback_call(self, name, seconds):
+        """Record a finished callback call with its total run time."""
+        callback_stats = self.callbacks[name]
+        callback_stats['calls'] += 1
+        callback_stats['max_seconds'] = max(callback_stats['max_seconds'], seconds)
+
+    def _queue_depth(self):
+        """Number of requests waiting in the scheduler, and the number of requests being downloaded."""
+        engine = self.crawler.engine
+        # the engine slot was renamed in Scrapy 2.6
+        slot = getattr(engine, '_slot', None) or getattr(engine, 'slot', None)
+        scheduler_size = len(slot.scheduler) if slot is not None and slot.scheduler is not None else None
+        return scheduler_size, len(engine.downloader.active)
+
+    def _sample(self):
+        """Add a point to the time series."""
+        elapsed = time.perf_counter() - self.start_time
+        scheduler_size, in_progress = self._queue_depth()
+        previous = self.time_series[-1] if self.time_series else {'seconds': 0., 'responses': 0}
+        period = elapsed - previous['seconds']
+
+        self.time_series.append({
+            'seconds': elapsed,
+            'requests_scheduled': self.counts['requests_scheduled'],
+            'responses': self.counts['responses'],
+            'response_bytes': self.counts['response_bytes'],
+            'items_scraped': self.counts['items_scraped'],
+            'scheduler_queue': scheduler_size,
+            'in_progress': in_progress,
+            'responses_per_sec': (self.counts['responses'] - previous['responses']) / period if period > 0 else 0.
+        })
+
+    def spider_closed(self, spider, reason):
+        if self._sampler is not None and self._sampler.running:
+            self._sampler.stop()
+        self._sample()
+        report = self.create_report(spider, reason)
+
+        with open(self.metrics_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.log_summary(spider, report)
+
+    def create_report(self, spider, reason):
+        """Collect the report of the crawl."""
+        seconds = time.perf_counter() - self.start_time
+        totals = {name: self.counts[name] for name in ['requests_scheduled', 'requests_dropped', 'responses',
+                                                       'response_bytes', 'items_scraped', 'items_dropped',
+                                                       'item_errors', 'duplicate_items']}
+        totals.update(
+            requests_per_sec=totals['responses'] / seconds,
+            items_per_sec=totals['items_scraped'] / seconds,
+            bytes_per_sec=totals['response_bytes'] / seconds,
+            retries=self.crawler.stats.get_value('retry/count', 0)
+        )
+
+        callbacks = {}
+        for name, callback_stats in self.callbacks.items():
+            callbacks[name] = dict(callback_stats)
+            callbacks[name]['mean_download_seconds'] = callback_stats['download_seconds'] / max(
+                callback_stats['responses'], 1)
+            callbacks[name]['mean_seconds'] = callback_stats['seconds'] / max(callback_stats['calls'], 1)
+
+        return {
+            'spider': spider.name,
+            'finish_reason': reason,
+            'seconds': seconds,
+            'totals': totals,
+            'callbacks': callbacks,
+            'responses_per_depth': {str(depth): count for depth, count in sorted(self.depths.items())},
+            'drop_reasons': dict(self.drop_reasons),
+            'time_series': self.time_series,
+            'scrapy_stats': {key: value if isinstance(value, (int, float, str)) else str(value)
+                             for key, value in self.crawler.stats.get_stats().items()}
+        }
+
+    def log_summary(self, spider, report):
+        """Log a table of the callbacks and the totals of the crawl."""
+        lines = ['Crawl metrics (saved to {}):'.format(self.metrics_path),
+                 '{:<28}{:>10}{:>12}{:>16}{:>10}{:>16}{:>8}{:>10}'.format(
+                     'callback', 'responses', 'MB', 'mean download s', 'calls', 'mean callback s', 'items',
+                     'requests')]
+        for name, stats in sorted(report['callbacks'].items()):
+            lines.append('{:<28}{:>10}{:>12.2f}{:>16.3f}{:>10}{:>16.4f}{:>8}{:>10}'.format(
+                name, stats['responses'], stats['response_bytes'] / 2 ** 20, stats['mean_download_seconds'],
+                stats['calls'], stats['mean_seconds'], stats['items'], stats['requests']
+            ))
+        lines.append('{:.1f} s, {requests_per_sec:.2f} requests/sec, {items_per_sec:.2f} items/sec, '
+                     '{requests_dropped} duplicate requests, {items_dropped} dropped and {duplicate_items} duplicate '
+                     'items, {retries} retries'.format(report['seconds'], **report['totals']))
+        spider.logger.info('\n'.join(lines))
+
+
+class CrawlMetricsMiddleware:
+    """Spider middleware that times the callbacks of the spider for the CrawlMetrics extension."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics = getattr(crawler, 'crawl_metrics', None)
+        if metrics is None:
+            raise NotConfigured
+        return cls(metrics)
+
+    def process_spider_output(self, response, result, spider):
+        """Time the production of every output of the callback (the callbacks are lazy generators)."""
+        name = self.metrics.callback_name(response.request, spider)
+        iterator = iter(result)
+        call_seconds = 0.
+
+        while True:
+            start = time.perf_counter()
+            try:
+                output = next(iterator)
+            except StopIteration:
+                seconds = time.perf_counter() - start
+                self.metrics.record_callback(name, seconds)
+                call_seconds += seconds
+                break
+            except Exception:
+                seconds = time.perf_counter() - start
+                self.metrics.record_callback(name, seconds, error=True)
+                self.metrics.record_callback_call(name, call_seconds + seconds)
+                raise
+
+            seconds = time.perf_counter() - start
+            self.metrics.record_callback(name, seconds, output)
+            call_seconds += seconds
+            yield output
+
+        self.metrics.record_callback_call(name, call_seconds)
+
+    async def process_spider_output_async(self, response, result, spider):
+        """Time the production of every output of an asynchronous callback (Scrapy 2.7+)."""
+        name = self.metrics.callback_name(response.request, spider)
+        iterator = result.__aiter__()
+        call_seconds = 0.
+
+        while True:
+            start = time.perf_counter()
+            try:
+                output = await iterator.__anext__()
+            except StopAsyncIteration:
+                seconds = time.perf_counter() - start
+                self.metrics.record_callback(name, seconds)
+                call_seconds += seconds
+                break
+            except Exception:
+                seconds = time.perf_counter() - start
+                self.metrics.record_callback(name, seconds, error=True)
+                self.metrics.record_callback_call(name, call_seconds + seconds)
+                raise
+
+            seconds = time.perf_counter() - start
+            self.metrics.record_callback(name, seconds, output)
+            call_seconds += seconds
+            yield output
+
+        self.metrics.record_callback_call(name, call_seconds)
@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import hashlib
+
+# leaf URLs are revisited after 30 days by default, so the edits of the skipped pages are eventually collected
+DEFAULT_MAX_LEAF_AGE = 30 * 86400
+
+
+class CrawlState:
+    """
+    Persistent state of a crawl, used for incremental re-crawling.
+
+    The state is stored in a JSON file and keeps track of:
+    - items: the content fingerprints of the current version of the episodes, grouped by their source URL and episode
+             title. Only new or changed episodes have to be emitted during a re-crawl.
+    - leaf_urls: visited URLs (+ the time of the visit) that do not have to be requested again, e.g. IMDb episode
+                 pages whose plot summaries were already collected. Leaf URLs older than max_leaf_age are revisited.
+    - crawl_id: the number of the crawl. The emitted items are tagged with it, so the items of a changed episode
+                supersede the ones of the previous crawls in the output (see utils.data.load_episode_data).
+    """
+
+    def __init__(self, state_path, max_leaf_age=None):
+        """Initialize the CrawlState object.
+
+        :param state_path: Path to the JSON state file. It is loaded, if it already exists
+        :param max_leaf_age: Leaf URLs visited more than max_leaf_age seconds ago are requested again. None: never
+        """
+        self.state_path = state_path
+        self.max_leaf_age = max_leaf_age
+        self.items = {}
+        self.leaf_urls = {}
+        self.crawl_id = 0
+
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+
+            self.items = {url: {ep_title: set(fingerprints) for ep_title, fingerprints in page_items.items()}
+                          for url, page_items in state['items'].items()}
+            self.leaf_urls = state['leaf_urls']
+            self.crawl_id = state.get('crawl_id', -1) + 1
+
+    @staticmethod
+    def fingerprint(ep_data):
+        """Create a content fingerprint for an episode data item."""
+        return hashlib.sha1(ep_data['episode_summary'].encode('utf-8')).hexdigest()
+
+    def is_leaf(self, url):
+        """Decide, if a URL was already visited and it is recent enough to skip it."""
+        visit_time = self.leaf_urls.get(url)
+
+        if visit_time is None:
+            return False
+
+        return self.max_leaf_age is None or time.time() - visit_time <= self.max_leaf_age
+
+    def mark_leaf(self, url):
+        """Mark a URL as a visited leaf."""
+        self.leaf_urls[url] = time.time()
+
+    def check_episode(self, ep_datas):
+        """
+        Compare the items of an episode (all of its summaries from a page) to the state, and register them as the
+        current version of the episode. The items of a new or changed episode are tagged with the crawl_id.
+
+        :param ep_datas: List of episode data dictionaries with the same source URL and episode title
+        :return: 'new' if the episode was not collected in the previous crawls,
+                 'changed' if it was, but with different summaries,
+                 None if the episode is unchanged
+        """
+        page_items = self.items.setdefault(ep_datas[0]['source_url'], {})
+        previous_fingerprints = page_items.get(ep_datas[0]['episode_title'])
+        fingerprints = {self.fingerprint(ep_data) for ep_data in ep_datas}
+
+        if fingerprints == previous_fingerprints:
+            return None
+
+        # the previous version is replaced, so the stale summaries are not kept in the state
+        page_items[ep_datas[0]['episode_title']] = fingerprints
+        for ep_data in ep_datas:
+            ep_data['crawl_id'] = self.crawl_id
+
+        return 'new' if previous_fingerprints is None else 'changed'
+
+    def save(self):
+        """Write the state to the disk."""
+        state = {
+            'items': {url: {ep_title: sorted(fingerprints) for ep_title, fingerprints in page_items.items()}
+                      for url, page_items in self.items.items()},
+            'leaf_urls': self.leaf_urls,
+            'crawl_id': self.crawl_id
+        }
+
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f)
+
+
+def convert_json_output(output_path):
+    """
+    Convert the JSON list output of a full crawl to JSON Lines, so the items of the incremental crawls can be appended
+    to it.
+
+    :param output_path: Path to the output file of a spider
+    :return: True if the file was converted, False if it does not exist or it is already in JSON Lines format
+    """
+    if not os.path.exists(output_path):
+        return False
+
+    with open(output_path, 'r') as f:
+        content = f.read()
+
+    if not content.lstrip().startswith('['):
+        return False
+
+    items = json.loads(content)
+    with open(output_path, 'w') as f:
+        for item in items:
+            f.write(json.dumps(item) + '\n')
+
+    return True
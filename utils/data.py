@@ -3,6 +3,7 @@ import torch
 import json
 from torch.utils.data import Dataset
 from pytorch_transformers import GPT2Tokenizer
+from utils.dedup import remove_near_duplicates
 
 
 class EpisodeSummaryTokenizer(GPT2Tokenizer):
@@ -36,7 +37,7 @@ class EpisodeSummaryTokenizer(GPT2Tokenizer):
         self._look_up_dict = {
             'chop_at_sentence_end': self._chop_text_at_sentence_end,
             'chop': self._chop_text,
-            'ignore': lambda x: x
+            'ignore': self._keep_text
         }
         self.size_var_handling_fnc = self._look_up_dict[size_variance_handling]
 
@@ -138,6 +139,11 @@ class EpisodeSummaryTokenizer(GPT2Tokenizer):
 
         return " ".join(words[:self.max_num_words])
 
+    @staticmethod
+    def _keep_text(text):
+        """Keep a text as it is (no lambda here, so the tokenizer can be pickled, e.g. for worker processes)."""
+        return text
+
     def pad_batch_to_same_size(self, batch):
         """
         Given a batch of tokenized text (lists of integers), pad them to the same size.
@@ -169,7 +175,7 @@ class EpisodeSummaryDataset(Dataset):
         :param episode_summaries: List of tokenized episode summaries
         """
         self.episode_summaries = episode_summaries
-        self._max_seq_size = len(max(episode_summaries, key=len))
+        self._max_seq_size = len(max(episode_summaries, key=len, default=[]))
 
     def __len__(self):
         return len(self.episode_summaries)
@@ -178,37 +184,83 @@ class EpisodeSummaryDataset(Dataset):
         return self.episode_summaries[idx]
 
 
-def create_datasets_from_jsons(json_file_paths, tokenizer, val_split_ratio):
+def load_episode_data(json_file_path):
+    """
+    Load the episode data from the output of a spider.
+
+    Full crawls produce a JSON list, incremental crawls append items to a JSON Lines file. Both formats are handled,
+    and a JSON list followed by JSON Lines too. The incremental crawls yield every summary of a new or changed episode
+    tagged with the crawl_id, so only the items of the latest crawl of every episode are kept (untagged items: oldest).
+
+    :param json_file_path: JSON or JSON Lines file path
+    :return: List of episode data dictionaries
+    """
+    with open(json_file_path, "r") as f:
+        content = f.read().strip()
+
+    episode_data = []
+    if content.startswith('['):
+        episode_data, end = json.JSONDecoder().raw_decode(content)
+        content = content[end:]
+
+    episode_data += [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    def episode_key(ep_data):
+        return ep_data.get('source_url'), ep_data.get('episode_title')
+
+    latest_crawl_ids = {}
+    for ep_data in episode_data:
+        key = episode_key(ep_data)
+        latest_crawl_ids[key] = max(latest_crawl_ids.get(key, -1), ep_data.get('crawl_id', -1))
+
+    return [ep_data for ep_data in episode_data
+            if ep_data.get('crawl_id', -1) == latest_crawl_ids[episode_key(ep_data)]]
+
+
+def create_datasets_from_jsons(json_file_paths, tokenizer, val_split_ratio, dedup_threshold=None):
     """
     Parse the data from a list of JSON files, and create EpisodeSummaryDataset objects for train/validation.
 
+    Near-duplicate summaries (e.g. the same summary scraped from IMDb and Wikipedia) are removed before the
+    train/validation split, so the validation subset does not leak into the training subset.
+
     :param json_file_paths: List of JSON file paths
     :param tokenizer: Tokenizer object
     :param val_split_ratio: The ratio between the size of our full dataset and the validation subset
+    :param dedup_threshold: Jaccard similarity threshold for the near-duplicate removal. None or 0: no removal
     :return: Tuple of EpisodeSummaryDataset objects (train and val datasets)
     """
     print('Creating datasets:')
     episode_summaries = []
     for json_file_path in json_file_paths:
-        with open(json_file_path, "r") as f:
-            json_data = json.load(f)
-
-        for ep_data in json_data:
+        for ep_data in load_episode_data(json_file_path):
             episode_summaries.append(ep_data['episode_summary'])
 
     episode_summaries.sort()
 
     tokenized_summaries = []
+    vectorized_summaries = []
     for ep_sum in episode_summaries:
         tokenized_summary = tokenizer.preprocess_text(ep_sum)
 
         if tokenized_summary:
             tokenized_summaries.append(tokenized_summary)
+            vectorized_summaries.append(ep_sum)
 
     print('  Dropped {}/{} episode summaries during vectorization.'.format(
         len(episode_summaries) - len(tokenized_summaries), len(episode_summaries)
     ))
 
+    if dedup_threshold:
+        to_keep, clusters = remove_near_duplicates(vectorized_summaries, dedup_threshold)
+        num_tokens = sum(len(tokenized_summary) for tokenized_summary in tokenized_summaries)
+        tokenized_summaries = [tokenized_summaries[idx] for idx in to_keep]
+
+        print('  Removed {}/{} near-duplicate episode summaries in {} clusters ({}/{} tokens saved).'.format(
+            len(vectorized_summaries) - len(to_keep), len(vectorized_summaries), len(clusters),
+            num_tokens - sum(len(tokenized_summary) for tokenized_summary in tokenized_summaries), num_tokens
+        ))
+
     random.shuffle(tokenized_summaries)
 
     # break up episode summaries into train and val subsets
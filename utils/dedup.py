@@ -0,0 +1,128 @@
+import re
+import zlib
+import numpy as np
+from collections import defaultdict
+
+# a prime slightly below 2^32, so (a * hash + b) fits into 64 bits for 32 bit shingle hashes
+_MINHASH_PRIME = np.uint64(4294967291)
+
+
+def _shingle_hashes(text, shingle_size):
+    """Hash the word n-grams (shingles) of a normalized text into 32 bit integers."""
+    words = re.findall(r'\w+', text.lower())
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))}
+
+    return np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+
+
+def _choose_bands(num_perm, threshold):
+    """
+    Choose the number of LSH bands and rows per band for a similarity threshold.
+
+    Two signatures become candidates if they are identical in at least one band, the probability of this is
+    1 - (1 - s^rows)^bands for a Jaccard similarity s. The S-curve is the steepest around (1 / bands)^(1 / rows),
+    so we pick the split that puts this point the closest to the threshold.
+
+    :return: Tuple of (bands, rows)
+    """
+    splits = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+
+def minhash_signatures(texts, num_perm=128, shingle_size=3, seed=1):
+    """
+    Compute the MinHash signatures of a list of texts.
+
+    :param texts: List of strings
+    :param num_perm: Number of hash permutations (signature length)
+    :param shingle_size: Number of words in a shingle
+    :param seed: Seed for the hash permutations. Independent from the global random state
+    :return: Numpy array of signatures (number of texts x num_perm)
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, int(_MINHASH_PRIME), size=num_perm).astype(np.uint64)
+    b = rng.randint(0, int(_MINHASH_PRIME), size=num_perm).astype(np.uint64)
+
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        hashes = _shingle_hashes(text, shingle_size)
+        signatures[i] = ((np.outer(hashes, a) + b) % _MINHASH_PRIME).min(axis=0)
+
+    return signatures
+
+
+def find_near_duplicate_clusters(texts, threshold, num_perm=128, shingle_size=3):
+    """
+    Find clusters of near-duplicate texts with MinHash and locality-sensitive hashing.
+
+    Texts are bucketed by the bands of their signatures, so only texts sharing a bucket are compared, instead of all
+    the possible pairs. Every text of a bucket is compared to one kept member of every cluster found in the bucket so
+    far, and pairs with an estimated Jaccard similarity >= threshold are merged into the same cluster.
+
+    :param texts: List of strings
+    :param threshold: Jaccard similarity threshold of the shingle sets, between 0 and 1
+    :param num_perm: Number of hash permutations (signature length)
+    :param shingle_size: Number of words in a shingle
+    :return: List of clusters (lists of text indexes) with at least 2 members
+    """
+    signatures = minhash_signatures(texts, num_perm, shingle_size)
+    bands, rows = _choose_bands(num_perm, threshold)
+
+    # union-find over the text indexes
+    parents = list(range(len(texts)))
+
+    def find(idx):
+        while parents[idx] != idx:
+            parents[idx] = parents[parents[idx]]
+            idx = parents[idx]
+        return idx
+
+    for band in range(bands):
+        buckets = defaultdict(list)
+        band_signatures = signatures[:, band * rows:(band + 1) * rows]
+        for idx in range(len(texts)):
+            buckets[band_signatures[idx].tobytes()].append(idx)
+
+        for bucket in buckets.values():
+            # a kept member of every cluster of the bucket, texts not similar to any of them start a new cluster
+            kept = [bucket[0]]
+            for idx in bucket[1:]:
+                merged = False
+                for other in kept:
+                    root_other, root_idx = find(other), find(idx)
+                    if root_other == root_idx:
+                        merged = True
+                        continue
+
+                    if np.mean(signatures[other] == signatures[idx]) >= threshold:
+                        parents[root_idx] = root_other
+                        merged = True
+
+                if not merged:
+                    kept.append(idx)
+
+    clusters = defaultdict(list)
+    for idx in range(len(texts)):
+        clusters[find(idx)].append(idx)
+
+    return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+
+def remove_near_duplicates(texts, threshold, num_perm=128, shingle_size=3):
+    """
+    Keep a single text from every cluster of near-duplicates: the longest one, which usually holds the most details.
+
+    :param texts: List of strings
+    :param threshold: Jaccard similarity threshold of the shingle sets, between 0 and 1
+    :param num_perm: Number of hash permutations (signature length)
+    :param shingle_size: Number of words in a shingle
+    :return: Tuple of (sorted list of the indexes to keep, list of near-duplicate clusters)
+    """
+    clusters = find_near_duplicate_clusters(texts, threshold, num_perm, shingle_size)
+
+    to_drop = set()
+    for cluster in clusters:
+        to_keep = max(cluster, key=lambda idx: (len(texts[idx]), -idx))
+        to_drop.update(idx for idx in cluster if idx != to_keep)
+
+    return [idx for idx in range(len(texts)) if idx not in to_drop], clusters
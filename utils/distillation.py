@@ -0,0 +1,256 @@
+import os
+import time
+import hashlib
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.data import Dataset
+from utils.gen_utils import generate_sequence
+from utils.scoring import inference_mode, make_length_sorted_batches
+
+
+def teacher_cache_fingerprint(teacher_name, top_k, datasets):
+    """
+    Fingerprint of the teacher outputs of a set of datasets: the teacher name, top_k and the token ids of every summary.
+
+    :param teacher_name: String identifying the teacher weights, e.g. the GPT-2 size and the content hash of the weights
+                         files (see utils.file_fingerprint.files_fingerprint)
+    :param top_k: Number of the kept teacher log-probabilities per token
+    :param datasets: Dictionary of EpisodeSummaryDataset objects
+    :return: Hex digest
+    """
+    digest = hashlib.sha1('{}|{}'.format(teacher_name, top_k).encode('utf-8'))
+    for name in sorted(datasets):
+        digest.update(name.encode('utf-8'))
+        for tokenized_summary in datasets[name].episode_summaries:
+            digest.update(torch.tensor(tokenized_summary, dtype=torch.int32).numpy().tobytes())
+            digest.update(b'|')
+
+    return digest.hexdigest()
+
+
+def compute_teacher_top_k(teacher, token_ids_list, pad_token_id, top_k, batch_size=8, max_batch_tokens=4096,
+                          device='cpu'):
+    """
+    Run the teacher over tokenized texts, and keep the top_k log-probabilities of the next token at every position.
+
+    The top-k outputs of all the texts are concatenated: the rows offsets[i]:offsets[i + 1] belong to the i-th text,
+    and the j-th of these rows is the prediction for its (j + 1)-th token. The log-probabilities are normalized over
+    the full vocabulary and stored in float16, the token ids in int32, so the cache takes 6 * top_k bytes per token.
+
+    :param teacher: Model with LM head
+    :param token_ids_list: List of tokenized texts (lists of integers)
+    :param pad_token_id: Id of the padding token
+    :param top_k: Number of the kept log-probabilities per token
+    :param batch_size: Maximum number of sequences per forward pass
+    :param max_batch_tokens: Maximum number of (padded) tokens per forward pass
+    :param device: 'cuda' or 'cpu'
+    :return: Dictionary with the offsets, log_probs (num tokens x top_k) and token_ids (num tokens x top_k) tensors
+    """
+    lengths = [len(token_ids) - 1 for token_ids in token_ids_list]
+    offsets = torch.zeros(len(lengths) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.tensor(lengths, dtype=torch.long), dim=0)
+    log_probs = torch.zeros(offsets[-1].item(), top_k, dtype=torch.float16)
+    token_ids = torch.zeros(offsets[-1].item(), top_k, dtype=torch.int32)
+
+    teacher.eval()
+    with inference_mode():
+        for batch_idxs in make_length_sorted_batches(lengths, batch_size, max_batch_tokens):
+            max_len = len(token_ids_list[batch_idxs[0]])
+            inputs = torch.tensor(
+                [token_ids_list[idx] + [pad_token_id] * (max_len - len(token_ids_list[idx])) for idx in batch_idxs],
+                dtype=torch.long, device=device
+            )
+            top_log_probs, top_ids = torch.topk(F.log_softmax(teacher(inputs)[0][:, :-1].float(), dim=-1), top_k)
+
+            for row, idx in enumerate(batch_idxs):
+                start, end = offsets[idx].item(), offsets[idx + 1].item()
+                log_probs[start:end] = top_log_probs[row, :end - start].cpu().half()
+                token_ids[start:end] = top_ids[row, :end - start].cpu().int()
+
+    return {'offsets': offsets, 'log_probs': log_probs, 'token_ids': token_ids}
+
+
+def load_or_compute_teacher_cache(teacher, teacher_name, datasets, cache_path, pad_token_id, top_k, batch_size=8,
+                                  max_batch_tokens=4096, device='cpu'):
+    """
+    Load the cached top-k teacher outputs of the datasets, or compute and save them if the cache is missing or stale.
+
+    :param teacher: Model with LM head
+    :param teacher_name: String identifying the teacher weights (part of the cache fingerprint), e.g. the GPT-2 size
+                         and the content hash of the weights files
+    :param datasets: Dictionary of EpisodeSummaryDataset objects, e.g. {'train': ..., 'val': ...}
+    :param cache_path: Path of the cache file. None: no cache file
+    :param pad_token_id: Id of the padding token
+    :param top_k: Number of the kept log-probabilities per token
+    :param batch_size: Maximum number of sequences per forward pass
+    :param max_batch_tokens: Maximum number of (padded) tokens per forward pass
+    :param device: 'cuda' or 'cpu'
+    :return: Dictionary of the teacher outputs of every dataset (see compute_teacher_top_k)
+    """
+    fingerprint = teacher_cache_fingerprint(teacher_name, top_k, datasets)
+    if cache_path and os.path.exists(cache_path):
+        cache = torch.load(cache_path)
+        if cache['fingerprint'] == fingerprint:
+            print('Loaded the teacher outputs from {}.'.format(cache_path))
+            return cache['teacher_outputs']
+        print('The teacher cache {} belongs to other data or another teacher, recomputing it.'.format(cache_path))
+
+    start = time.perf_counter()
+    teacher_outputs = {
+        name: compute_teacher_top_k(teacher, dataset.episode_summaries, pad_token_id, top_k, batch_size,
+                                    max_batch_tokens, device)
+        for name, dataset in datasets.items()
+    }
+    print('Computed the teacher outputs in {:.1f} seconds.'.format(time.perf_counter() - start))
+
+    if cache_path:
+        torch.save({'fingerprint': fingerprint, 'teacher_outputs': teacher_outputs}, cache_path)
+        print('Saved the teacher outputs to {} ({:.1f} MB).'.format(cache_path, os.path.getsize(cache_path) / 2 ** 20))
+
+    return teacher_outputs
+
+
+class DistillationDataset(Dataset):
+    """Episode summaries together with the top-k teacher outputs of their tokens."""
+
+    def __init__(self, episode_summaries, teacher_outputs):
+        """Initialize the DistillationDataset object.
+
+        :param episode_summaries: List of tokenized episode summaries
+        :param teacher_outputs: Top-k teacher outputs of the summaries (see compute_teacher_top_k)
+        """
+        self.episode_summaries = episode_summaries
+        self.teacher_outputs = teacher_outputs
+
+    def __len__(self):
+        return len(self.episode_summaries)
+
+    def __getitem__(self, idx):
+        start, end = self.teacher_outputs['offsets'][idx].item(), self.teacher_outputs['offsets'][idx + 1].item()
+        return (self.episode_summaries[idx],
+                self.teacher_outputs['log_probs'][start:end],
+                self.teacher_outputs['token_ids'][start:end])
+
+
+def pad_distillation_batch(batch, pad_token_id):
+    """
+    Pad a batch of DistillationDataset items to the same size.
+
+    :param batch: List of (token ids, teacher log-probs, teacher token ids) tuples
+    :param pad_token_id: Id of the padding token
+    :return: Tuple of the inputs (batch x length), the teacher log-probs and token ids (batch x length - 1 x top_k),
+             and the mask of the real (not padding) targets (batch x length - 1)
+    """
+    max_len = len(max(batch, key=lambda item: len(item[0]))[0])
+    top_k = batch[0][1].size(-1)
+
+    inputs = torch.full((len(batch), max_len), pad_token_id, dtype=torch.long)
+    teacher_log_probs = torch.zeros(len(batch), max_len - 1, top_k)
+    teacher_token_ids = torch.zeros(len(batch), max_len - 1, top_k, dtype=torch.long)
+    mask = torch.zeros(len(batch), max_len - 1, dtype=torch.bool)
+
+    for row, (token_ids, log_probs, top_ids) in enumerate(batch):
+        inputs[row, :len(token_ids)] = torch.tensor(token_ids, dtype=torch.long)
+        teacher_log_probs[row, :len(log_probs)] = log_probs.float()
+        teacher_token_ids[row, :len(top_ids)] = top_ids.long()
+        mask[row, :len(log_probs)] = True
+
+    return inputs, teacher_log_probs, teacher_token_ids, mask
+
+
+def _log_rest_mass(top_log_probs):
+    """Log of the probability mass outside of the top-k tokens, from the top-k log-probs."""
+    return torch.log1p(-torch.logsumexp(top_log_probs, dim=-1).exp().clamp(max=1 - 1e-6))
+
+
+def distillation_loss(logits, inputs, teacher_log_probs, teacher_token_ids, mask, temperature=2., alpha=0.5):
+    """
+    Compute the distillation loss of a batch: a mix of the soft loss on the teacher outputs and the hard loss on the
+    real next tokens, both averaged over the real (not padding) tokens.
+
+    Only the top-k teacher log-probs are known, so the soft loss compares the teacher and the student over k + 1
+    classes: the top-k tokens of the teacher, and the rest of the vocabulary as one class. Without the rest class, the
+    student would learn to give zero probability to every token outside of the top-k of the teacher. The soft loss is
+    the cross-entropy of the two distributions softened with the temperature, scaled by temperature ** 2, so its
+    gradients keep the same magnitude for any temperature (Hinton et al., 2015).
+
+    :param logits: Student logits (batch x length x vocabulary size)
+    :param inputs: Input token ids (batch x length)
+    :param teacher_log_probs: Top-k teacher log-probs (batch x length - 1 x top_k)
+    :param teacher_token_ids: Token ids of the top-k teacher log-probs (batch x length - 1 x top_k)
+    :param mask: Mask of the real targets (batch x length - 1)
+    :param temperature: Softmax temperature of the soft loss
+    :param alpha: Weight of the soft loss, the hard loss has the weight 1 - alpha
+    :return: Tuple of the loss, the soft loss and the hard loss
+    """
+    logits = logits[:, :-1]
+    num_tokens = mask.sum().clamp(min=1)
+    student_log_probs = F.log_softmax(logits, dim=-1)
+
+    teacher_classes = torch.cat([teacher_log_probs, _log_rest_mass(teacher_log_probs).unsqueeze(-1)], dim=-1)
+    student_top_log_probs = student_log_probs.gather(-1, teacher_token_ids)
+    student_classes = torch.cat([student_top_log_probs, _log_rest_mass(student_top_log_probs).unsqueeze(-1)], dim=-1)
+
+    teacher_probs = F.softmax(teacher_classes / temperature, dim=-1)
+    soft_loss = -(teacher_probs * F.log_softmax(student_classes / temperature, dim=-1)).sum(-1)
+    soft_loss = soft_loss.masked_fill(~mask, 0.).sum() / num_tokens * temperature ** 2
+
+    hard_loss = -student_log_probs.gather(-1, inputs[:, 1:].unsqueeze(-1)).squeeze(-1)
+    hard_loss = hard_loss.masked_fill(~mask, 0.).sum() / num_tokens
+
+    return alpha * soft_loss + (1 - alpha) * hard_loss, soft_loss, hard_loss
+
+
+def keep_layers(model, n_layer):
+    """
+    Shrink a GPT-2 model to n_layer transformer blocks, keeping evenly spaced blocks (always the first and the last).
+
+    :param model: GPT-2 model with LM head
+    :param n_layer: Number of kept blocks
+    :return: The model with the kept blocks
+    """
+    num_blocks = len(model.transformer.h)
+    if n_layer >= num_blocks:
+        return model
+
+    kept = [round(i * (num_blocks - 1) / max(n_layer - 1, 1)) for i in range(n_layer)]
+    model.transformer.h = nn.ModuleList([model.transformer.h[idx] for idx in kept])
+    model.config.n_layer = n_layer
+    return model
+
+
+def count_parameters(model):
+    """Count the parameters of a model (the tied LM head and input embeddings are counted once)."""
+    return sum(p.numel() for p in {p.data_ptr(): p for p in model.parameters()}.values())
+
+
+def measure_generation_latency(model, tokenizer, max_length, num_samples, top_k, num_rounds=3, device='cpu'):
+    """
+    Measure the generation latency of a model: the time per decoding step (forward call) and per generated sample.
+
+    :param model: Model with LM head
+    :param tokenizer: Tokenizer
+    :param max_length: Max length of the generated samples
+    :param num_samples: Number of samples per generation
+    :param top_k: Top-k filtering of the sampling
+    :param num_rounds: Number of generations
+    :param device: 'cuda' or 'cpu'
+    :return: Dictionary with the milliseconds per step and per sample
+    """
+    num_forward_calls = [0]
+
+    def count_forward_calls(module, inputs, outputs):
+        num_forward_calls[0] += 1
+    hook = model.register_forward_hook(count_forward_calls)
+
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        generate_sequence(model, tokenizer, max_length, num_samples=num_samples, top_k=top_k, device=device)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    hook.remove()
+
+    return {'ms_per_step': seconds / num_forward_calls[0] * 1000,
+            'ms_per_sample': seconds / (num_rounds * num_samples) * 1000}
@@ -0,0 +1,55 @@
+import os
+import json
+import hashlib
+
+
+def list_files(path):
+    """The files of a path: the path itself, or every file of a directory (recursively, in a stable order)."""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+
+def file_memo_key(file_path):
+    """Memo key of the content hash of a file: its absolute path, size and modification time. None if it is missing."""
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    return '{}:{}:{}'.format(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def hash_file(file_path):
+    """SHA-1 hex digest of the content of a file."""
+    hasher = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def files_fingerprint(paths, extra=None, memo=None):
+    """
+    Content hash of files, e.g. the weights, configs or adapters of a model, without loading them.
+
+    :param paths: List of file paths, or directories (all of their files are hashed, in a stable order)
+    :param extra: JSON serializable description of other inputs, e.g. the arguments of the model loading
+    :param memo: Dictionary of the content hashes of the files by file_memo_key, or None. The hashes of unchanged
+                 files are taken from it instead of reading the files again, and the new hashes are added to it
+    :return: Hex digest
+    """
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps(extra, sort_keys=True).encode('utf-8'))
+
+    for path in paths:
+        for file_path in list_files(path):
+            if memo is None:
+                file_hash = hash_file(file_path)
+            else:
+                memo_key = file_memo_key(file_path)
+                if memo_key not in memo:
+                    memo[memo_key] = hash_file(file_path)
+                file_hash = memo[memo_key]
+            hasher.update(os.path.relpath(file_path, path).encode('utf-8'))
+            hasher.update(file_hash.encode('utf-8'))
+
+    return hasher.hexdigest()
@@ -45,12 +45,107 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0):
     return logits
 
 
+def batch_top_k_top_p_filtering(logits, top_k, top_p):
+    """
+    Filter a batch of logits with top-k and/or nucleus (top-p) filtering, with its own top_k and top_p for every row.
+
+    The result is the same as top_k_top_p_filtering applied row by row, but the whole batch is filtered with one sort.
+
+    :param logits: logits distribution shape (batch size x vocabulary size)
+    :param top_k: Tensor of the top_k of every row (batch size), 0: no top-k filtering for the row
+    :param top_p: Tensor of the top_p of every row (batch size), 0: no nucleus filtering for the row
+    :return: The filtered logits (filtered in place)
+    """
+    top_k = top_k.clamp(max=logits.size(-1))
+    use_top_k = (top_k > 0).unsqueeze(1)
+    use_top_p = (top_p > 0).unsqueeze(1)
+    # the index of the k-th highest logit of every row (a dummy 0 for the rows without top-k filtering)
+    kth_idx = (top_k - 1).clamp(min=0).unsqueeze(1)
+
+    if not use_top_p.any():
+        if use_top_k.any():
+            # top-k only: a partial sort up to the highest k is enough
+            kth_logits = torch.topk(logits, int(top_k.max()))[0].gather(1, kth_idx)
+            logits[use_top_k & (logits < kth_logits)] = -float('Inf')
+        return logits
+
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+    if use_top_k.any():
+        kth_logits = sorted_logits.gather(1, kth_idx)
+        sorted_logits = sorted_logits.masked_fill(use_top_k & (sorted_logits < kth_logits), -float('Inf'))
+    cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+
+    # Remove tokens with cumulative probability above the threshold, and keep the first token above the threshold
+    sorted_indices_to_remove = use_top_p & (cumulative_probs > top_p.unsqueeze(1))
+    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+    sorted_indices_to_remove[..., 0] = 0
+    # and the tokens removed by the top-k filtering
+    sorted_indices_to_remove |= sorted_logits == -float('Inf')
+
+    indices_to_remove = sorted_indices_to_remove.scatter(dim=1, index=sorted_indices, src=sorted_indices_to_remove)
+    logits[indices_to_remove] = -float('Inf')
+    return logits
+
+
+def per_row_param(value, num_rows, dtype, device):
+    """
+    Broadcast a sampling parameter to a tensor with a value for every row of a batch.
+
+    :param value: A number (the same value for every row), or a list or tensor of num_rows values
+    :param num_rows: The number of rows
+    :param dtype: Data type of the tensor
+    :param device: 'cuda' or 'cpu'
+    :return: Tensor of num_rows values
+    """
+    value = torch.as_tensor(value, dtype=dtype, device=device)
+    if value.dim() == 0:
+        return value.repeat(num_rows)
+    if value.size() != (num_rows,):
+        raise ValueError('Expected a number or {} values for a sampling parameter, got {}.'.format(
+            num_rows, list(value.size())))
+    return value
+
+
+def compute_prefix_state(model, token_ids, device, prefix_cache=None):
+    """
+    Run the prefill of a token prefix (with batch size 1): compute its key/value state and the logits of its last token.
+
+    If a prefix cache is given, the longest cached prefix of the tokens is reused, and only the rest is computed.
+    The cache is not used in training mode, since the dropout makes the states random.
+
+    :param model: Model with LM head
+    :param token_ids: List of token ids
+    :param device: 'cuda' or 'cpu'
+    :param prefix_cache: PrefixCache object or None
+    :return: Tuple of the logits of the last token (1 x vocabulary size) and the past (list of per-layer states)
+    """
+    use_cache = prefix_cache is not None and not model.training
+
+    prefix_len, logits, past = prefix_cache.lookup(model, token_ids) if use_cache else (0, None, None)
+    if prefix_len < len(token_ids):
+        inputs = torch.tensor(token_ids[prefix_len:], dtype=torch.long, device=device).unsqueeze(0)
+        outputs = model(inputs, past=past)
+        logits, past = outputs[0][:, -1, :], outputs[1]
+
+        if use_cache:
+            prefix_cache.store(model, token_ids, logits, past)
+
+    return logits, past
+
+
 # originally from somewhere in https://github.com/huggingface/transformers/
 def generate_sequence(model, tokenizer, max_length, context='', num_samples=1, temperature=1,
-                      top_k=0, top_p=0, repetition_penalty=1.0, device='cpu'):
+                      top_k=0, top_p=0, repetition_penalty=1.0, device='cpu', prefix_cache=None):
     """
     Generate a sequence of words from some context.
 
+    The context is computed only once (or taken from the prefix cache) and shared by all the samples, then every step
+    only computes the new tokens, reusing the key/value states of the previous ones.
+
+    The sampling parameters are either the same for all the samples, or given per sample (a list or tensor of
+    num_samples values), so requests with different settings share the forward passes of one batch. E.g.
+    temperature=[0, 0.7, 1.0] generates a greedy sample and two sampled ones.
+
     :param model: Model with LM head
     :param tokenizer: Tokenizer
     :param max_length: The maximum length of the generated sequence
@@ -61,6 +156,7 @@ def generate_sequence(model, tokenizer, max_length, context='', num_samples=1, t
     :param top_p: Keep the top tokens with cumulative probability >= top_p (nucleus filtering). Must be between 0 and 1
     :param repetition_penalty: The parameter for repetition penalty. Between 1.0 and + infinity. 1.0 means no penalty
     :param device: 'gpu' or 'cpu'
+    :param prefix_cache: PrefixCache object for reusing the states of the contexts across calls, or None
     :return: List of generated texts
     """
     # pre-process context
@@ -68,28 +164,69 @@ def generate_sequence(model, tokenizer, max_length, context='', num_samples=1, t
         tokenizer.tokenize('<|endoftext|> {}'.format(context))
     )
     context_len = len(context)
-    context = torch.tensor(context, dtype=torch.long, device=device)
-    context = context.unsqueeze(0).repeat(num_samples, 1)
 
-    generated = context
+    # models with a restricted output vocabulary (see utils.restricted_vocab) compute logits for a subset of the tokens
+    output_vocab_ids = getattr(model, 'output_vocab_ids', None)
+    output_vocab_index = getattr(model, 'output_vocab_index', None)
+
+    # per-sample sampling parameters
+    temperature = per_row_param(temperature, num_samples, torch.float, device)
+    top_k = per_row_param(top_k, num_samples, torch.long, device)
+    top_p = per_row_param(top_p, num_samples, torch.float, device)
+    repetition_penalty = per_row_param(repetition_penalty, num_samples, torch.float, device)
+
+    greedy = temperature == 0
+    all_greedy, any_greedy = bool(greedy.all()), bool(greedy.any())
+    temperature = temperature.masked_fill(greedy, 1.).unsqueeze(1)
+    use_temperature = bool((temperature != 1).any())
+    use_penalty = bool((repetition_penalty != 1).any())
+    repetition_penalty = repetition_penalty.unsqueeze(1)
+
     with torch.no_grad():
+        # compute the context once, and broadcast its state to the samples
+        next_token_logits, past = compute_prefix_state(model, context, device, prefix_cache)
+        next_token_logits = next_token_logits.repeat(num_samples, 1)
+        past = [layer_past.expand(-1, num_samples, -1, -1, -1) for layer_past in past]
+
+        generated = torch.tensor(context, dtype=torch.long, device=device)
+        generated = generated.unsqueeze(0).repeat(num_samples, 1)
+
+        if use_penalty:
+            # mask of the already generated tokens of every sample (tokens outside the output vocabulary go to an
+            # extra column), updated with every new token
+            vocab_size = next_token_logits.size(-1)
+            logit_ids = generated if output_vocab_index is None else output_vocab_index[generated]
+            generated_mask = torch.zeros(num_samples, vocab_size + 1, dtype=torch.bool, device=device)
+            generated_mask.scatter_(1, logit_ids.masked_fill(logit_ids < 0, vocab_size), True)
+
         for current_len in range(context_len, max_length):
-            inputs = {'input_ids': generated}
+            if current_len > context_len:
+                outputs = model(next_token, past=past)
+                next_token_logits, past = outputs[0][:, -1, :], outputs[1]
 
-            outputs = model(**inputs)
-            next_token_logits = outputs[0][:, -1, :] / (temperature if temperature > 0 else 1.)
+            if use_temperature:
+                next_token_logits = next_token_logits / temperature
 
             # repetition penalty from CTRL (https://arxiv.org/abs/1909.05858)
-            for i in range(num_samples):
-                for _ in set(generated[i].tolist()):
-                    next_token_logits[i, _] /= repetition_penalty
+            if use_penalty:
+                next_token_logits = torch.where(generated_mask[:, :-1], next_token_logits / repetition_penalty,
+                                                next_token_logits)
 
-            filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)
+            filtered_logits = batch_top_k_top_p_filtering(next_token_logits, top_k, top_p)
 
-            if temperature == 0:  # greedy sampling:
+            if all_greedy:
                 next_token = torch.argmax(filtered_logits, dim=-1).unsqueeze(-1)
-            else:
+            elif not any_greedy:
                 next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
+            else:
+                # greedy samples mixed with sampled ones
+                next_token = torch.argmax(filtered_logits, dim=-1).unsqueeze(-1)
+                next_token[~greedy] = torch.multinomial(F.softmax(filtered_logits[~greedy], dim=-1), num_samples=1)
+
+            if use_penalty:
+                generated_mask.scatter_(1, next_token, True)
+            if output_vocab_ids is not None:
+                next_token = output_vocab_ids[next_token]
             generated = torch.cat((generated, next_token), dim=1)
 
             # if all the samples reach the end, i.e. the same words are getting re-generated: break
@@ -0,0 +1,379 @@
+import os
+import json
+import base64
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import torch
+from utils.gen_utils import generate_sequence, per_row_param
+from utils.prefix_cache import model_cache_key
+from utils.file_fingerprint import list_files, file_memo_key, files_fingerprint
+
+
+def weights_fingerprint(model):
+    """
+    Fingerprint of the weights of a model: a hash of its state dict (names, shapes, data types and values) and of its
+    restricted output vocabulary (see utils.restricted_vocab).
+
+    The fingerprint is memoized on the model until its weights change (see utils.prefix_cache.model_cache_key).
+
+    :param model: Model with LM head
+    :return: Hex string
+    """
+    model_key = model_cache_key(model)
+    memo = getattr(model, '_weights_fingerprint', None)
+    if memo is not None and memo[0] == model_key:
+        return memo[1]
+
+    hasher = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        hasher.update('{}:{}:{}'.format(name, tensor.dtype, list(tensor.size())).encode('utf-8'))
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    output_vocab_ids = getattr(model, 'output_vocab_ids', None)
+    if output_vocab_ids is not None:
+        hasher.update(output_vocab_ids.cpu().numpy().tobytes())
+
+    model._weights_fingerprint = (model_key, hasher.hexdigest())
+    return model._weights_fingerprint[1]
+
+
+def normalize_request(token_ids, max_length, num_samples, temperature=1, top_k=0, top_p=0, repetition_penalty=1.0,
+                      device='cpu'):
+    """
+    Normalize a generation request of generate_sequence, so equivalent requests get the same cache key.
+
+    The sampling parameters are expanded to one value per sample (a number and a list of the same numbers are the same
+    request), and top_k and top_p are dropped for the greedy samples, where they do not change the result.
+
+    :param token_ids: Token ids of the context (including the start token)
+    :param max_length: The maximum length of the generated sequence
+    :param num_samples: Number of samples
+    :param temperature: Temperature, a number or a value per sample
+    :param top_k: Top-k, a number or a value per sample
+    :param top_p: Top-p, a number or a value per sample
+    :param repetition_penalty: Repetition penalty, a number or a value per sample
+    :param device: 'cuda' or 'cpu'
+    :return: Dictionary of the normalized request
+    """
+    temperature = per_row_param(temperature, num_samples, torch.float, 'cpu').tolist()
+    greedy = [value == 0 for value in temperature]
+    top_k = [0 if is_greedy else value for is_greedy, value in
+             zip(greedy, per_row_param(top_k, num_samples, torch.long, 'cpu').tolist())]
+    top_p = [0. if is_greedy else value for is_greedy, value in
+             zip(greedy, per_row_param(top_p, num_samples, torch.float, 'cpu').tolist())]
+
+    return {
+        'token_ids': list(token_ids),
+        'max_length': max_length,
+        'num_samples': num_samples,
+        'temperature': temperature,
+        'top_k': top_k,
+        'top_p': top_p,
+        'repetition_penalty': per_row_param(repetition_penalty, num_samples, torch.float, 'cpu').tolist(),
+        # the results (and the random number generators) can differ across devices and torch versions
+        'device': torch.device(device).type,
+        'torch_version': torch.__version__
+    }
+
+
+def request_cache_key(model_fingerprint, request, rng_state=None):
+    """
+    Content address of a generation request.
+
+    :param model_fingerprint: Fingerprint of the model weights (see weights_fingerprint and files_fingerprint)
+    :param request: A normalized request (see normalize_request), or any JSON serializable request description
+    :param rng_state: The state of the random number generator before the generation (a byte tensor), or None for a
+                      deterministic (greedy) request
+    :return: Hex string
+    """
+    hasher = hashlib.sha1()
+    hasher.update(model_fingerprint.encode('utf-8'))
+    hasher.update(json.dumps(request, sort_keys=True).encode('utf-8'))
+    if rng_state is not None:
+        hasher.update(rng_state.cpu().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+class GenerationCache:
+    """
+    Content-addressed cache of generation results, with an in-memory LRU tier and an optional on-disk tier.
+
+    The entries are keyed by request_cache_key: the fingerprint of the model weights and the normalized request. A
+    value is a JSON serializable object (the generated samples, and the state of the random number generator after the
+    generation). The disk tier keeps one JSON file per entry, and evicts the least recently used entries when it grows
+    over its byte budget. The disk files are written atomically, so several processes can share a cache directory.
+    """
+
+    def __init__(self, max_memory_entries=1024, disk_dir=None, max_disk_bytes=2 ** 30):
+        """
+        Initialize the GenerationCache object.
+
+        :param max_memory_entries: Maximum number of entries of the in-memory tier. 0: no in-memory tier
+        :param disk_dir: Directory of the on-disk tier, or None for no on-disk tier
+        :param max_disk_bytes: Maximum total size of the entry files of the on-disk tier in bytes
+        """
+        self.max_memory_entries = max_memory_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._file_fingerprints = {}
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0, 'memory_evictions': 0,
+                      'disk_evictions': 0}
+
+        # index of the disk tier: entry file -> (size in bytes, last use time)
+        self._disk_index = {}
+        self.disk_bytes = 0
+        if disk_dir:
+            os.makedirs(os.path.join(disk_dir, 'entries'), exist_ok=True)
+            for path in list_files(os.path.join(disk_dir, 'entries')):
+                if path.endswith('.json'):
+                    self._index_file(path)
+            fingerprints_path = os.path.join(disk_dir, 'file_fingerprints.json')
+            if os.path.exists(fingerprints_path):
+                with open(fingerprints_path, 'r') as f:
+                    self._file_fingerprints = json.load(f)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _index_file(self, path):
+        """Add an entry file to the index of the disk tier, or update its size and last use time."""
+        self._unindex_file(path)
+        stat = os.stat(path)
+        self._disk_index[path] = (stat.st_size, stat.st_mtime)
+        self.disk_bytes += stat.st_size
+
+    def _unindex_file(self, path):
+        size, _ = self._disk_index.pop(path, (0, None))
+        self.disk_bytes -= size
+
+    def _entry_path(self, key):
+        return os.path.join(self.disk_dir, 'entries', key[:2], '{}.json'.format(key))
+
+    def _write_json(self, path, value):
+        """Write a JSON file atomically."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def _store_in_memory(self, key, value):
+        if self.max_memory_entries <= 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.stats['memory_evictions'] += 1
+
+    def get(self, key):
+        """
+        Look up an entry, first in memory, then on disk (a disk hit is also stored in memory).
+
+        :param key: Cache key (see request_cache_key)
+        :return: The cached value, or None on a miss
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return self._memory[key]
+
+        if self.disk_dir:
+            path = self._entry_path(key)
+            try:
+                with open(path, 'r') as f:
+                    value = json.load(f)
+            except (OSError, ValueError):
+                # missing, or evicted by another process
+                self._unindex_file(path)
+            else:
+                # the modification time of a file is its last use time for the eviction
+                os.utime(path)
+                self._index_file(path)
+                self.stats['disk_hits'] += 1
+                self._store_in_memory(key, value)
+                return value
+
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        """Store an entry in both tiers, and evict the least recently used entry files if the disk tier is full."""
+        self._store_in_memory(key, value)
+        if not self.disk_dir:
+            return
+
+        path = self._entry_path(key)
+        self._write_json(path, value)
+        self._index_file(path)
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+
+        for old_path, _ in sorted(self._disk_index.items(), key=lambda item: item[1][1]):
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            if old_path == path:
+                continue
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+            self._unindex_file(old_path)
+            self.stats['disk_evictions'] += 1
+
+    def clear(self):
+        """Remove all the entries of both tiers."""
+        self._memory.clear()
+        for path in list(self._disk_index):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._disk_index.clear()
+        self.disk_bytes = 0
+
+    def files_fingerprint(self, paths, extra=None):
+        """
+        Fingerprint of model files (weights, configs, adapters, ...), without loading the model (see
+        utils.file_fingerprint.files_fingerprint).
+
+        The content hashes of the files are memoized by path, size and modification time (on disk, with the disk
+        tier), so unchanged weight files are not read again. The memo of the deleted and modified files is pruned.
+
+        :param paths: List of file or directory paths
+        :param extra: JSON serializable description of the other inputs of the model loading (e.g. architecture name)
+        :return: Hex string
+        """
+        num_memoized = len(self._file_fingerprints)
+        fingerprint = files_fingerprint(paths, extra, memo=self._file_fingerprints)
+
+        if len(self._file_fingerprints) != num_memoized and self.disk_dir:
+            # the hashes of the deleted files and of the previous versions of the modified files are dropped
+            self._file_fingerprints = {
+                memo_key: file_hash for memo_key, file_hash in self._file_fingerprints.items()
+                if file_memo_key(memo_key.rsplit(':', 2)[0]) == memo_key
+            }
+            self._write_json(os.path.join(self.disk_dir, 'file_fingerprints.json'), self._file_fingerprints)
+
+        return fingerprint
+
+
+def _get_rng_state(device):
+    """The state of the random number generator of torch (and of the GPU, for a CUDA device) as a byte tensor."""
+    rng_state = torch.get_rng_state()
+    if torch.device(device).type == 'cuda':
+        rng_state = torch.cat([rng_state, torch.cuda.get_rng_state(device)])
+    return rng_state
+
+
+def _set_rng_state(rng_state, device):
+    """Restore a state returned by _get_rng_state."""
+    cpu_state_size = torch.get_rng_state().numel()
+    if torch.device(device).type == 'cuda':
+        torch.cuda.set_rng_state(rng_state[cpu_state_size:], device)
+    torch.set_rng_state(rng_state[:cpu_state_size])
+
+
+def _encode_rng_state(rng_state):
+    """A state returned by _get_rng_state as a JSON serializable string."""
+    return base64.b64encode(rng_state.numpy().tobytes()).decode('ascii')
+
+
+def _decode_rng_state(encoded):
+    """Decode a state encoded by _encode_rng_state."""
+    return torch.from_numpy(np.frombuffer(base64.b64decode(encoded), dtype=np.uint8).copy())
+
+
+def cached_model_loading(cache, model_fingerprint, load_model, device='cpu'):
+    """
+    Load a model, or only move the random number generator to its state after the loading of the model.
+
+    The initialization of a model draws random numbers, so the samples generated after the loading depend on it. The
+    state of the generator after the loading is cached (keyed by the model and the state before the loading): later
+    runs restore it instead of loading the model, and their samples are the same as without the cache.
+
+    :param cache: GenerationCache object
+    :param model_fingerprint: Fingerprint of the model (e.g. GenerationCache.files_fingerprint of the model files)
+    :param load_model: Function loading the model (once)
+    :param device: 'cuda' or 'cpu'
+    """
+    request = {'model_loading': True, 'device': torch.device(device).type, 'torch_version': torch.__version__}
+    key = request_cache_key(model_fingerprint, request, _get_rng_state(device))
+
+    value = cache.get(key)
+    if value is not None:
+        _set_rng_state(_decode_rng_state(value['rng_state']), device)
+        return
+
+    load_model()
+    cache.put(key, {'rng_state': _encode_rng_state(_get_rng_state(device))})
+
+
+def cached_generate_sequence(cache, model, tokenizer, max_length, context='', num_samples=1, seeded=False,
+                             model_fingerprint=None, load_model=None, **gen_kwargs):
+    """
+    generate_sequence with a GenerationCache.
+
+    The samples depend on the random number generator of torch, so a sampled (not greedy) request is only cached if
+    the generator was seeded by the caller (set_random_seeds), and its state is part of the key: a request after
+    set_random_seeds(seed) always has the same key, and so does the n-th request after it. A hit restores the state of
+    the generator after the cached generation, so the following requests are the same as without the cache. Unseeded
+    sampling bypasses the cache. Greedy requests do not use the generator, and are always cached.
+
+    :param cache: GenerationCache object
+    :param model: Model with LM head, or None if load_model is given
+    :param tokenizer: Tokenizer
+    :param max_length: The maximum length of the generated sequence
+    :param context: Initial context for the generation
+    :param num_samples: Number of samples to generate
+    :param seeded: True if the random number generators were seeded by the caller
+    :param model_fingerprint: Fingerprint of the model, if known (e.g. GenerationCache.files_fingerprint of the model
+                              files). Default: weights_fingerprint of the model
+    :param load_model: Function returning the model, called on a miss only (with model_fingerprint). It should load
+                       the model once, and it does not change the state of the random number generator
+    :param gen_kwargs: Other arguments of generate_sequence (temperature, top_k, top_p, repetition_penalty, device,
+                       prefix_cache)
+    :return: List of generated texts
+    """
+    sampling_params = {name: gen_kwargs[name] for name in ['temperature', 'top_k', 'top_p', 'repetition_penalty']
+                       if name in gen_kwargs}
+    request = normalize_request(
+        tokenizer.convert_tokens_to_ids(tokenizer.tokenize('<|endoftext|> {}'.format(context))),
+        max_length, num_samples, device=gen_kwargs.get('device', 'cpu'), **sampling_params
+    )
+    sampled = any(temperature > 0 for temperature in request['temperature'])
+    device = gen_kwargs.get('device', 'cpu')
+
+    def generate():
+        if model is not None:
+            return generate_sequence(model, tokenizer, max_length, context, num_samples, **gen_kwargs)
+
+        # the initialization of a model draws random numbers: the loading must not change the samples
+        rng_state = _get_rng_state(device)
+        loaded_model = load_model()
+        _set_rng_state(rng_state, device)
+        return generate_sequence(loaded_model, tokenizer, max_length, context, num_samples, **gen_kwargs)
+
+    if sampled and not seeded:
+        cache.stats['bypassed'] += 1
+        return generate()
+
+    if model_fingerprint is None:
+        model_fingerprint = weights_fingerprint(model)
+    key = request_cache_key(model_fingerprint, request, _get_rng_state(device) if sampled else None)
+
+    value = cache.get(key)
+    if value is not None:
+        if sampled:
+            _set_rng_state(_decode_rng_state(value['rng_state']), device)
+        return list(value['samples'])
+
+    generated = generate()
+    value = {'samples': generated}
+    if sampled:
+        value['rng_state'] = _encode_rng_state(_get_rng_state(device))
+    cache.put(key, value)
+
+    return generated
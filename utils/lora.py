@@ -0,0 +1,113 @@
+import math
+import torch
+from torch import nn
+from pytorch_transformers.modeling_utils import Conv1D
+
+# the attention (c_attn, c_proj) and MLP (c_fc, c_proj) projections of the GPT-2 blocks
+LORA_TARGET_MODULES = ['c_attn', 'c_proj', 'c_fc']
+
+
+class LoRAConv1D(nn.Module):
+    """
+    GPT-2 Conv1D projection with a low-rank adapter (LoRA, Hu et al., https://arxiv.org/abs/2106.09685).
+
+    The weights of the wrapped projection are frozen, and the output is corrected with a trainable low-rank update:
+    y = x W + b + (x A B) * alpha / rank. B is initialized with zeros, so the adapter starts as an identity change.
+    """
+
+    def __init__(self, base, rank, alpha, dropout=0.):
+        """
+        Initialize the LoRAConv1D object.
+
+        :param base: The Conv1D projection to adapt
+        :param rank: Rank of the update
+        :param alpha: Scaling of the update (the update is scaled by alpha / rank)
+        :param dropout: Dropout probability of the adapter input
+        """
+        super(LoRAConv1D, self).__init__()
+        self.base = base
+        self.nf = base.nf
+        self.scaling = alpha / rank
+
+        nx = base.weight.size(0)
+        self.lora_A = nn.Parameter(base.weight.new_empty(nx, rank))
+        self.lora_B = nn.Parameter(base.weight.new_zeros(rank, self.nf))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.lora_dropout = nn.Dropout(dropout)
+
+    def forward(self, x):
+        return self.base(x) + torch.matmul(torch.matmul(self.lora_dropout(x), self.lora_A), self.lora_B) * self.scaling
+
+    def merge(self):
+        """Add the low-rank update to the weights of the wrapped projection, and return the projection."""
+        with torch.no_grad():
+            self.base.weight += torch.matmul(self.lora_A, self.lora_B) * self.scaling
+        return self.base
+
+
+def add_lora_adapters(model, rank, alpha, dropout=0., target_modules=None):
+    """
+    Freeze the weights of a GPT-2 model, and add trainable low-rank adapters to its projections.
+
+    :param model: GPT-2 model
+    :param rank: Rank of the adapters
+    :param alpha: Scaling of the adapters
+    :param dropout: Dropout probability of the adapter inputs
+    :param target_modules: Names of the adapted projections. Default: LORA_TARGET_MODULES
+    :return: The model with adapters
+    """
+    target_modules = target_modules or LORA_TARGET_MODULES
+    for param in model.parameters():
+        param.requires_grad = False
+
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if name in target_modules and isinstance(child, Conv1D):
+                setattr(module, name, LoRAConv1D(child, rank, alpha, dropout))
+
+    model.lora_config = {'rank': rank, 'alpha': alpha, 'dropout': dropout, 'target_modules': list(target_modules)}
+    return model
+
+
+def has_lora_adapters(model):
+    """Check whether a model has low-rank adapters."""
+    return getattr(model, 'lora_config', None) is not None
+
+
+def save_lora_adapters(model, save_path):
+    """Save only the adapter weights (and the adapter config) of a model."""
+    state_dict = {name: tensor for name, tensor in model.state_dict().items() if '.lora_' in name}
+    torch.save({'lora_config': model.lora_config, 'state_dict': state_dict}, save_path)
+
+
+def load_lora_adapters(model, adapter_path, merge=False):
+    """
+    Add the saved low-rank adapters to a model (loaded with the base weights of the adapter training).
+
+    :param model: GPT-2 model
+    :param adapter_path: Path to the adapter file saved by save_lora_adapters()
+    :param merge: If True, merge the adapters into the projection weights, so the inference has no adapter overhead
+    :return: The model with the adapters
+    """
+    adapter = torch.load(adapter_path, map_location=lambda storage, location: storage)
+    model = add_lora_adapters(model, **adapter['lora_config'])
+
+    missing_keys, unexpected_keys = model.load_state_dict(adapter['state_dict'], strict=False)
+    if unexpected_keys or any('.lora_' in key for key in missing_keys):
+        raise ValueError('The adapter in {} does not match the model.'.format(adapter_path))
+
+    if merge:
+        model = merge_lora_adapters(model)
+
+    return model
+
+
+def merge_lora_adapters(model):
+    """Merge the low-rank adapters of a model into the projection weights, and remove the adapters."""
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRAConv1D):
+                setattr(module, name, child.merge())
+
+    model.lora_config = None
+    return model
@@ -0,0 +1,91 @@
+import uuid
+from collections import OrderedDict
+
+
+def model_cache_key(model):
+    """
+    Identify a model and the current state of its weights.
+
+    Every model gets a unique token on the first call. Replaced weights (e.g. moving the model to another device) and
+    in-place updates (e.g. load_state_dict) are tracked with the storage pointers and the version counters of the
+    parameters. Updates through param.data (like the optimizers of pytorch_transformers) are not tracked, so clear the
+    cache after such updates, or do not share a cache during training.
+    """
+    if not hasattr(model, '_prefix_cache_token'):
+        model._prefix_cache_token = uuid.uuid4().hex
+
+    return model._prefix_cache_token, tuple((param.data_ptr(), param._version) for param in model.parameters())
+
+
+def tensor_bytes(tensors):
+    """Size of a list of tensors in bytes."""
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class PrefixCache:
+    """
+    LRU cache of the key/value states of token prefixes (prompts), with a byte budget.
+
+    An entry is keyed by the model (see model_cache_key) and the token ids of the prefix, and holds the key/value state
+    of the prefix (the "past" of the GPT-2 model, with batch size 1) and the logits of its last position. A lookup
+    returns the longest cached prefix of the requested tokens, so an extended prompt only needs the prefill of the new
+    tokens.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Initialize the PrefixCache object.
+
+        :param max_bytes: Maximum total size of the cached states in bytes. The least recently used states are evicted
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'partial_hits': 0, 'misses': 0, 'evictions': 0, 'prefill_tokens_saved': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all the cached states."""
+        self._entries.clear()
+        self.num_bytes = 0
+
+    def lookup(self, model, token_ids):
+        """
+        Find the longest cached prefix of a token sequence.
+
+        :param model: Model with LM head
+        :param token_ids: List of token ids
+        :return: Tuple of the length of the prefix, its last logits and its past, or (0, None, None) on a miss
+        """
+        model_key = model_cache_key(model)
+        for prefix_len in range(len(token_ids), 0, -1):
+            key = (model_key, tuple(token_ids[:prefix_len]))
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats['hits' if prefix_len == len(token_ids) else 'partial_hits'] += 1
+                self.stats['prefill_tokens_saved'] += prefix_len
+
+                logits, past, _ = self._entries[key]
+                return prefix_len, logits, past
+
+        self.stats['misses'] += 1
+        return 0, None, None
+
+    def store(self, model, token_ids, logits, past):
+        """Cache the last logits and the past of a token prefix, and evict the least recently used states if needed."""
+        num_bytes = tensor_bytes([logits] + list(past))
+        if num_bytes > self.max_bytes:
+            return
+
+        key = (model_cache_key(model), tuple(token_ids))
+        if key in self._entries:
+            self.num_bytes -= self._entries.pop(key)[2]
+
+        self._entries[key] = (logits, past, num_bytes)
+        self.num_bytes += num_bytes
+
+        while self.num_bytes > self.max_bytes:
+            self.num_bytes -= self._entries.popitem(last=False)[1][2]
+            self.stats['evictions'] += 1
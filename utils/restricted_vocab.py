@@ -0,0 +1,56 @@
+import torch
+from torch import nn
+
+
+def corpus_token_ids(datasets, vocab_size, margin=1000, extra_token_ids=()):
+    """
+    Collect the output vocabulary of a restricted model: the token ids used by a corpus, plus a safety margin.
+
+    The GPT-2 token ids follow the order of the byte-pair merges, i.e. the most frequent tokens have the lowest ids,
+    so the margin is the first margin ids of the vocabulary.
+
+    :param datasets: EpisodeSummaryDataset objects, e.g. from create_datasets_from_jsons
+    :param vocab_size: Size of the full vocabulary
+    :param margin: Number of the most frequent tokens that are always kept
+    :param extra_token_ids: Other token ids to keep, e.g. "<|endoftext|>"
+    :return: Sorted list of token ids
+    """
+    token_ids = set(range(min(margin, vocab_size)))
+    token_ids.update(extra_token_ids)
+    for dataset in datasets:
+        for tokenized_summary in dataset.episode_summaries:
+            token_ids.update(tokenized_summary)
+
+    return sorted(token_ids)
+
+
+def restrict_output_vocabulary(model, token_ids):
+    """
+    Slice the LM head of a GPT-2 model to a subset of the vocabulary, for cheaper inference.
+
+    The input embeddings are kept, so the model still reads every token, but the logits are computed only for the
+    token_ids: the k-th logit belongs to the token id token_ids[k]. The generation and scoring functions map the ids
+    with model.output_vocab_ids (restricted index -> token id) and model.output_vocab_index (token id -> restricted
+    index, -1 for tokens outside the restricted vocabulary). The restricted model is for inference only: the loss of
+    the LM head (labels) does not map the ids.
+
+    :param model: GPT-2 model with LM head
+    :param token_ids: Sorted list of the kept token ids
+    :return: The model with the restricted LM head
+    """
+    vocab_size, n_embd = model.lm_head.weight.size()
+    device = model.lm_head.weight.device
+    output_vocab_ids = torch.tensor(token_ids, dtype=torch.long, device=device)
+
+    # the LM head is tied to the input embeddings, so the sliced weights are copied
+    lm_head = nn.Linear(n_embd, len(token_ids), bias=False).to(device)
+    with torch.no_grad():
+        lm_head.weight.copy_(model.lm_head.weight[output_vocab_ids])
+    model.lm_head = lm_head
+
+    output_vocab_index = torch.full((vocab_size,), -1, dtype=torch.long, device=device)
+    output_vocab_index[output_vocab_ids] = torch.arange(len(token_ids), device=device)
+
+    model.register_buffer('output_vocab_ids', output_vocab_ids)
+    model.register_buffer('output_vocab_index', output_vocab_index)
+    return model
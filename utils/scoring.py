@@ -0,0 +1,171 @@
+import math
+import torch
+
+# torch.inference_mode is only available in newer torch versions
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def tokenize_for_scoring(tokenizer, text):
+    """Tokenize a text the same way as the training data: wrapped in "<|endoftext|>" tokens."""
+    return tokenizer.convert_tokens_to_ids(tokenizer.tokenize('<|endoftext|> {} <|endoftext|>'.format(text)))
+
+
+def make_length_sorted_batches(lengths, batch_size, max_batch_tokens):
+    """
+    Group sequences into batches of similar lengths.
+
+    The sequences are sorted by length, and a batch is closed when it has batch_size sequences, or when one more
+    sequence would make the padded batch larger than max_batch_tokens tokens.
+
+    :param lengths: List of sequence lengths
+    :param batch_size: Maximum number of sequences per batch
+    :param max_batch_tokens: Maximum number of (padded) tokens per batch
+    :return: List of batches (lists of sequence indices), the sequences of a batch sorted from longest to shortest
+    """
+    batches = []
+    batch = []
+    for idx in sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True):
+        if batch and (len(batch) == batch_size or (len(batch) + 1) * lengths[batch[0]] > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def split_into_windows(token_ids, max_len, stride):
+    """
+    Split a tokenized text longer than the context of the model into overlapping windows of at most max_len tokens.
+
+    Every window after the first one starts max_len - stride tokens before the end of the previous one, so its first
+    scored tokens still have this much context. The tokens scored by the previous windows are skipped.
+
+    :param token_ids: Tokenized text (list of integers)
+    :param max_len: Maximum sequence length of the model
+    :param stride: Number of new tokens per window, between 1 and max_len - 1
+    :return: List of (window token ids, number of skipped targets at the start of the window) tuples
+    """
+    windows = [(token_ids[:max_len], 0)]
+    scored_end = len(windows[0][0])
+    while scored_end < len(token_ids):
+        start = scored_end - (max_len - stride)
+        windows.append((token_ids[start:start + max_len], scored_end - start - 1))
+        scored_end = start + len(windows[-1][0])
+
+    return windows
+
+
+def score_token_ids(model, token_ids_list, pad_token_id, batch_size=32, max_batch_tokens=4096, device='cpu',
+                    max_len=None, stride=None):
+    """
+    Compute the log-likelihood of tokenized texts under a language model.
+
+    The sequences are batched by length (see make_length_sorted_batches), so every batch is padded as little as
+    possible, and long sequences are scored in smaller batches than short ones. The padding is added to the end of the
+    sequences, where the causal attention never sees it from the real tokens, and it is masked out of the
+    log-likelihood. With a restricted output vocabulary (see utils.restricted_vocab), the tokens outside of it have
+    zero probability. Sequences longer than the context of the model are scored in overlapping windows (see
+    split_into_windows).
+
+    :param model: Model with LM head
+    :param token_ids_list: List of tokenized texts (lists of integers). The first token of every text is not scored
+    :param pad_token_id: Id of the padding token
+    :param batch_size: Maximum number of sequences per forward pass
+    :param max_batch_tokens: Maximum number of (padded) tokens per forward pass
+    :param device: 'cuda' or 'cpu'
+    :param max_len: Maximum sequence length of the model. None: model.config.n_positions
+    :param stride: Number of new tokens per window of the long sequences. None: max_len // 2
+    :return: List of (log-likelihood, number of scored tokens) tuples, in the order of the inputs
+    """
+    max_len = max_len or model.config.n_positions
+    stride = stride or max_len // 2
+
+    # the windows of the long sequences are scored like separate sequences, then their scores are summed
+    windows, window_text_idxs = [], []
+    for text_idx, token_ids in enumerate(token_ids_list):
+        text_windows = split_into_windows(token_ids, max_len, stride) if len(token_ids) > max_len else [(token_ids, 0)]
+        windows.extend(text_windows)
+        window_text_idxs.extend([text_idx] * len(text_windows))
+
+    batches = make_length_sorted_batches([len(token_ids) for token_ids, _ in windows], batch_size, max_batch_tokens)
+    scores = [(0., 0)] * len(token_ids_list)
+    output_vocab_index = getattr(model, 'output_vocab_index', None)
+
+    with inference_mode():
+        for batch_idxs in batches:
+            lengths = torch.tensor([len(windows[idx][0]) for idx in batch_idxs], device=device)
+            num_skipped = torch.tensor([windows[idx][1] for idx in batch_idxs], device=device)
+            batch_len = len(windows[batch_idxs[0]][0])
+
+            inputs = torch.tensor(
+                [windows[idx][0] + [pad_token_id] * (batch_len - len(windows[idx][0])) for idx in batch_idxs],
+                dtype=torch.long, device=device
+            )
+            logits = model(inputs)[0][:, :-1]
+            targets = inputs[:, 1:]
+
+            # a model with a restricted output vocabulary can not generate the tokens outside of it
+            if output_vocab_index is not None:
+                targets = output_vocab_index[targets]
+            impossible = targets < 0
+
+            # log softmax of the target tokens, without materializing the log softmax of the full vocabulary
+            token_log_probs = logits.gather(-1, targets.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+            token_log_probs = token_log_probs - torch.logsumexp(logits, dim=-1)
+            token_log_probs = token_log_probs.masked_fill(impossible, -float('Inf'))
+            positions = torch.arange(batch_len - 1, device=device).unsqueeze(0)
+            mask = (positions < (lengths - 1).unsqueeze(1)) & (positions >= num_skipped.unsqueeze(1))
+            log_likelihoods = token_log_probs.masked_fill(~mask, 0.).sum(dim=1)
+
+            for idx, log_likelihood, num_tokens in zip(batch_idxs, log_likelihoods.tolist(), mask.sum(dim=1).tolist()):
+                text_log_likelihood, text_num_tokens = scores[window_text_idxs[idx]]
+                scores[window_text_idxs[idx]] = (text_log_likelihood + log_likelihood, text_num_tokens + num_tokens)
+
+    return scores
+
+
+def score_texts(model, tokenizer, texts, batch_size=32, max_batch_tokens=4096, device='cpu'):
+    """
+    Score texts with a language model: token-weighted log-likelihood and perplexity.
+
+    :param model: Model with LM head
+    :param tokenizer: Tokenizer
+    :param texts: List of strings
+    :param batch_size: Maximum number of texts per forward pass
+    :param max_batch_tokens: Maximum number of (padded) tokens per forward pass
+    :param device: 'cuda' or 'cpu'
+    :return: List of dictionaries with the keys "log_likelihood", "num_tokens", "perplexity" and "out_of_vocabulary",
+             in the order of the texts. The texts with tokens outside of a restricted output vocabulary have zero
+             probability: their log-likelihood and perplexity are None (null in JSON), and out_of_vocabulary is True
+    """
+    pad_token_id = tokenizer.convert_tokens_to_ids('<|endoftext|>')
+    token_ids_list = [tokenize_for_scoring(tokenizer, text) for text in texts]
+
+    scores = []
+    token_scores = score_token_ids(model, token_ids_list, pad_token_id, batch_size, max_batch_tokens, device)
+    for log_likelihood, num_tokens in token_scores:
+        out_of_vocabulary = log_likelihood == -float('Inf')
+        scores.append({
+            'log_likelihood': None if out_of_vocabulary else log_likelihood,
+            'num_tokens': num_tokens,
+            'perplexity': None if out_of_vocabulary else math.exp(-log_likelihood / num_tokens),
+            'out_of_vocabulary': out_of_vocabulary
+        })
+
+    return scores
+
+
+def corpus_perplexity(scores):
+    """
+    Token-weighted perplexity of a set of texts scored by score_texts. The texts outside of a restricted output
+    vocabulary (without a log-likelihood) are left out. NaN if there are no scored tokens.
+    """
+    scores = [score for score in scores if score['log_likelihood'] is not None]
+    num_tokens = sum(score['num_tokens'] for score in scores)
+    if num_tokens == 0:
+        return float('nan')
+
+    return math.exp(-sum(score['log_likelihood'] for score in scores) / num_tokens)
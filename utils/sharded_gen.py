@@ -0,0 +1,101 @@
+import torch
+import torch.multiprocessing as mp
+from utils.gen_utils import set_random_seeds, generate_sequence
+from utils.prefix_cache import PrefixCache
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def derive_shard_seed(seed, shard_idx):
+    """
+    Derive the random seed of a shard from the base seed.
+
+    The shards are defined by the requests and the shard size only, so the samples do not depend on the number of
+    workers, or on the order in which the workers process the shards.
+    """
+    return (seed * 1000003 + shard_idx) % 2 ** 32
+
+
+def make_shards(requests, shard_size):
+    """
+    Split generation requests into shards of at most shard_size samples.
+
+    :param requests: List of (context, number of samples) tuples
+    :param shard_size: Maximum number of samples per shard
+    :return: List of (shard index, request index, context, number of samples) tuples
+    """
+    shards = []
+    for request_idx, (context, num_samples) in enumerate(requests):
+        for shard_start in range(0, num_samples, shard_size):
+            shards.append((len(shards), request_idx, context, min(shard_size, num_samples - shard_start)))
+
+    return shards
+
+
+def _init_worker(model, tokenizer, num_threads, prefix_cache_mb):
+    """Set up a worker process: the model weights are received as shared memory, not copied."""
+    torch.set_num_threads(num_threads)
+    _worker.update(model=model, tokenizer=tokenizer,
+                   prefix_cache=PrefixCache(prefix_cache_mb * 2 ** 20) if prefix_cache_mb else None)
+
+
+def _generate_shard(model, tokenizer, prefix_cache, shard, seed, gen_kwargs):
+    """Generate the samples of a shard, with the seed of the shard."""
+    shard_idx, request_idx, context, num_samples = shard
+    set_random_seeds(derive_shard_seed(seed, shard_idx))
+
+    generated = generate_sequence(model, tokenizer, context=context, num_samples=num_samples,
+                                  prefix_cache=prefix_cache, **gen_kwargs)
+    return request_idx, generated
+
+
+def _generate_shard_in_worker(task):
+    """Generate the samples of a shard in a worker process."""
+    return _generate_shard(_worker['model'], _worker['tokenizer'], _worker['prefix_cache'], *task)
+
+
+def generate_sharded(model, tokenizer, requests, seed, num_workers=0, threads_per_worker=1, shard_size=4,
+                     prefix_cache_mb=0, **gen_kwargs):
+    """
+    Generate samples for a list of requests, sharded across worker processes.
+
+    The model is moved to shared memory once, and the worker processes use the same weights without copying them.
+    The samples of the requests are split into shards of shard_size samples, and every shard is generated with its own
+    seed derived from the base seed (see derive_shard_seed), so the results are the same for any number of workers.
+
+    :param model: Model with LM head, on the CPU
+    :param tokenizer: Tokenizer
+    :param requests: List of (context, number of samples) tuples
+    :param seed: Base random seed
+    :param num_workers: Number of worker processes. 0: generate the shards in the current process
+    :param threads_per_worker: Number of intra-op threads of every worker
+    :param shard_size: Maximum number of samples per shard
+    :param prefix_cache_mb: Prefix cache budget of every worker in MB. 0: no prefix cache
+    :param gen_kwargs: Other arguments of generate_sequence (max_length, temperature, top_k, ...)
+    :return: List of lists of generated texts: the samples of every request, in order
+    """
+    shards = make_shards(requests, shard_size)
+    results = [[] for _ in requests]
+
+    if num_workers == 0:
+        prefix_cache = PrefixCache(prefix_cache_mb * 2 ** 20) if prefix_cache_mb else None
+        for shard in shards:
+            request_idx, generated = _generate_shard(model, tokenizer, prefix_cache, shard, seed, gen_kwargs)
+            results[request_idx].extend(generated)
+        return results
+
+    model.share_memory()
+    # spawn: forking a process with an initialized OpenMP thread pool can hang
+    pool = mp.get_context('spawn').Pool(num_workers, initializer=_init_worker,
+                                        initargs=(model, tokenizer, threads_per_worker, prefix_cache_mb))
+    try:
+        # imap returns the shards in order, so the samples are merged back in order
+        tasks = [(shard, seed, gen_kwargs) for shard in shards]
+        for request_idx, generated in pool.imap(_generate_shard_in_worker, tasks):
+            results[request_idx].extend(generated)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
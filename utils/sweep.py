@@ -0,0 +1,208 @@
+import csv
+import json
+import math
+import random
+import itertools
+import statistics
+import torch
+
+# training arguments that change the tokenized data: the trials with the same values share one tokenized corpus
+DATA_ARGS = ['json_paths', 'max_num_words', 'size_var_handling', 'dedup_threshold', 'val_split', 'random_seed']
+
+
+def load_sweep_spec(spec_path, argument_names):
+    """
+    Load and check a sweep spec.
+
+    A spec is a JSON object with the search "method" ("grid" or "random"), the number of random trials
+    ("num_trials", random search only), and the searched training arguments ("parameters"). Every parameter is a list of
+    values, or (random search only) a range: {"min": ..., "max": ..., "log": true/false, "type": "int"/"float"}, e.g.
+
+        {"method": "random", "num_trials": 8,
+         "parameters": {"learning_rate": {"min": 1e-5, "max": 1e-3, "log": true}, "batch_size": [4, 8]}}
+
+    :param spec_path: Path to the JSON spec
+    :param argument_names: Names of the training arguments (the dests of train.py's get_arguments)
+    :return: The spec dictionary
+    """
+    with open(spec_path, 'r') as f:
+        spec = json.load(f)
+
+    if spec.get('method') not in ['grid', 'random']:
+        raise ValueError('The sweep method must be "grid" or "random", got {}.'.format(spec.get('method')))
+    if not spec.get('parameters'):
+        raise ValueError('The sweep spec has no parameters.')
+    for name, values in spec['parameters'].items():
+        # a misspelled name would only set an unused attribute, and every trial would train with the base arguments
+        if name not in argument_names:
+            raise ValueError('{} is not a training argument.'.format(name))
+        if isinstance(values, dict):
+            if spec['method'] == 'grid':
+                raise ValueError('The grid search needs a list of values for {}, not a range.'.format(name))
+            if values['min'] > values['max'] or (values.get('log') and values['min'] <= 0):
+                raise ValueError('Invalid range for {}: {}.'.format(name, values))
+        elif not isinstance(values, list) or not values:
+            raise ValueError('The values of {} must be a non-empty list or a range.'.format(name))
+    # the pruner compares the validation losses of the trials at the same checkpoint index
+    if 'checkpoint_steps' in spec['parameters']:
+        raise ValueError('checkpoint_steps can not be searched, the trials are compared at the same checkpoints.')
+    if spec['method'] == 'random' and spec.get('num_trials', 0) < 1:
+        raise ValueError('The random search needs "num_trials" >= 1.')
+
+    return spec
+
+
+def _sample_value(values, rng):
+    """Sample a value of a parameter: a choice from a list, or a uniform (or log-uniform) value from a range."""
+    if isinstance(values, list):
+        return rng.choice(values)
+
+    low, high = values['min'], values['max']
+    if values.get('log'):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+
+    return int(round(value)) if values.get('type') == 'int' else value
+
+
+def make_trials(spec, seed=0):
+    """
+    Create the trials of a sweep.
+
+    :param spec: Sweep spec (see load_sweep_spec)
+    :param seed: Random seed of the random search
+    :return: List of dictionaries of the training arguments of every trial
+    """
+    names = sorted(spec['parameters'])
+    if spec['method'] == 'grid':
+        return [dict(zip(names, values)) for values in itertools.product(*[spec['parameters'][n] for n in names])]
+
+    rng = random.Random(seed)
+    return [{name: _sample_value(spec['parameters'][name], rng) for name in names} for _ in range(spec['num_trials'])]
+
+
+def data_key(args):
+    """The values of the training arguments that change the tokenized data (see DATA_ARGS)."""
+    return tuple(tuple(value) if isinstance(value, list) else value
+                 for value in (getattr(args, name) for name in DATA_ARGS))
+
+
+class PackedSequences:
+    """
+    Read-only list of token id sequences, packed into one flat tensor.
+
+    The tensors can be moved to shared memory, so worker processes read the same tokenized corpus without copying
+    it: a list of Python integer lists would be copied into every process (and touched by the reference counting).
+    """
+
+    def __init__(self, token_ids_list=None, tokens=None, offsets=None):
+        """
+        Pack a list of token id sequences, or wrap already packed tensors.
+
+        :param token_ids_list: List of lists of integers
+        :param tokens: Flat tensor of the token ids of all the sequences
+        :param offsets: Tensor of the start offsets of the sequences in tokens, plus the total number of tokens
+        """
+        if token_ids_list is not None:
+            lengths = torch.tensor([len(token_ids) for token_ids in token_ids_list], dtype=torch.long)
+            offsets = torch.zeros(len(token_ids_list) + 1, dtype=torch.long)
+            offsets[1:] = torch.cumsum(lengths, dim=0)
+            tokens = torch.tensor([token_id for token_ids in token_ids_list for token_id in token_ids],
+                                  dtype=torch.int32)
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def share_memory_(self):
+        """Move the packed tensors to shared memory."""
+        self.tokens.share_memory_()
+        self.offsets.share_memory_()
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= len(self):
+            raise IndexError('Sequence index out of range.')
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]].tolist()
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+
+def core_allotments(num_slots, threads_per_trial, num_cpus):
+    """
+    Split the CPU cores between the concurrent trials: every slot gets threads_per_trial consecutive cores (wrapping
+    around if there are not enough cores).
+
+    :param num_slots: Number of concurrent trials
+    :param threads_per_trial: Number of cores of every trial
+    :param num_cpus: Number of CPU cores
+    :return: List of lists of core ids, one list per slot
+    """
+    return [[(slot * threads_per_trial + i) % num_cpus for i in range(threads_per_trial)] for slot in range(num_slots)]
+
+
+class MedianPruner:
+    """
+    Median stopping rule for the trials of a sweep.
+
+    At every checkpoint, a trial reports its validation loss curve (train_state['val_loss']). It is pruned if its best
+    validation loss so far is worse than the median of the best losses of the other trials at the same checkpoint.
+    The curves are kept in a dictionary shared by the processes of the sweep (e.g. a multiprocessing.Manager dict),
+    so a trial is compared to the finished trials and to the concurrent ones.
+    """
+
+    def __init__(self, curves, trial_idx, warmup_checkpoints=2, min_trials=2):
+        """
+        Initialize the MedianPruner object.
+
+        :param curves: Shared dictionary of the validation loss curves of the trials (trial index -> list of losses)
+        :param trial_idx: Index of the trial
+        :param warmup_checkpoints: Number of checkpoints before a trial can be pruned
+        :param min_trials: Minimum number of other trials with a loss at the checkpoint to compare with
+        """
+        self.curves = curves
+        self.trial_idx = trial_idx
+        self.warmup_checkpoints = warmup_checkpoints
+        self.min_trials = min_trials
+
+    def __call__(self, train_state):
+        """Record the validation loss curve of the trial, and return True if the trial should be pruned."""
+        curve = list(train_state['val_loss'])
+        self.curves[self.trial_idx] = curve
+        checkpoint = len(curve)
+        if checkpoint <= self.warmup_checkpoints:
+            return False
+
+        other_best_losses = [min(other_curve[:checkpoint]) for idx, other_curve in self.curves.items()
+                             if idx != self.trial_idx and len(other_curve) >= checkpoint]
+        if len(other_best_losses) < self.min_trials:
+            return False
+
+        return min(curve) > statistics.median(other_best_losses)
+
+
+def write_results_table(results, param_names, results_path):
+    """
+    Write the results of a sweep to a CSV file, and print them sorted by the best validation loss.
+
+    :param results: List of dictionaries of the trial results (trial, the parameters, status, steps, best_val_loss,
+                    final_train_loss, seconds, cores)
+    :param param_names: Names of the searched parameters
+    :param results_path: Path of the CSV file
+    """
+    results = sorted(results, key=lambda result: result['best_val_loss'])
+    columns = ['trial'] + param_names + ['status', 'steps', 'best_val_loss', 'final_train_loss', 'seconds', 'cores']
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+    rows = [['{:.4g}'.format(result[column]) if isinstance(result[column], float) else str(result[column])
+             for column in columns] for result in results]
+    widths = [max(len(cell) for cell in cells) + 2 for cells in zip(columns, *rows)]
+    for cells in [columns] + rows:
+        print(''.join('{:>{}}'.format(cell, width) for cell, width in zip(cells, widths)))
+    print('Saved the results to {}.'.format(results_path))
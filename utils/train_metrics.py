@@ -0,0 +1,197 @@
+import sys
+import json
+import time
+import contextlib
+from collections import defaultdict
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+TRAIN_PHASES = ['data', 'forward', 'backward', 'optimizer']
+CHECKPOINT_PHASES = ['validation', 'save', 'generation']
+
+
+def null_phase(name):
+    """Phase context of the disabled instrumentation: does nothing."""
+    return contextlib.suppress()
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of the process in MB, or None if it is not available."""
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+class TrainingMetrics:
+    """
+    Per-step instrumentation of the training loop.
+
+    Records the wall time of the training phases (data loading + collate, forward, backward, optimizer step) and the
+    checkpoint phases (validation, model saving, sample generation), the throughput, the padding ratio of the batches
+    and the peak memory, and streams them to a JSON Lines file: one "step" record per training step, one "checkpoint"
+    record per checkpoint and a "summary" record at the end.
+
+    Optionally, the steps in the [profile_start, profile_end] window are traced with the autograd profiler, and the
+    trace is saved in the Chrome trace format (chrome://tracing).
+    """
+
+    def __init__(self, metrics_path, device, pad_token_id, profile_steps=None, profile_path='train_profile.json'):
+        """
+        Initialize the TrainingMetrics object.
+
+        :param metrics_path: Path to the output JSONL file
+        :param device: Training device. CUDA is synchronized at the phase boundaries for correct timings
+        :param pad_token_id: Id of the padding token of the batches
+        :param profile_steps: Tuple of the first and last (1-based) steps of the profiler window. None: no profiling
+        :param profile_path: Output path of the profiler trace
+        """
+        self.metrics_file = open(metrics_path, 'w')
+        self.sync_cuda = torch.device(device).type == 'cuda'
+        self.pad_token_id = pad_token_id
+        self.profile_steps = profile_steps
+        self.profile_path = profile_path
+
+        self.profiler = None
+        self.phase_times = {}
+        self.total_phase_times = defaultdict(float)
+        self.total_tokens = 0
+        self.num_steps = 0
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager measuring the wall time of a phase of the current step or checkpoint."""
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+
+        if self.profiler is not None:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        else:
+            yield
+
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        self.phase_times[name] = self.phase_times.get(name, 0.) + time.perf_counter() - start
+
+    def timed_batches(self, dataloader):
+        """Iterate over a data loader, measuring the data loading and collate time of every batch."""
+        batches = iter(dataloader)
+        while True:
+            self._start_step()
+            with self.phase('data'):
+                batch = next(batches, None)
+
+            if batch is None:
+                # the last (empty) iteration of an epoch is not charged to the first step of the next epoch
+                self._reset_phases()
+                return
+            yield batch
+
+    def _start_step(self):
+        """Start the profiler at the beginning of the profiler window."""
+        if self.profile_steps and self.profiler is None and self.num_steps + 1 == self.profile_steps[0]:
+            self.profiler = self._create_profiler()
+            self.profiler.__enter__()
+
+    def end_step(self, step, batch, loss, learning_rate):
+        """
+        Write the record of a training step, and stop the profiler at the end of the profiler window.
+
+        :param step: Training steps so far
+        :param batch: Padded batch of the step
+        :param loss: Training loss of the step
+        :param learning_rate: Learning rate of the step
+        """
+        # every summary has an "<|endoftext|>" token at both ends, the rest of them are padding
+        num_tokens = batch.numel()
+        num_padding = max(0, (batch == self.pad_token_id).sum().item() - 2 * batch.size()[0])
+        step_seconds = sum(self.phase_times.values())
+
+        record = {'type': 'step', 'step': step, 'loss': loss, 'learning_rate': learning_rate}
+        record.update({'{}_seconds'.format(name): self.phase_times.get(name, 0.) for name in TRAIN_PHASES})
+        record.update({
+            'step_seconds': step_seconds,
+            'batch_size': batch.size()[0],
+            'seq_len': batch.size()[1],
+            'tokens': num_tokens - num_padding,
+            'tokens_per_sec': (num_tokens - num_padding) / step_seconds,
+            'padding_ratio': num_padding / num_tokens,
+            'peak_rss_mb': peak_rss_mb()
+        })
+        if self.sync_cuda:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        self._write(record)
+
+        self.total_tokens += num_tokens - num_padding
+        self.num_steps += 1
+        self._reset_phases()
+
+        if self.profiler is not None and step >= self.profile_steps[1]:
+            self._stop_profiler()
+
+    def end_checkpoint(self, step, train_loss, val_loss):
+        """Write the record of a checkpoint (validation, model saving, sample generation)."""
+        record = {'type': 'checkpoint', 'step': step, 'train_loss': train_loss, 'val_loss': val_loss}
+        record.update({'{}_seconds'.format(name): self.phase_times.get(name, 0.) for name in CHECKPOINT_PHASES})
+        record['peak_rss_mb'] = peak_rss_mb()
+        self._write(record)
+        self._reset_phases()
+
+    def close(self):
+        """Write the summary record, print the time spent in the different phases, and close the metrics file."""
+        # the phases not closed by a step or a checkpoint record
+        self._reset_phases()
+        if self.profiler is not None:
+            self._stop_profiler()
+
+        total_seconds = time.perf_counter() - self.start_time
+        summary = {
+            'type': 'summary',
+            'steps': self.num_steps,
+            'seconds': total_seconds,
+            'tokens_per_sec': self.total_tokens / total_seconds,
+            'phase_seconds': dict(self.total_phase_times),
+            'peak_rss_mb': peak_rss_mb()
+        }
+        self._write(summary)
+        self.metrics_file.close()
+
+        print('\nTime spent in the training phases ({} steps, {:.1f} seconds, {:.1f} tokens/sec):'.format(
+            self.num_steps, total_seconds, summary['tokens_per_sec']
+        ))
+        for name in TRAIN_PHASES + CHECKPOINT_PHASES:
+            seconds = self.total_phase_times.get(name, 0.)
+            print('  {:<12}{:>10.1f} s{:>8.1f}%'.format(name, seconds, 100 * seconds / total_seconds))
+
+    def _reset_phases(self):
+        for name, seconds in self.phase_times.items():
+            self.total_phase_times[name] += seconds
+        self.phase_times = {}
+
+    def _create_profiler(self):
+        if not self.sync_cuda:
+            return torch.autograd.profiler.profile()
+
+        try:
+            return torch.autograd.profiler.profile(use_cuda=True)
+        except TypeError:  # newer torch versions
+            return torch.autograd.profiler.profile(use_device='cuda')
+
+    def _stop_profiler(self):
+        self.profiler.__exit__(None, None, None)
+        self.profiler.export_chrome_trace(self.profile_path)
+        print('Saved the profiler trace of steps {}-{} to {}.'.format(*self.profile_steps, self.profile_path))
+        self.profiler = None
+
+    def _write(self, record):
+        self.metrics_file.write(json.dumps(record) + '\n')
+        self.metrics_file.flush()